@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+""" per-frame cost of the motion detector preprocessing stage,
+    old path (deepcopy, resize, blur BGR, grayscale) against
+    Downsampler (shallow copy, resize, grayscale, blur into
+    preallocated buffers) """
+
+import argparse
+import copy
+import os
+import sys
+import timeit
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from smartcam.frame import Frame
+from smartcam.motion_detector import Downsampler, resize_image
+
+
+def legacy(frame, width, blur_kernel):
+  frame = copy.deepcopy(frame)
+  image = resize_image(frame.image, width)
+  image = cv2.GaussianBlur(image, (blur_kernel, blur_kernel), 0)
+  frame.image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+  return frame
+
+
+def current(frame, downsample):
+  frame = copy.copy(frame)
+  frame.image = downsample(frame.image)
+  return frame
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-r', '--resolution', action='append',
+    help="WIDTHxHEIGHT of source frames, may be repeated")
+  parser.add_argument('-n', '--iterations', type=int, default=200)
+  parser.add_argument('-w', '--width', type=int, default=400)
+  parser.add_argument('-k', '--blur-kernel', type=int, default=21)
+  args = parser.parse_args()
+
+  for res in args.resolution or ['1280x720', '1920x1080']:
+    (w, h) = [ int(i) for i in res.split('x') ]
+    image = np.random.randint(0, 256, (h, w, 3), dtype=np.uint8)
+    frame = Frame(0, image, w, h)
+    downsample = Downsampler(args.width, args.blur_kernel)
+    old = timeit.timeit(lambda: legacy(frame, args.width, args.blur_kernel),
+      number=args.iterations) / args.iterations
+    new = timeit.timeit(lambda: current(frame, downsample),
+      number=args.iterations) / args.iterations
+    print("%-10s legacy: %7.3f ms  downsampler: %7.3f ms  speedup: %.2fx" %
+      (res, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+""" per-frame JPEG encode cost of each FrameEncoder backend,
+    at full size and downscaled for thumbnails """
+
+import argparse
+import os
+import sys
+import timeit
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from smartcam.encoder import ENCODERS
+
+
+def synthetic_image(w, h):
+  ''' noise is a worst case for JPEG, so draw something
+      closer to a camera image: gradient plus a few shapes '''
+  x = np.linspace(0, 255, w, dtype=np.uint8)
+  image = np.dstack([np.tile(x, (h, 1))] * 3)
+  for i in range(10):
+    cv2.circle(image, (w * i // 10, h // 2), h // 8,
+      (37 * i % 256, 91 * i % 256, 151 * i % 256), -1)
+  return image
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-r', '--resolution', action='append',
+    help="WIDTHxHEIGHT of source frames, may be repeated")
+  parser.add_argument('-n', '--iterations', type=int, default=100)
+  parser.add_argument('-q', '--quality', type=int, default=90)
+  parser.add_argument('-t', '--thumbnail-width', type=int, default=320)
+  args = parser.parse_args()
+
+  for res in args.resolution or ['1280x720', '1920x1080']:
+    (w, h) = [ int(i) for i in res.split('x') ]
+    image = synthetic_image(w, h)
+    for width in (None, args.thumbnail_width):
+      for (name, cls) in sorted(ENCODERS.items()):
+        encoder = cls(quality=args.quality, width=width)
+        size = len(encoder.encode(image))
+        t = timeit.timeit(lambda: encoder.encode(image),
+          number=args.iterations) / args.iterations
+        print("%-10s %-4s width=%-5s %7.3f ms  %8d bytes" %
+          (res, name, width or w, t * 1000, size))
+
+
+if __name__ == '__main__':
+  main()
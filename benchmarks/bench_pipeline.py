@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+""" end to end capture -> detect -> record benchmark -- runs the
+    real pipeline (CV2FrameReader, frame fan-out, the motion
+    detector process, VideoWriterImpl and FrameWriter) over a
+    video file at each resolution, once per motion detector,
+    with the api and cloud storage replaced by local stand-ins.
+    Frames are read as fast as the pipeline takes them.
+
+    Reports throughput, p50/p99 latency of each stage from the
+    per-frame trace stamps, and cpu and peak rss of the
+    detector and of the whole pipeline.  With --baseline,
+    exits non-zero if any case regressed by more than
+    --threshold against an earlier --save. """
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from smartcam import trace
+from smartcam.abstract import CloudWriter
+from smartcam.frame import Frame
+from smartcam.frame_reader import CV2FrameReader, detection_frame
+from smartcam.frame_writer import FrameWriter
+from smartcam.motion_detector import ( CV2MotionDetectorProcess,
+                                       CV2FrameDiffMotionDetector,
+                                       CV2BackgroundSubtractorMOG,
+                                       CV2BackgroundSubtractorGMG )
+from smartcam.queue import Queue
+from smartcam.queue_tee import QueueTee
+from smartcam.shared_frame import SharedFrameFanout, SharedFrameSubscriber
+from smartcam.video_writer import VideoWriterImpl
+
+CAMERA_ID = 'bench'
+
+DETECTORS = {
+  'framediff': CV2FrameDiffMotionDetector,
+  'mog': CV2BackgroundSubtractorMOG,
+  'gmg': CV2BackgroundSubtractorGMG
+}
+
+# (metric, True if higher is better) checked against a baseline:
+CHECKS = (('fps', True), ('detect_p50_ms', False), ('detect_p99_ms', False),
+          ('detector_cpu_ms_per_frame', False), ('peak_rss_mb', False))
+
+
+class MockAPIManager:
+  ''' stands in for APIManager, keeping clips and their
+      metadata in a local directory '''
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.clips = 0
+
+  def post_video_data(self, gen, url=None):
+    self.clips += 1
+    key = 'clip-%s-%05d.mkv' % (os.getpid(), self.clips)
+    with open(os.path.join(self.directory, key), 'wb') as f:
+      for chunk in gen:
+        f.write(chunk)
+    return { 'bucket': 'local', 'key': key, 'region': 'local' }
+
+  def post_video(self, video):
+    with open(os.path.join(self.directory, 'videos.jsonl'), 'a') as f:
+      f.write(video.serialize() + '\n')
+
+  def post_camera(self, camera_id):
+    pass
+
+
+class LocalCloudWriter(CloudWriter):
+  ''' stands in for S3Writer and BufferedKinesisWriter,
+      writing under a local directory '''
+
+  bucket = 'local'
+  region = 'local'
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def _path(self, dest):
+    path = os.path.join(self.directory, dest.replace(':', '-'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+  def write_file(self, src, dest):
+    shutil.copyfile(src, self._path(dest))
+
+  def write_fileobj(self, src, dest):
+    with open(self._path(dest), 'wb') as f:
+      shutil.copyfileobj(src, f)
+
+  def write_str(self, src, dest):
+    if isinstance(src, str):
+      src = src.encode('utf-8')
+    with open(self._path(dest), 'wb') as f:
+      f.write(src)
+
+  def write_stream(self, chunks, remote_path):
+    with open(self._path(remote_path), 'wb') as f:
+      for chunk in chunks:
+        f.write(chunk)
+    return remote_path
+
+  def get_video_path(self, camera_id, start_time, ext='mkv'):
+    return 'video/%s/%s.%s' % (camera_id, int(start_time.timestamp()), ext)
+
+
+def synthetic_video(path, w, h, frames, fps, seed=0):
+  """ write an MJPG avi of a textured static scene with a
+      shape moving across it for 4 of every 10 seconds, so
+      that both idle and motion paths are exercised """
+  rng = np.random.RandomState(seed)
+  x = np.linspace(40, 200, w, dtype=np.uint8)
+  background = np.dstack([np.tile(x, (h, 1))] * 3)
+  background = cv2.add(background,
+    rng.randint(0, 20, (h, w, 3), dtype=np.uint8))
+  period = int(10 * fps)
+  moving = int(4 * fps)
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+  for i in range(frames):
+    image = background.copy()
+    t = i % period
+    if t < moving:
+      cx = int(w * t / moving)
+      cv2.rectangle(image, (cx, h // 3), (cx + w // 8, h // 3 + h // 4),
+        (20, 20, 230), -1)
+    writer.write(image)
+  writer.release()
+
+
+def resized_video(src, path, w, h, frames, fps):
+  """ write the first frames of src, scaled to w x h """
+  cap = cv2.VideoCapture(src)
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+  n = 0
+  while n < frames:
+    (ok, image) = cap.read()
+    if not ok:
+      break
+    writer.write(cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA))
+    n += 1
+  writer.release()
+  cap.release()
+  if n == 0:
+    raise ValueError("no frames read from %s" % src)
+
+
+def make_fanout(transport, label, out_labels, stage, size):
+  """ return (in_queue, out_queues, tee), as main.make_frame_fanout
+      does with unbounded queues """
+  if transport == 'shared':
+    out_queues = [ SharedFrameSubscriber(l) for l in out_labels ]
+    return (SharedFrameFanout(label, out_queues, stage=stage, **size),
+      out_queues, None)
+  in_queue = Queue(label)
+  out_queues = [ Queue(l) for l in out_labels ]
+  return (in_queue, out_queues,
+    QueueTee(in_queue, out_queues, label.replace('_queue', '_tee'), stage))
+
+
+def drain(q):
+  try:
+    while True:
+      q.get()
+  except (EOFError, OSError):
+    # the case is over and its queues are gone
+    return
+
+
+def proc_stats(pid):
+  """ (cpu seconds, peak rss MB) of a live process, from /proc """
+  with open('/proc/%s/stat' % pid) as f:
+    fields = f.read().rsplit(')', 1)[1].split()
+  cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+  rss = 0
+  with open('/proc/%s/status' % pid) as f:
+    for line in f:
+      if line.startswith('VmHWM:'):
+        rss = int(line.split()[1]) / 1024.0
+  return (cpu, rss)
+
+
+def percentiles(values):
+  if not values:
+    return (None, None)
+  return tuple(float(np.percentile(values, p)) * 1000 for p in (50, 99))
+
+
+def summarize(trace_path, frames, sample_every):
+  """ throughput and per-stage latency from the trace, where a
+      stage's latency is the time since the stage before it """
+  records = [ json.loads(l) for l in open(trace_path) ]
+  stages = {}
+  detected = []
+  for r in records:
+    stamps = sorted(r['stamps'].items(), key=lambda s: s[1])
+    for ((_, start), (stage, end)) in zip(stamps, stamps[1:]):
+      stages.setdefault(stage, []).append(end - start)
+    stages.setdefault('total_' + r['sink'], []).append(r['latency'])
+    if 'detect_end' in r['stamps'] and r['sink'] != 'video':
+      detected.append(r['stamps'])
+  result = { 'frames': frames, 'stages': {} }
+  if detected:
+    elapsed = max(s['detect_end'] for s in detected) - \
+      min(s['capture'] for s in detected)
+    # sampled frames span the run, so this is the rate of all
+    result['fps'] = len(detected) * sample_every / elapsed \
+      if elapsed > 0 else None
+  for (stage, values) in stages.items():
+    result['stages'][stage] = percentiles(values)
+  (result['detect_p50_ms'], result['detect_p99_ms']) = \
+    result['stages'].get('detect_end', (None, None))
+  return result
+
+
+def settled(trace_path, captured, recording):
+  """ has every captured frame been traced to the end """
+  sinks = { 'detect': 0, 'image': 0, 'video': 0 }
+  if os.path.exists(trace_path):
+    for l in open(trace_path):
+      sinks[json.loads(l)['sink']] += 1
+  done = sinks['detect'] + sinks['image'] >= captured
+  if recording:
+    done = done and sinks['video'] >= sinks['image']
+  return done
+
+
+def run_case(case, results):
+  """ run the pipeline over one video with one detector,
+      in a fresh process so that cases don't share state """
+  # a spawned process spawns its own children by default, but
+  # the pipeline processes must be forked to inherit the tracer
+  multiprocessing.set_start_method('fork', force=True)
+  work = tempfile.mkdtemp(prefix='bench-pipeline-')
+  trace_path = os.path.join(work, 'trace.jsonl')
+  trace.enable(trace_path, case['sample_every'], 'jsonl')
+  (w, h) = case['size']
+  detect_width = case['detect_width']
+  size = { 'max_width': w, 'max_height': h }
+  if detect_width:
+    size = { 'max_width': detect_width, 'max_height': h, 'channels': 1,
+             'full_size': (w, h, 3) }
+  (frame_queue, (video_queue, image_queue), frame_tee) = make_fanout(
+    case['transport'], 'frame_queue', ['video_queue', 'image_queue'],
+    trace.TEE, size)
+  (motion_queue, (motion_video_queue, motion_image_queue), motion_tee) = \
+    make_fanout(case['transport'], 'motion_queue',
+      ['motion_video_queue', 'motion_image_queue'], trace.MOTION_QUEUE,
+      { 'max_width': w, 'max_height': h })
+
+  detector = CV2MotionDetectorProcess(DETECTORS[case['detector']](
+      area_threshold=case['area_threshold'], width=case['motion_width']),
+    image_queue, motion_queue, case['motion_timeout'],
+    preprocess_workers=case['preprocess_workers'])
+  detector.daemon = True
+  processes = [detector]
+  if case['record']:
+    video_writer = VideoWriterImpl(motion_video_queue, case['fps'],
+      MockAPIManager(work), cloud_writer=LocalCloudWriter(work))
+    video_writer.daemon = True
+    processes.append(video_writer)
+  else:
+    threading.Thread(target=drain, args=(motion_video_queue,),
+      daemon=True).start()
+  processes += [ t for t in (frame_tee, motion_tee) if t is not None ]
+  for p in processes:
+    p.start()
+  frame_writer = FrameWriter(motion_image_queue, LocalCloudWriter(work))
+  frame_writer.daemon = True
+  frame_writer.start()
+  threading.Thread(target=drain, args=(video_queue,), daemon=True).start()
+
+  reader = CV2FrameReader(CAMERA_ID, case['video'])
+  frames = 0
+  captured = 0
+  last = None
+  t0 = time.monotonic()
+  cpu0 = os.times()
+  while True:
+    frame = reader.get_frame()
+    if frame is None:
+      break
+    frames += 1
+    trace.start(frame)
+    if frame.stamps is not None:
+      captured += 1
+    last = frame.image
+    if detect_width:
+      frame = detection_frame(frame, detect_width)
+    frame_queue.put(frame)
+  # untraced still frames at the nominal rate until motion
+  # times out, so the last clip is finished and uploaded
+  tail_end = time.monotonic() + case['motion_timeout'] + 0.5
+  while last is not None and time.monotonic() < tail_end:
+    frame = Frame(CAMERA_ID, last, w, h)
+    if detect_width:
+      frame = detection_frame(frame, detect_width)
+    frame_queue.put(frame)
+    time.sleep(1.0 / case['fps'])
+  deadline = time.monotonic() + case['drain_timeout']
+  while not settled(trace_path, captured, case['record']):
+    if time.monotonic() > deadline:
+      print("warning: %s not settled after %ss" % (case['name'],
+        case['drain_timeout']), file=sys.stderr)
+      break
+    time.sleep(0.2)
+  wall = time.monotonic() - t0
+  cpu1 = os.times()
+
+  result = summarize(trace_path, frames, case['sample_every'])
+  stats = dict((p.name, proc_stats(p.pid)) for p in processes)
+  own_cpu = (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system)
+  own_rss = proc_stats(os.getpid())[1]
+  (detector_cpu, detector_rss) = stats[detector.name]
+  result.update(wall=wall,
+    detector_cpu_pct=100 * detector_cpu / wall,
+    detector_cpu_ms_per_frame=1000 * detector_cpu / max(1, frames),
+    pipeline_cpu_pct=100 * (own_cpu + sum(c for (c, _) in stats.values()))
+      / wall,
+    detector_rss_mb=detector_rss,
+    peak_rss_mb=max([own_rss] + [ r for (_, r) in stats.values() ]))
+  for p in processes:
+    p.terminate()
+    p.join()
+  shutil.rmtree(work, ignore_errors=True)
+  results.put(result)
+
+
+def run_isolated(case):
+  ctx = multiprocessing.get_context('spawn')
+  results = ctx.Queue()
+  p = ctx.Process(target=run_case, args=(case, results))
+  p.start()
+  try:
+    return results.get(timeout=case['drain_timeout'] + 600)
+  finally:
+    p.join()
+
+
+def available(detector):
+  """ MOG and GMG need opencv-contrib's bgsegm module """
+  try:
+    DETECTORS[detector]()
+    return True
+  except Exception:
+    return False
+
+
+def report(name, result):
+  print("%s: %s frames, %.1f fps, detector %.0f%% cpu %.1f ms/frame "
+    "%.0f MB, pipeline %.0f%% cpu, peak rss %.0f MB" % (name,
+    result['frames'], result.get('fps') or 0, result['detector_cpu_pct'],
+    result['detector_cpu_ms_per_frame'], result['detector_rss_mb'],
+    result['pipeline_cpu_pct'], result['peak_rss_mb']))
+  order = dict((s, i) for (i, s) in enumerate(trace.STAGES))
+  for (stage, (p50, p99)) in sorted(result['stages'].items(),
+                                    key=lambda s: (order.get(s[0], 99), s[0])):
+    print("  %-14s p50 %8.2f ms  p99 %8.2f ms" % (stage, p50, p99))
+
+
+def regressions(results, baseline, threshold):
+  """ return list of messages for metrics that got worse
+      by more than threshold, as a fraction """
+  failed = []
+  for (name, result) in sorted(results.items()):
+    base = baseline.get(name)
+    if base is None:
+      continue
+    for (metric, higher_is_better) in CHECKS:
+      (new, old) = (result.get(metric), base.get(metric))
+      if not new or not old:
+        continue
+      change = (new - old) / old
+      if higher_is_better:
+        change = -change
+      if change > threshold:
+        failed.append("%s %s: %.2f -> %.2f (%+.0f%%)" %
+          (name, metric, old, new, 100 * (new - old) / old))
+  return failed
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-r', '--resolution', action='append',
+    help="WIDTHxHEIGHT of frames, may be repeated")
+  parser.add_argument('-d', '--detector', action='append',
+    choices=sorted(DETECTORS), help="may be repeated, default all")
+  parser.add_argument('--video',
+    help="recorded video to use instead of a synthetic one, "
+         "scaled to each resolution")
+  parser.add_argument('-n', '--frames', type=int, default=600)
+  parser.add_argument('--fps', type=float, default=15,
+    help="nominal rate of the video, for recording")
+  parser.add_argument('--transport', choices=['shared', 'queue'],
+    default='shared')
+  parser.add_argument('--detect-width', type=int, default=0)
+  parser.add_argument('--motion-width', type=int, default=400)
+  parser.add_argument('--area-threshold', type=int, default=100)
+  parser.add_argument('--motion-timeout', type=float, default=1.0)
+  parser.add_argument('--preprocess-workers', type=int, default=0)
+  parser.add_argument('--sample-every', type=int, default=1,
+    help="trace one in this many frames")
+  parser.add_argument('--no-record', action='store_true',
+    help="skip ffmpeg recording, implied if ffmpeg is not installed")
+  parser.add_argument('--drain-timeout', type=float, default=60)
+  parser.add_argument('--save', help="write results to this json file")
+  parser.add_argument('--baseline', help="results json to compare against")
+  parser.add_argument('--threshold', type=float, default=0.2,
+    help="largest tolerated regression, as a fraction")
+  args = parser.parse_args()
+
+  record = not args.no_record
+  if record and shutil.which('ffmpeg') is None:
+    print("ffmpeg not found, not recording", file=sys.stderr)
+    record = False
+  detectors = args.detector or sorted(DETECTORS)
+  for d in list(detectors):
+    if not available(d):
+      print("skipping %s: not available in this opencv build" % d,
+        file=sys.stderr)
+      detectors.remove(d)
+
+  results = {}
+  videos = tempfile.mkdtemp(prefix='bench-videos-')
+  try:
+    for res in args.resolution or ['640x480', '1280x720']:
+      (w, h) = [ int(i) for i in res.split('x') ]
+      path = os.path.join(videos, '%s.avi' % res)
+      if args.video:
+        resized_video(args.video, path, w, h, args.frames, args.fps)
+      else:
+        synthetic_video(path, w, h, args.frames, args.fps)
+      for detector in detectors:
+        name = '%s@%s' % (detector, res)
+        results[name] = run_isolated({ 'name': name, 'video': path,
+          'size': (w, h), 'detector': detector, 'fps': args.fps,
+          'transport': args.transport, 'detect_width': args.detect_width,
+          'motion_width': args.motion_width,
+          'area_threshold': args.area_threshold,
+          'motion_timeout': args.motion_timeout,
+          'preprocess_workers': args.preprocess_workers,
+          'sample_every': args.sample_every, 'record': record,
+          'drain_timeout': args.drain_timeout })
+        report(name, results[name])
+  finally:
+    shutil.rmtree(videos, ignore_errors=True)
+
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      failed = regressions(results, json.load(f), args.threshold)
+    for message in failed:
+      print("REGRESSION %s" % message)
+    if failed:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -11,21 +11,33 @@ import cv2
 import time
 import argparse
 import smartcam
-from smartcam.cloud.aws import S3Writer, KinesisWriter
-from smartcam.frame_reader import CV2FrameReader, run_frame_thread
+from smartcam import metrics, trace
+from smartcam.cloud.aws import S3Writer, BufferedKinesisWriter
+from smartcam.frame_reader import ( CV2FrameReader, FFmpegFrameReader,
+                                    run_frame_thread )
 from smartcam.queue_tee import QueueTee
+from smartcam.preroll_buffer import PrerollBuffer
+from smartcam.motion_mask import MotionMask, parse_polygons
 from smartcam.motion_detector import ( CV2MotionDetectorProcess,
+                              AdaptiveScheduler,
                               CV2FrameDiffMotionDetector,
                               CV2BackgroundSubtractorMOG,
                               CV2BackgroundSubtractorGMG )
 from smartcam.video_processor import CV2VideoProcessor
-from smartcam.video_writer import VideoWriterImpl
-from smartcam.frame_writer import FrameWriter
+from smartcam.video_writer import VideoWriterImpl, video_spool_handlers
+from smartcam.frame_writer import FrameWriter, frame_spool_handlers
+from smartcam.spool import Spool, SpoolUploader
+from smartcam.encoder import ENCODERS, set_default_encoder
 from smartcam.api_manager import APIManager
 from smartcam.queue import Queue
+from smartcam.shared_frame import SharedFrameFanout, SharedFrameSubscriber
+from smartcam.supervisor import ( Supervisor, MotionWorker, UploadWorker,
+                                  assign_workers, default_worker_count )
 
 logger = logging.getLogger(__name__)
 
+CONFIG_FILE = "config"
+
 
 def get_device(use_default=True, device_path=None):
   """ assume lowest index camera found
@@ -77,19 +89,39 @@ def handle_video(video_processor, fps, show_video=False):
         logger.debug("FPS: %s" % (interval/diff.seconds))
       f1 = frame.time
     if show_video:
-      img = frame.image
+      img = frame.full.image if frame.full is not None else frame.image
       t = frame.time
       cv2.imshow(t.strftime('%Y-%m-%d'), img)
       cv2.waitKey(1)
 
 
-def parse_config():
-  config_file = "config"
+def list_cameras():
+  """ return ids of the [camera:<id>] sections in config """
   p = configparser.ConfigParser()
-  p.read(config_file)
+  p.read(CONFIG_FILE)
+  return [ s.split(':', 1)[1] for s in p.sections()
+           if s.startswith('camera:') ]
+
+
+def parse_config(camera=None):
+  """ given camera, settings in its [camera:<id>] section
+      override those in [camera] """
+  p = configparser.ConfigParser()
+  p.read(CONFIG_FILE)
+  if camera is not None:
+    for (key, value) in p.items('camera:%s' % camera):
+      p.set('camera', key, value)
   export = {}
   export['VIDEO_SOURCE'] = os.environ.get('VIDEO_SOURCE',
     p.get('camera', 'source'))
+  export['FRAME_READER'] = os.environ.get('FRAME_READER',
+    p.get('camera', 'reader', fallback='cv2'))
+  export['DECODE_WIDTH'] = int(os.environ.get('DECODE_WIDTH',
+    p.get('camera', 'decode_width', fallback=0)))
+  export['DECODE_HEIGHT'] = int(os.environ.get('DECODE_HEIGHT',
+    p.get('camera', 'decode_height', fallback=0)))
+  export['DETECT_WIDTH'] = int(os.environ.get('DETECT_WIDTH',
+    p.get('camera', 'detect_width', fallback=0)))
   export['MOTION_TIMEOUT'] = float(os.environ.get('MOTION_TIMEOUT',
     p.get('camera', 'motion_timeout')))
   export['FPS'] = float(os.environ.get('FPS',
@@ -106,46 +138,318 @@ def parse_config():
     p.get('storage', 's3_bucket'))
   export['AWS_REGION'] = os.environ.get('AWS_REGION',
     p.get('storage', 'aws_region'))
+  export['S3_MULTIPART_THRESHOLD_MB'] = int(os.environ.get(
+    'S3_MULTIPART_THRESHOLD_MB',
+    p.get('storage', 's3_multipart_threshold_mb', fallback=8)))
+  export['S3_MULTIPART_CHUNKSIZE_MB'] = int(os.environ.get(
+    'S3_MULTIPART_CHUNKSIZE_MB',
+    p.get('storage', 's3_multipart_chunksize_mb', fallback=8)))
+  export['S3_MAX_CONCURRENCY'] = int(os.environ.get('S3_MAX_CONCURRENCY',
+    p.get('storage', 's3_max_concurrency', fallback=4)))
+  export['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL',
+    p.get('storage', 's3_endpoint_url', fallback='')) or None
   export['KINESIS_STREAM'] = os.environ.get('KINESIS_STREAM',
     p.get('storage', 'kinesis_stream'))
+  export['IMAGE_FORMAT'] = os.environ.get('IMAGE_FORMAT',
+    p.get('storage', 'image_format', fallback='binary'))
+  export['IMAGE_ENCODER'] = os.environ.get('IMAGE_ENCODER',
+    p.get('storage', 'image_encoder', fallback='cv2'))
+  export['IMAGE_QUALITY'] = int(os.environ.get('IMAGE_QUALITY',
+    p.get('storage', 'image_quality', fallback=90)))
+  export['IMAGE_WIDTH'] = int(os.environ.get('IMAGE_WIDTH',
+    p.get('storage', 'image_width', fallback=0)))
+  export['KINESIS_LINGER'] = float(os.environ.get('KINESIS_LINGER',
+    p.get('storage', 'kinesis_linger', fallback=0.5)))
+  export['KINESIS_ENDPOINT_URL'] = os.environ.get('KINESIS_ENDPOINT_URL',
+    p.get('storage', 'kinesis_endpoint_url', fallback='')) or None
   export['CAMERA_ID'] = os.environ.get('CAMERA_ID',
     p.get('camera', 'camera_id'))
   export['BASE_API_URL'] = os.environ.get('BASE_API_URL',
     p.get('api', 'base_url'))
+  export['API_TIMEOUT'] = float(os.environ.get('API_TIMEOUT',
+    p.get('api', 'timeout', fallback=30)))
+  export['API_RETRIES'] = int(os.environ.get('API_RETRIES',
+    p.get('api', 'retries', fallback=3)))
+  export['API_BACKOFF'] = float(os.environ.get('API_BACKOFF',
+    p.get('api', 'backoff', fallback=0.5)))
+  export['API_BREAKER_THRESHOLD'] = int(os.environ.get('API_BREAKER_THRESHOLD',
+    p.get('api', 'breaker_threshold', fallback=5)))
+  export['API_BREAKER_COOLDOWN'] = float(os.environ.get('API_BREAKER_COOLDOWN',
+    p.get('api', 'breaker_cooldown', fallback=30)))
   export['MOTION_AREA_THRESH'] = int(os.environ.get('MOTION_AREA_THRESH',
     p.get('camera', 'motion_area_threshold', fallback=100)))
+  export['MOTION_FRAME_WIDTH'] = int(os.environ.get('MOTION_FRAME_WIDTH',
+    p.get('camera', 'motion_frame_width', fallback=400)))
+  export['MOTION_BLUR_KERNEL'] = int(os.environ.get('MOTION_BLUR_KERNEL',
+    p.get('camera', 'motion_blur_kernel', fallback=21)))
+  export['MOTION_REGION_MODE'] = os.environ.get('MOTION_REGION_MODE',
+    p.get('camera', 'motion_region_mode', fallback='components'))
+  export['MOTION_ROI'] = os.environ.get('MOTION_ROI',
+    p.get('camera', 'motion_roi', fallback=''))
+  export['MOTION_EXCLUDE'] = os.environ.get('MOTION_EXCLUDE',
+    p.get('camera', 'motion_exclude', fallback=''))
+  export['MOTION_MAX_SKIP'] = int(os.environ.get('MOTION_MAX_SKIP',
+    p.get('camera', 'motion_max_skip', fallback=1)))
+  export['MOTION_IDLE_BUDGET'] = float(os.environ.get('MOTION_IDLE_BUDGET',
+    p.get('camera', 'motion_idle_budget', fallback=0.25)))
+  export['MOTION_PREPROCESS_WORKERS'] = int(os.environ.get(
+    'MOTION_PREPROCESS_WORKERS',
+    p.get('camera', 'motion_preprocess_workers', fallback=0)))
+  export['MOTION_NEAR_RATIO'] = float(os.environ.get('MOTION_NEAR_RATIO',
+    p.get('camera', 'motion_near_ratio', fallback=0.5)))
+  export['PREROLL_SECONDS'] = float(os.environ.get('PREROLL_SECONDS',
+    p.get('camera', 'preroll_seconds', fallback=0)))
+  export['PREROLL_QUALITY'] = int(os.environ.get('PREROLL_QUALITY',
+    p.get('camera', 'preroll_quality', fallback=80)))
+  export['FRAME_TRANSPORT'] = os.environ.get('FRAME_TRANSPORT',
+    p.get('transport', 'frame_transport', fallback='shared'))
+  frame_slots = os.environ.get('FRAME_SLOTS',
+    p.get('transport', 'frame_slots', fallback=''))
+  export['FRAME_SLOTS'] = int(frame_slots) if frame_slots else None
+  export['MAX_FRAME_WIDTH'] = int(os.environ.get('MAX_FRAME_WIDTH',
+    p.get('transport', 'max_frame_width', fallback=1920)))
+  export['MAX_FRAME_HEIGHT'] = int(os.environ.get('MAX_FRAME_HEIGHT',
+    p.get('transport', 'max_frame_height', fallback=1080)))
+  export['FFMPEG_INPUT'] = os.environ.get('FFMPEG_INPUT',
+    p.get('recording', 'ffmpeg_input', fallback='rawvideo'))
+  export['FFMPEG_PRESET'] = os.environ.get('FFMPEG_PRESET',
+    p.get('recording', 'preset', fallback='')) or None
+  export['FFMPEG_CRF'] = int(os.environ.get('FFMPEG_CRF',
+    p.get('recording', 'crf', fallback=0)))
+  export['FFMPEG_TUNE'] = os.environ.get('FFMPEG_TUNE',
+    p.get('recording', 'tune', fallback='')) or None
+  export['RECORDING_MODE'] = os.environ.get('RECORDING_MODE',
+    p.get('recording', 'mode', fallback='clip'))
+  export['SEGMENT_SECONDS'] = float(os.environ.get('SEGMENT_SECONDS',
+    p.get('recording', 'segment_seconds', fallback=10)))
+  export['SEGMENT_DIR'] = os.environ.get('SEGMENT_DIR',
+    p.get('recording', 'segment_dir', fallback='')) or None
+  export['SEGMENT_UPLOAD_WORKERS'] = int(os.environ.get(
+    'SEGMENT_UPLOAD_WORKERS',
+    p.get('recording', 'segment_upload_workers', fallback=2)))
+  export['SPOOL_DIR'] = os.environ.get('SPOOL_DIR',
+    p.get('spool', 'directory', fallback=''))
+  export['SPOOL_QUOTA_MB'] = int(os.environ.get('SPOOL_QUOTA_MB',
+    p.get('spool', 'quota_mb', fallback=1024)))
+  export['SPOOL_SEGMENT_MB'] = int(os.environ.get('SPOOL_SEGMENT_MB',
+    p.get('spool', 'segment_mb', fallback=64)))
+  export['SPOOL_WORKERS'] = int(os.environ.get('SPOOL_WORKERS',
+    p.get('spool', 'upload_workers', fallback=2)))
+  export['SPOOL_INTERVAL'] = float(os.environ.get('SPOOL_INTERVAL',
+    p.get('spool', 'retry_interval', fallback=30)))
+  export['MOTION_WORKERS'] = int(os.environ.get('MOTION_WORKERS',
+    p.get('supervisor', 'motion_workers', fallback=0)))
+  export['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS',
+    p.get('supervisor', 'upload_workers', fallback=0)))
+  export['METRICS_PORT'] = int(os.environ.get('METRICS_PORT',
+    p.get('metrics', 'port', fallback=0)))
+  export['METRICS_BIND'] = os.environ.get('METRICS_BIND',
+    p.get('metrics', 'bind', fallback='127.0.0.1'))
+  export['METRICS_CAPACITY'] = int(os.environ.get('METRICS_CAPACITY',
+    p.get('metrics', 'capacity', fallback=1024)))
+  export['TRACE_FILE'] = os.environ.get('TRACE_FILE',
+    p.get('trace', 'file', fallback=''))
+  export['TRACE_SAMPLE_EVERY'] = int(os.environ.get('TRACE_SAMPLE_EVERY',
+    p.get('trace', 'sample_every', fallback=100)))
+  export['TRACE_FORMAT'] = os.environ.get('TRACE_FORMAT',
+    p.get('trace', 'format', fallback='jsonl'))
+  export['QUEUES'] = {}
+  if p.has_section('queues'):
+    for (label, value) in p.items('queues'):
+      export['QUEUES'][label] = parse_queue_options(value)
+  if camera is not None:
+    export['CAMERA_ID'] = camera
   return export
 
 
+def parse_queue_options(value):
+  ''' parse 'maxsize[,policy[,nth]]' into Queue keyword args '''
+  fields = [ f.strip() for f in value.split(',') ]
+  options = { 'maxsize': int(fields[0]) }
+  if len(fields) > 1:
+    options['policy'] = fields[1]
+  if len(fields) > 2:
+    options['nth'] = int(fields[2])
+  return options
+
+
+def make_frame_fanout(config, label, out_labels, suffix='', leases=None,
+                      detection=False, stage=None):
+  """ return (in_queue, out_queues, tee) for passing each frame
+      put on in_queue to every out queue -- 'shared' writes the
+      image once into a shared memory pool and fans out small
+      headers, so tee is None; 'queue' pickles whole frames and
+      needs tee, a QueueTee process, to be started by the caller.
+      suffix is appended to each label, but queue options are
+      still looked up by the bare label; leases maps a bare
+      out label to the number of frames its consumer holds
+      at once, if more than one.  detection is set for the
+      queue frame readers put to, which carries detection
+      frames if detect_width is set.  Traced frames are
+      stamped with stage as they are fanned out """
+  transport = config['FRAME_TRANSPORT']
+  leases = leases or {}
+  if transport == 'shared':
+    out_queues = [ SharedFrameSubscriber(l + suffix, debug=DEBUG,
+                     leases=leases.get(l, 1), **config['QUEUES'].get(l, {}))
+                   for l in out_labels ]
+    in_queue = SharedFrameFanout(label + suffix, out_queues,
+      slots=config['FRAME_SLOTS'], stage=stage,
+      **shared_frame_size(config, detection))
+    return in_queue, out_queues, None
+  if transport == 'queue':
+    in_queue = Queue(label + suffix, debug=DEBUG,
+      **config['QUEUES'].get(label, {}))
+    out_queues = [ Queue(l + suffix, debug=DEBUG,
+                     **config['QUEUES'].get(l, {})) for l in out_labels ]
+    tee = QueueTee(in_queue=in_queue, out_queues=out_queues,
+      name=(label + suffix).replace('_queue', '_tee'), stage=stage)
+    return in_queue, out_queues, tee
+  raise ValueError("unknown frame_transport: %s" % transport)
+
+
+def shared_frame_size(config, detection=False):
+  """ SharedFrameFanout size arguments -- a fanout carrying
+      detection frames holds small grayscale ones, with a
+      second store for the full frames they were made from """
+  size = { 'max_width': config['MAX_FRAME_WIDTH'],
+           'max_height': config['MAX_FRAME_HEIGHT'] }
+  if detection and config['DETECT_WIDTH']:
+    return { 'max_width': config['DETECT_WIDTH'],
+             'max_height': config['MAX_FRAME_HEIGHT'], 'channels': 1,
+             'full_size': (config['MAX_FRAME_WIDTH'],
+                           config['MAX_FRAME_HEIGHT'], 3) }
+  return size
+
+
+def make_shared_input(config, label, camera_ids, suffix='', leases=1):
+  """ return (out_queue, in_queues) where in_queues maps each
+      camera id to a queue whose frames all end up on the one
+      out_queue -- with 'shared' transport each camera gets its
+      own fanout (and shared memory store) feeding out_queue """
+  transport = config['FRAME_TRANSPORT']
+  options = config['QUEUES'].get(label, {})
+  if transport == 'shared':
+    out_queue = SharedFrameSubscriber(label + suffix, debug=DEBUG,
+      leases=leases, **options)
+    in_queues = { c: SharedFrameFanout('frame_queue_%s' % c, [out_queue],
+                       slots=config['FRAME_SLOTS'], stage=trace.TEE,
+                       **shared_frame_size(config, detection=True))
+                  for c in camera_ids }
+    return out_queue, in_queues
+  if transport == 'queue':
+    out_queue = Queue(label + suffix, debug=DEBUG, **options)
+    return out_queue, { c: out_queue for c in camera_ids }
+  raise ValueError("unknown frame_transport: %s" % transport)
+
+
+def preprocess_leases(config):
+  """ frames the motion detector holds at once -- one, or as
+      many as its PreprocessPool keeps in flight """
+  return 2 * config['MOTION_PREPROCESS_WORKERS'] or 1
+
+
+def load_frame_reader(config):
+  """ return (frame reader class, reader options) """
+  reader = config['FRAME_READER']
+  if reader == 'cv2':
+    return CV2FrameReader, {}
+  if reader == 'ffmpeg':
+    return FFmpegFrameReader, {
+      'width': config['DECODE_WIDTH'] or None,
+      'height': config['DECODE_HEIGHT'] or None,
+      # frames are copied into shared memory as they are put:
+      'reuse_buffer': config['FRAME_TRANSPORT'] == 'shared'
+    }
+  raise ValueError("unknown frame reader: %s" % reader)
+
+
+def load_ffmpeg_options(config):
+  return {
+    'input_format': config['FFMPEG_INPUT'],
+    'preset': config['FFMPEG_PRESET'],
+    'crf': config['FFMPEG_CRF'],
+    'tune': config['FFMPEG_TUNE']
+  }
+
+
+def load_segment_options(config):
+  ''' return SegmentedVideoManager options, or None
+      to record a single clip per event '''
+  mode = config['RECORDING_MODE']
+  if mode == 'clip':
+    return None
+  if mode == 'segmented':
+    return {
+      'segment_seconds': config['SEGMENT_SECONDS'],
+      'segment_dir': config['SEGMENT_DIR'],
+      'upload_workers': config['SEGMENT_UPLOAD_WORKERS']
+    }
+  raise ValueError("unknown recording mode: %s" % mode)
+
+
+def load_encoder(config):
+  return ENCODERS[config['IMAGE_ENCODER']](
+    quality=config['IMAGE_QUALITY'],
+    width=config['IMAGE_WIDTH'] or None)
+
+
 def load_api_manager(config):
   url = config['BASE_API_URL']
-  return APIManager(url, None)
+  return APIManager(url, None,
+    timeout=(3.05, config['API_TIMEOUT']),
+    retries=config['API_RETRIES'],
+    backoff=config['API_BACKOFF'],
+    breaker_threshold=config['API_BREAKER_THRESHOLD'],
+    breaker_cooldown=config['API_BREAKER_COOLDOWN'])
+
+
+def load_s3_writer(config, api, base_path):
+  return S3Writer(config['AWS_REGION'],
+    config['S3_BUCKET'], api, base_path,
+    multipart_threshold=config['S3_MULTIPART_THRESHOLD_MB'] << 20,
+    multipart_chunksize=config['S3_MULTIPART_CHUNKSIZE_MB'] << 20,
+    max_concurrency=config['S3_MAX_CONCURRENCY'],
+    endpoint_url=config['S3_ENDPOINT_URL'])
 
 
 def load_cloud_video_writer(config, api):
   ''' load object for writing stuff to cloud storage ---
-      will return None if not configured '''
+      will return None if not configured.  Clips are only
+      streamed straight to s3, with the device's own aws
+      credentials, with 's3_direct'; with 's3' they still go
+      through the api's video data endpoint '''
   dest = config['VIDEO_DESTINATION']
-  if dest == 'local':
+  if dest in ('local', 's3'):
     return None
-  if dest == 's3':
-    return S3Writer(config['AWS_REGION'],
-      config['S3_BUCKET'], api, 'video')
+  if dest == 's3_direct':
+    return load_s3_writer(config, api, 'video')
   raise ValueError
 
 
-def load_cloud_frame_writer(config):
+def load_spool(config):
+  ''' return Spool, or None if not configured '''
+  if not config['SPOOL_DIR']:
+    return None
+  return Spool(config['SPOOL_DIR'],
+    quota_bytes=config['SPOOL_QUOTA_MB'] << 20,
+    segment_bytes=config['SPOOL_SEGMENT_MB'] << 20)
+
+
+def load_cloud_frame_writer(config, spool=None):
   ''' load object for writing stuff to cloud storage ---
       will return None if not configured '''
   dest = config['IMAGE_DESTINATION']
   if dest == 'local':
     return None
   if dest == 's3':
-    return S3Writer(config['AWS_REGION'],
-      config['S3_BUCKET'], 'img')
+    return load_s3_writer(config, None, 'img')
   if dest == 'kinesis':
-    return KinesisWriter(config['AWS_REGION'],
-      config['KINESIS_STREAM'])
+    return BufferedKinesisWriter(config['AWS_REGION'],
+      config['KINESIS_STREAM'],
+      linger=config['KINESIS_LINGER'],
+      endpoint_url=config['KINESIS_ENDPOINT_URL'],
+      spool=spool)
   raise ValueError
 
 
@@ -153,47 +457,131 @@ def load_motion_detector(config):
   pass
 
 
+def load_motion_mask(config):
+  return MotionMask(parse_polygons(config['MOTION_ROI']),
+    parse_polygons(config['MOTION_EXCLUDE']))
+
+
+def load_motion_process(config, image_queue, motion_queue, show_video=False):
+  # FIXME: make this configurable:
+  # motion_detector = CV2BackgroundSubtractorMOG(debug=DEBUG,
+  #  show_video=show_video)
+  # motion_detector = CV2BackgroundSubtractorGMG(debug=DEBUG,
+  #  show_video=show_video)
+  motion_detector = CV2FrameDiffMotionDetector(
+    area_threshold=config['MOTION_AREA_THRESH'],
+    debug=DEBUG,
+    show_video=show_video,
+    width=config['MOTION_FRAME_WIDTH'],
+    blur_kernel=config['MOTION_BLUR_KERNEL'],
+    region_mode=config['MOTION_REGION_MODE'],
+    mask=load_motion_mask(config))
+  preroll = None
+  if config['PREROLL_SECONDS'] > 0:
+    preroll = PrerollBuffer(config['PREROLL_SECONDS'], config['FPS'],
+      config['PREROLL_QUALITY'])
+  scheduler = None
+  if config['MOTION_MAX_SKIP'] > 1:
+    scheduler = AdaptiveScheduler(config['FPS'],
+      max_stride=config['MOTION_MAX_SKIP'],
+      idle_budget=config['MOTION_IDLE_BUDGET'],
+      near_ratio=config['MOTION_NEAR_RATIO'])
+  return CV2MotionDetectorProcess(motion_detector,
+    image_queue, motion_queue, config['MOTION_TIMEOUT'], debug=DEBUG,
+    show_video=show_video, preroll=preroll, scheduler=scheduler,
+    preprocess_workers=config['MOTION_PREPROCESS_WORKERS'])
+
+
+def load_metrics(config):
+  """ set up the shared metrics registry, and serve it if
+      a port is configured -- must run before any queues or
+      processes are created, so that they all report into it """
+  if not config['METRICS_PORT']:
+    return
+  metrics.enable(config['METRICS_CAPACITY'])
+  metrics.MetricsServer(config['METRICS_PORT'], config['METRICS_BIND']).start()
+
+
+def load_trace(config):
+  """ start writing sampled frame traces, if a file is
+      configured -- like load_metrics, before any processes
+      are started """
+  if not config['TRACE_FILE']:
+    return
+  trace.enable(config['TRACE_FILE'], config['TRACE_SAMPLE_EVERY'],
+    config['TRACE_FORMAT'])
+
+
+def load_spool_uploader(config, spool, api_manager, cloud_video_writer,
+                        cloud_frame_writer):
+  handlers = video_spool_handlers(api_manager, cloud_video_writer)
+  if cloud_frame_writer is not None:
+    handlers.update(frame_spool_handlers(cloud_frame_writer))
+  return SpoolUploader(spool, handlers,
+    max_workers=config['SPOOL_WORKERS'],
+    interval=config['SPOOL_INTERVAL'])
+
+
 def main(show_video=False):
   """ initialize all the things  """
 
   config = parse_config()
-  motion_timeout = config['MOTION_TIMEOUT']
   camera_id = config['CAMERA_ID']
   fps = config['FPS']
   video_source = get_video_source(config)
-  frame_queue = Queue("frame_queue", debug=DEBUG)
-  video_queue = Queue("video_queue", debug=DEBUG)
-  image_queue = Queue("image_queue", debug=DEBUG)
-  motion_queue = Queue("motion_queue", debug=DEBUG)
-  motion_video_queue = Queue("motion_video_queue", debug=DEBUG)
-  motion_image_queue = Queue("motion_image_queue", debug=DEBUG)
-
   try:
-    frame_tee = QueueTee(in_queue=frame_queue,
-      out_queues=[video_queue, image_queue],
-      name="frame_tee")
-    frame_tee.start()
+    set_default_encoder(load_encoder(config))
   except Exception as e:
-    logger.critical("Failed to load frame_tee: %s " % e)
+    logger.critical("Failed to load encoder: %s" % e)
+    return 1
+  try:
+    load_metrics(config)
+  except Exception as e:
+    logger.critical("Failed to load metrics: %s" % e)
+    return 1
+  try:
+    load_trace(config)
+  except Exception as e:
+    logger.critical("Failed to load trace: %s" % e)
     return 1
-
   try:
-    motion_tee = QueueTee(in_queue=motion_queue,
-     out_queues=[motion_video_queue, motion_image_queue],
-     name="motion_tee")
-    motion_tee.start()
+    (frame_queue, (video_queue, image_queue), frame_tee) = \
+      make_frame_fanout(config, "frame_queue", ["video_queue", "image_queue"],
+        leases={ "image_queue": preprocess_leases(config) }, detection=True,
+        stage=trace.TEE)
+    (motion_queue, (motion_video_queue, motion_image_queue), motion_tee) = \
+      make_frame_fanout(config, "motion_queue",
+        ["motion_video_queue", "motion_image_queue"],
+        stage=trace.MOTION_QUEUE)
   except Exception as e:
-    logger.critical("Failed to load motion_tee: %s " % e)
+    logger.critical("Failed to create frame queues: %s" % e)
     return 1
 
+  if frame_tee is not None:
+    try:
+      frame_tee.start()
+    except Exception as e:
+      logger.critical("Failed to load frame_tee: %s " % e)
+      return 1
+
+  if motion_tee is not None:
+    try:
+      motion_tee.start()
+    except Exception as e:
+      logger.critical("Failed to load motion_tee: %s " % e)
+      return 1
+
   try:
     logger.debug('starting frame_reader')
+    (frame_reader_class, reader_options) = load_frame_reader(config)
     frame_thread = multiprocessing.Process(target=run_frame_thread,
-                                           args=(CV2FrameReader,
+                                           args=(frame_reader_class,
                                                  camera_id,
                                                  video_source,
                                                  frame_queue,
-                                                 fps))
+                                                 fps,
+                                                 reader_options,
+                                                 config['DETECT_WIDTH']))
     frame_thread.start()
   except Exception as e:
     logger.critical("Failed to start frame_thread: %s" % e)
@@ -205,6 +593,12 @@ def main(show_video=False):
     logger.critical("Failed to load api_manager: %s" % e)
     return 1
 
+  try:
+    spool = load_spool(config)
+  except Exception as e:
+    logger.critical("Failed to load spool: %s" % e)
+    return 1
+
   try:
     cloud_video_writer = load_cloud_video_writer(config, api_manager)
   except Exception as e:
@@ -212,45 +606,41 @@ def main(show_video=False):
     return 1
 
   try:
-    cloud_frame_writer = load_cloud_frame_writer(config)
+    cloud_frame_writer = load_cloud_frame_writer(config, spool)
   except Exception as e:
     logger.critical("Failed to load cloud_frame_writer: %s" % e)
     return 1
 
   try:
     video_writer = VideoWriterImpl(motion_video_queue,
-      fps, load_api_manager(config))
+      fps, load_api_manager(config), load_ffmpeg_options(config), spool,
+      cloud_video_writer, load_segment_options(config))
     video_writer.start()
   except Exception as e:
     logger.critical("Failed to load video_writer: %s" % e)
     return 1
 
   try:
-    frame_writer = FrameWriter(motion_image_queue, cloud_frame_writer)
+    frame_writer = FrameWriter(motion_image_queue, cloud_frame_writer,
+      config['IMAGE_FORMAT'], spool)
     frame_writer.start()
   except Exception as e:
     logger.critical("Failed to load frame_writer: %s" % e)
     return 1
 
-  try:
-    # FIXME: make this configurable:
-    # motion_detector = CV2BackgroundSubtractorMOG(debug=DEBUG,
-    #  show_video=show_video)
-    # motion_detector = CV2BackgroundSubtractorGMG(debug=DEBUG,
-    #  show_video=show_video)
-    motion_detector = CV2FrameDiffMotionDetector(
-      area_threshold=config['MOTION_AREA_THRESH'],
-      debug=DEBUG,
-      show_video=show_video)
-  except Exception as e:
-    logger.critical("Failed to load motion_detector: %s" % e)
-    return 1
+  if spool is not None:
+    try:
+      spool_uploader = load_spool_uploader(config, spool, api_manager,
+        cloud_video_writer, cloud_frame_writer)
+      spool_uploader.start()
+    except Exception as e:
+      logger.critical("Failed to load spool_uploader: %s" % e)
+      return 1
 
   try:
     logger.debug('starting motion_detector process')
-    md_process = CV2MotionDetectorProcess(motion_detector,
-      image_queue, motion_queue, motion_timeout, debug=DEBUG,
-      show_video=show_video)
+    md_process = load_motion_process(config, image_queue, motion_queue,
+      show_video)
     md_process.start()
   except Exception as e:
     logger.critical("Failed to load motion_detector process: %s" % e)
@@ -271,14 +661,166 @@ def main(show_video=False):
 
   frame_thread.join()
   md_process.join()
-  frame_tee.join()
-  motion_tee.join()
+  if frame_tee is not None:
+    frame_tee.join()
+  if motion_tee is not None:
+    motion_tee.join()
   video_writer.join()
   frame_writer.join()
 
   return 0
 
 
+def supervise():
+  """ run every [camera:<id>] in config in one process tree --
+      each camera has its own frame reader process, while motion
+      detection and uploads run on pools of worker processes
+      that cameras are pinned to, sized from the cpu count
+      unless configured """
+  camera_ids = list_cameras()
+  if not camera_ids:
+    logger.critical("No [camera:<id>] sections in config")
+    return 1
+  try:
+    config = parse_config()
+    configs = { c: parse_config(c) for c in camera_ids }
+  except Exception as e:
+    logger.critical("Failed to parse config: %s" % e)
+    return 1
+  try:
+    set_default_encoder(load_encoder(config))
+  except Exception as e:
+    logger.critical("Failed to load encoder: %s" % e)
+    return 1
+  try:
+    load_metrics(config)
+  except Exception as e:
+    logger.critical("Failed to load metrics: %s" % e)
+    return 1
+  try:
+    load_trace(config)
+  except Exception as e:
+    logger.critical("Failed to load trace: %s" % e)
+    return 1
+
+  n_motion = config['MOTION_WORKERS'] or default_worker_count(len(camera_ids))
+  n_upload = config['UPLOAD_WORKERS'] or default_worker_count(
+    len(camera_ids), reserved=n_motion)
+  motion_workers = assign_workers(camera_ids, n_motion)
+  upload_workers = assign_workers(camera_ids, n_upload)
+  logger.info("%s cameras on %s motion and %s upload workers" %
+    (len(camera_ids), n_motion, n_upload))
+
+  supervisor = Supervisor()
+  try:
+    camera_queues = {}
+    image_queues = []
+    for i in range(n_motion):
+      cameras = [ c for c in camera_ids if motion_workers[c] == i ]
+      (image_queue, in_queues) = make_shared_input(config, 'image_queue',
+        cameras, suffix='_%s' % i, leases=preprocess_leases(config))
+      image_queues.append(image_queue)
+      camera_queues.update(in_queues)
+    motion_queues = {}
+    motion_video_queues = {}
+    motion_image_queues = {}
+    for c in camera_ids:
+      (motion_queues[c], (motion_video_queues[c], motion_image_queues[c]),
+        motion_tee) = make_frame_fanout(config, 'motion_queue',
+          ['motion_video_queue', 'motion_image_queue'], suffix='_%s' % c,
+          stage=trace.MOTION_QUEUE)
+      if motion_tee is not None:
+        supervisor.add(motion_tee.name, tee_factory(motion_tee))
+  except Exception as e:
+    logger.critical("Failed to create frame queues: %s" % e)
+    return 1
+
+  for c in camera_ids:
+    supervisor.add('frame_reader_%s' % c,
+      frame_reader_factory(configs[c], camera_queues[c],
+        config['DETECT_WIDTH']))
+  for i in range(n_motion):
+    cameras = [ c for c in camera_ids if motion_workers[c] == i ]
+    supervisor.add('motion_worker_%s' % i, motion_worker_factory(
+      'motion_worker_%s' % i, configs, cameras, image_queues[i],
+      motion_queues, config['MOTION_PREPROCESS_WORKERS']),
+      queues=[image_queues[i]])
+
+  try:
+    api_manager = load_api_manager(config)
+    spool = load_spool(config)
+  except Exception as e:
+    logger.critical("Failed to load api_manager: %s" % e)
+    return 1
+  for i in range(n_upload):
+    cameras = [ c for c in camera_ids if upload_workers[c] == i ]
+    supervisor.add('upload_worker_%s' % i, upload_worker_factory(
+      'upload_worker_%s' % i, config, spool,
+      [ (configs[c], motion_video_queues[c], motion_image_queues[c])
+        for c in cameras ]),
+      queues=[ q for c in cameras
+               for q in (motion_video_queues[c], motion_image_queues[c]) ])
+
+  if spool is not None:
+    try:
+      load_spool_uploader(config, spool, api_manager,
+        load_cloud_video_writer(config, api_manager),
+        load_cloud_frame_writer(config, spool)).start()
+    except Exception as e:
+      logger.critical("Failed to load spool_uploader: %s" % e)
+      return 1
+
+  for c in camera_ids:
+    try:
+      api_manager.post_camera(c)
+    except Exception as e:
+      logger.warn("Failed to post camera %s: %s" % (c, e))
+
+  supervisor.run()
+  return 0
+
+
+def tee_factory(tee):
+  return lambda: QueueTee(tee.in_queue, tee.out_queues, tee.name, tee.stage)
+
+
+def frame_reader_factory(config, queue, detect_width):
+  """ detect_width must match the shared input queue's, so
+      it is not taken from the camera's config """
+  (frame_reader_class, reader_options) = load_frame_reader(config)
+  return lambda: multiprocessing.Process(target=run_frame_thread,
+    name='frame_reader_%s' % config['CAMERA_ID'],
+    args=(frame_reader_class, config['CAMERA_ID'], get_video_source(config),
+          queue, config['FPS'], reader_options, detect_width))
+
+
+def motion_worker_factory(name, configs, cameras, image_queue, motion_queues,
+                          preprocess_workers=0):
+  """ detector state is rebuilt on every restart """
+  return lambda: MotionWorker(name, image_queue,
+    { c: load_motion_process(configs[c], None, motion_queues[c])
+      for c in cameras }, preprocess_workers)
+
+
+def upload_worker_factory(name, config, spool, cameras):
+  """ cameras is a list of (camera config, motion video queue,
+      motion image queue); cloud clients are shared by the
+      cameras on the worker """
+  def factory():
+    api_manager = load_api_manager(config)
+    cloud_video_writer = load_cloud_video_writer(config, api_manager)
+    cloud_frame_writer = load_cloud_frame_writer(config, spool)
+    video_writers = [ VideoWriterImpl(video_queue, c['FPS'], api_manager,
+                        load_ffmpeg_options(c), spool, cloud_video_writer,
+                        load_segment_options(c))
+                      for (c, video_queue, _) in cameras ]
+    frame_writers = [ FrameWriter(image_queue, cloud_frame_writer,
+                        c['IMAGE_FORMAT'], spool)
+                      for (c, _, image_queue) in cameras ]
+    return UploadWorker(name, video_writers, frame_writers)
+  return factory
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument(
@@ -294,6 +836,13 @@ if __name__ == '__main__':
       default=False
   )
 
+  parser.add_argument(
+      '--supervisor',
+      help="Run every [camera:<id>] in config on shared worker processes",
+      action="store_true",
+      default=False
+  )
+
   args = parser.parse_args()
   logging.basicConfig(stream=sys.stdout,
     level=args.loglevel,
@@ -310,6 +859,9 @@ if __name__ == '__main__':
   logging.getLogger('nose').setLevel(logging.WARNING)
   logging.getLogger('s3transfer').setLevel(logging.WARNING)
 
-  x = main(show_video)
+  if args.supervisor:
+    x = supervise()
+  else:
+    x = main(show_video)
   sys.exit(x)
 
@@ -87,3 +87,24 @@ class Queue(metaclass=abc.ABCMeta):
 
   def put(self, item):
     pass
+
+
+class FrameEncoder(metaclass=abc.ABCMeta):
+  """ interface for still image encoders """
+
+  image_type = None
+
+  @abc.abstractmethod
+  def encode(self, image):
+    """ return encoded bytes of BGR ndarray """
+    pass
+
+  @property
+  def key(self):
+    """ identifies output, for caching encoded frames """
+    return (type(self).__name__,)
+
+  def size(self, image):
+    """ (width, height) of what encode makes of image """
+    (h, w) = image.shape[:2]
+    return (w, h)
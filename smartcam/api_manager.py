@@ -1,52 +1,191 @@
 import requests
 import logging
 import json
+import os
+import random
+import threading
+import time
+from smartcam import metrics
 
 logger = logging.getLogger(__name__)
 
+# methods safe to send again when the first try may have
+# reached the server:
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
 
 class APIConnectionError(Exception):
   pass
 
 
+class CircuitOpenError(APIConnectionError):
+  ''' raised without trying the api while the breaker is open '''
+  pass
+
+
+class CircuitBreaker:
+  ''' stop calling an api that keeps failing -- opens after
+      threshold consecutive failures, and after cooldown seconds
+      lets a single call through to test it again, failing the
+      others fast until it is back.  Shared by the threads of a
+      process, so state is only touched under a lock. '''
+
+  def __init__(self, threshold=5, cooldown=30.0):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.opened_at = None
+    self.probing = False
+    self._lock = threading.Lock()
+
+  def allow(self):
+    with self._lock:
+      if self.opened_at is None:
+        return True
+      if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+        return False
+      # half open: this call is the probe, and its result
+      # closes or re-opens the breaker
+      self.probing = True
+      return True
+
+  def record_success(self):
+    with self._lock:
+      self.failures = 0
+      self.opened_at = None
+      self.probing = False
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+      if self.probing or (self.opened_at is None and
+                          self.failures >= self.threshold):
+        logger.warning("api circuit breaker open for %ss" % self.cooldown)
+        self.opened_at = time.monotonic()
+        self.probing = False
+
+  def record_aborted(self):
+    ''' a call let through ended without telling whether the
+        api is up, eg. on a bad request -- let another probe '''
+    with self._lock:
+      self.probing = False
+
+
 class APIManager:
-  ''' handles calls to remote api '''
+  ''' handles calls to remote api -- requests go through a
+      pooled keep-alive session, connection errors, timeouts
+      and 5xx responses are retried with jittered exponential
+      backoff, and a circuit breaker fails calls fast while the
+      api is down.  Request bodies that are generators can't be
+      replayed, so those are tried only once.  Other requests
+      that are not idempotent (POST) are only retried if they
+      can't have reached the server -- connection failures, not
+      read timeouts or 5xx -- so records are never duplicated. '''
 
-  def __init__(self, base_url, auth_key=None):
+  def __init__(self, base_url, auth_key=None, timeout=(3.05, 30),
+               retries=3, backoff=0.5, breaker_threshold=5,
+               breaker_cooldown=30.0, pool_size=4):
     self.base_url = base_url
     self.auth_key = auth_key
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.pool_size = pool_size
+    self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+    self._session = None
+    self._pid = None
+    self._metrics = {}
+
+  @property
+  def session(self):
+    ''' one session per process -- pooled connections must
+        not be shared across a fork '''
+    if self._session is None or self._pid != os.getpid():
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(
+        pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      self._session = session
+      self._pid = os.getpid()
+    return self._session
+
+  def _metric(self, kind, name, method):
+    key = (name, method)
+    metric = self._metrics.get(key)
+    if metric is None:
+      metric = self._metrics[key] = getattr(metrics, kind)(name,
+        method=method)
+    return metric
+
+  def _request(self, method, url, retry=True, **kwargs):
+    with self._metric('histogram', 'smartcam_api_request_seconds',
+                      method).time():
+      try:
+        return self._try_request(method, url, retry, **kwargs)
+      except Exception:
+        self._metric('counter', 'smartcam_api_errors_total', method).inc()
+        raise
+
+  def _try_request(self, method, url, retry=True, **kwargs):
+    attempts = self.retries + 1 if retry else 1
+    idempotent = method in IDEMPOTENT
+    error = None
+    for attempt in range(attempts):
+      if not self.breaker.allow():
+        raise CircuitOpenError("circuit open for %s" % url)
+      if attempt > 0:
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+      try:
+        r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+      except (requests.exceptions.ConnectionError,
+              requests.exceptions.Timeout) as e:
+        self.breaker.record_failure()
+        error = e
+        logger.warning("%s %s failed (attempt %s): %s" %
+          (method, url, attempt + 1, e))
+        if not idempotent and isinstance(e, requests.exceptions.ReadTimeout):
+          # the server may have acted on it already
+          break
+        continue
+      except BaseException:
+        self.breaker.record_aborted()
+        raise
+      if r.status_code >= 500:
+        self.breaker.record_failure()
+        error = requests.exceptions.HTTPError(
+          "%s Server Error for url: %s" % (r.status_code, url), response=r)
+        logger.warning("%s %s returned %s (attempt %s)" %
+          (method, url, r.status_code, attempt + 1))
+        if not idempotent:
+          break
+        continue
+      self.breaker.record_success()
+      r.raise_for_status()
+      return r
+    if isinstance(error, requests.exceptions.HTTPError):
+      raise error
+    raise APIConnectionError(error)
 
   def post_video_data(self, gen, url=None):
     """ upload video binary in chunks using provided
         generator function, return s3 location json """
     if url is None:
       url = self.base_url + 'videodata'
-    try:
-      r = requests.post(url, data=gen)
-      r.raise_for_status()
-      return r.json()
-    except requests.exceptions.ConnectionError as e:
-      raise APIConnectionError
+    r = self._request('POST', url, data=gen,
+      retry=isinstance(gen, (bytes, bytearray)))
+    return r.json()
 
   def post_video(self, video):
     """ upload video metadata, including
         location of previously-uploaded binary
         data  """
     url = self.base_url + 'videos'
-    try:
-      a = video.serialize()
-      headers = { 'Content-type': 'application/json' }
-      r = requests.post(url, data=video.serialize(), headers=headers)
-      r.raise_for_status()
-    except requests.exceptions.ConnectionError as e:
-      raise APIConnectionError
+    headers = { 'Content-type': 'application/json' }
+    self._request('POST', url, data=video.serialize(), headers=headers)
 
   def post_camera(self, camera_id):
     url = self.base_url + 'cameras'
     payload = json.dumps({ "camera_id": camera_id })
-    try:
-      headers = { 'Content-type': 'application/json' }
-      r = requests.post(url, data=payload, headers=headers)
-      r.raise_for_status()
-    except requests.exceptions.ConnectionError as e:
-      raise APIConnectionError
+    headers = { 'Content-type': 'application/json' }
+    self._request('POST', url, data=payload, headers=headers)
@@ -0,0 +1,230 @@
+""" offline motion detection over recorded video files --
+
+      python -m smartcam.batch [options] FILE...
+
+    Files are read as fast as they decode, each on its own
+    worker process, and the motion intervals found in them are
+    written as columnar json: a table is an object of equal
+    length column arrays, eg. intervals['start'][i] and
+    intervals['end'][i] are the bounds of interval i, in
+    seconds from the start of intervals['file'][i]. """
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import cv2
+from smartcam.frame import Frame
+from smartcam.motion_mask import MotionMask, parse_polygons
+from smartcam.motion_detector import ( CV2FrameDiffMotionDetector,
+                                       CV2BackgroundSubtractorMOG,
+                                       CV2BackgroundSubtractorGMG )
+
+logger = logging.getLogger(__name__)
+
+DETECTORS = {
+  'framediff': CV2FrameDiffMotionDetector,
+  'mog': CV2BackgroundSubtractorMOG,
+  'gmg': CV2BackgroundSubtractorGMG
+}
+
+# used when a file does not say what its frame rate is:
+DEFAULT_FPS = 25.0
+
+
+def load_detector(options):
+  mask = MotionMask(parse_polygons(options['roi']),
+    parse_polygons(options['exclude']))
+  return DETECTORS[options['detector']](
+    area_threshold=options['area_threshold'],
+    width=options['width'],
+    blur_kernel=options['blur_kernel'],
+    region_mode=options['region_mode'],
+    mask=mask)
+
+
+class Interval:
+  ''' a run of motion, closed once there has been none for
+      motion_timeout seconds, as CV2MotionDetectorProcess
+      closes a clip -- end is the last frame with motion '''
+
+  def __init__(self, start):
+    self.start = start
+    self.end = start
+    self.frames = 0
+    self.box = None
+
+  def add(self, t, boxes):
+    self.end = t
+    self.frames += 1
+    x0 = boxes[:, 0].min()
+    y0 = boxes[:, 1].min()
+    x1 = (boxes[:, 0] + boxes[:, 2]).max()
+    y1 = (boxes[:, 1] + boxes[:, 3]).max()
+    if self.box is not None:
+      (x0, y0) = (min(x0, self.box[0]), min(y0, self.box[1]))
+      (x1, y1) = (max(x1, self.box[2]), max(y1, self.box[3]))
+    self.box = (int(x0), int(y0), int(x1), int(y1))
+
+
+def scan(path, options):
+  """ run motion detection over one file, return a dict of
+      its 'file' row and the rows of its 'intervals' and
+      'boxes' tables """
+  t0 = time.monotonic()
+  detector = load_detector(options)
+  cap = cv2.VideoCapture(path)
+  if not cap.isOpened():
+    raise IOError("cannot open %s" % path)
+  fps = cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+  stride = options['stride']
+  intervals = []
+  boxes = []
+  current = None
+  index = -1
+  detected = 0
+  while True:
+    # frames skipped by stride are grabbed but never decoded
+    for _ in range(stride - 1):
+      if not cap.grab():
+        break
+      index += 1
+    (ok, image) = cap.read()
+    if not ok:
+      break
+    index += 1
+    t = index / fps
+    (h, w) = image.shape[:2]
+    detector.current = Frame(path, image, w, h)
+    regions = detector.detect_motion()
+    detected += 1
+    if regions is not None:
+      regions = detector.downsample.to_source(regions)
+      if current is None:
+        current = Interval(t)
+        intervals.append(current)
+      current.add(t, regions)
+      if options['boxes']:
+        boxes += [ (t,) + tuple(int(v) for v in r) for r in regions ]
+    elif current is not None and t - current.end >= options['motion_timeout']:
+      current = None
+  cap.release()
+  return {
+    'file': { 'frames': index + 1, 'detected': detected, 'fps': fps,
+      'duration': (index + 1) / fps, 'seconds': time.monotonic() - t0,
+      'error': None },
+    'intervals': [ (i.start, i.end, i.frames) + i.box for i in intervals ],
+    'boxes': boxes
+  }
+
+
+def _init_worker():
+  # one file per core already, so keep opencv to one thread
+  cv2.setNumThreads(1)
+
+
+def _scan(job):
+  (path, options) = job
+  try:
+    return (path, scan(path, options))
+  except Exception as e:
+    logger.error("%s: %s" % (path, e))
+    return (path, { 'file': { 'frames': 0, 'detected': 0, 'fps': None,
+      'duration': None, 'seconds': None, 'error': str(e) },
+      'intervals': [], 'boxes': [] })
+
+
+FILE_COLUMNS = ('file', 'frames', 'detected', 'fps', 'duration', 'seconds',
+                'error')
+INTERVAL_COLUMNS = ('file', 'start', 'end', 'frames', 'x0', 'y0', 'x1', 'y1')
+BOX_COLUMNS = ('file', 'time', 'x', 'y', 'w', 'h', 'area')
+
+
+def run(paths, options, workers=None):
+  """ scan paths on a pool of workers, return the columnar
+      tables, with rows in the order paths were given """
+  tables = { 'files': { c: [] for c in FILE_COLUMNS },
+             'intervals': { c: [] for c in INTERVAL_COLUMNS } }
+  if options['boxes']:
+    tables['boxes'] = { c: [] for c in BOX_COLUMNS }
+  jobs = [ (p, options) for p in paths ]
+  workers = min(workers or os.cpu_count() or 1, len(jobs))
+  with multiprocessing.Pool(workers, _init_worker) as pool:
+    for (path, result) in pool.imap(_scan, jobs):
+      result['file']['file'] = path
+      for c in FILE_COLUMNS:
+        tables['files'][c].append(result['file'][c])
+      for (table, rows) in (('intervals', result['intervals']),
+                            ('boxes', result['boxes'])):
+        if table not in tables:
+          continue
+        columns = tables[table]
+        for row in rows:
+          columns['file'].append(path)
+          for (c, v) in zip(list(columns)[1:], row):
+            columns[c].append(v)
+      logger.info("%s: %s intervals in %s frames" % (path,
+        len(result['intervals']), result['file']['frames']))
+  return tables
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m smartcam.batch',
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('files', nargs='+', metavar='FILE')
+  parser.add_argument('-o', '--output', default='-',
+    help="file to write json to, default stdout")
+  parser.add_argument('-j', '--workers', type=int, default=None,
+    help="worker processes, default one per cpu")
+  parser.add_argument('--detector', choices=sorted(DETECTORS),
+    default='framediff')
+  parser.add_argument('--area-threshold', type=int, default=100)
+  parser.add_argument('--width', type=int, default=400,
+    help="width frames are scaled to for detection")
+  parser.add_argument('--blur-kernel', type=int, default=21)
+  parser.add_argument('--region-mode', choices=['components', 'contours'],
+    default='components')
+  parser.add_argument('--roi', default='',
+    help="motion_roi polygons, as in config")
+  parser.add_argument('--exclude', default='',
+    help="motion_exclude polygons, as in config")
+  parser.add_argument('--motion-timeout', type=float, default=5.0,
+    help="seconds without motion that end an interval")
+  parser.add_argument('--stride', type=int, default=1,
+    help="run detection on every nth frame")
+  parser.add_argument('--boxes', action='store_true',
+    help="also write every region found, in a 'boxes' table")
+  parser.add_argument('-d', '--debug', action='store_const',
+    dest='loglevel', const=logging.DEBUG, default=logging.INFO)
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=args.loglevel,
+    format='%(asctime)s %(levelname)s %(message)s')
+  if args.stride < 1:
+    parser.error("stride must be at least 1")
+
+  options = { 'detector': args.detector,
+    'area_threshold': args.area_threshold, 'width': args.width,
+    'blur_kernel': args.blur_kernel, 'region_mode': args.region_mode,
+    'roi': args.roi, 'exclude': args.exclude,
+    'motion_timeout': args.motion_timeout, 'stride': args.stride,
+    'boxes': args.boxes }
+  try:
+    load_detector(options)
+  except Exception as e:
+    logger.critical("Failed to load motion detector: %s" % e)
+    return 1
+  tables = run(args.files, options, args.workers)
+  if args.output == '-':
+    json.dump(tables, sys.stdout)
+    sys.stdout.write('\n')
+  else:
+    with open(args.output, 'w') as f:
+      json.dump(tables, f)
+  return 1 if any(tables['files']['error']) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,10 +1,15 @@
 from smartcam.abstract import CloudWriter
 import boto3
-import s3transfer
+from boto3.s3.transfer import S3Transfer, TransferConfig
+import collections
+import concurrent.futures
 import logging
 import os
 import string
 import random
+import threading
+import time
+from smartcam import metrics
 from smartcam.video import RemoteVideo, convert_time
 from smartcam.api_manager import APIConnectionError
 
@@ -12,32 +17,118 @@ logger = logging.getLogger(__name__)
 
 
 class S3Writer(CloudWriter):
-  ''' implements CloudWriter interface '''
+  ''' implements CloudWriter interface -- keeps one transfer
+      manager with the given multipart threshold, part size and
+      concurrency for its lifetime.  The client is created per
+      process, as writers are handed to child processes.
 
-  def __init__(self, region, bucket, api, base_path=None):
+      endpoint_url can point the client at a local stand-in. '''
+
+  MIN_PART_SIZE = 5 * 1024 * 1024
+
+  def __init__(self, region, bucket, api, base_path=None,
+               multipart_threshold=8 * 1024 * 1024,
+               multipart_chunksize=8 * 1024 * 1024,
+               max_concurrency=4, endpoint_url=None):
     self.region = region
     self.bucket = bucket
     self.api = api
-    self.client = boto3.client('s3', self.region)
     self.base_path = base_path
+    self.endpoint_url = endpoint_url
+    self.multipart_chunksize = max(self.MIN_PART_SIZE, multipart_chunksize)
+    self.max_concurrency = max_concurrency
+    self.transfer_config = TransferConfig(
+      multipart_threshold=multipart_threshold,
+      multipart_chunksize=self.multipart_chunksize,
+      max_concurrency=max_concurrency)
+    self._client = None
+    self._transfer = None
+    self._pid = None
+
+  @property
+  def client(self):
+    if self._client is None or self._pid != os.getpid():
+      self._client = boto3.client('s3', self.region,
+        endpoint_url=self.endpoint_url)
+      self._transfer = S3Transfer(self._client, self.transfer_config)
+      self._pid = os.getpid()
+    return self._client
+
+  @property
+  def transfer(self):
+    self.client
+    return self._transfer
+
+  def _remote_path(self, remote_path):
+    if self.base_path:
+      return os.path.join(self.base_path, remote_path)
+    return remote_path
 
   def write_file(self, path, remote_path):
     logger.debug("write_file: writing to s3")
-    transfer = s3transfer.S3Transfer(self.client)
-    if self.base_path:
-      remote_path = os.path.join(self.base_path, remote_path)
-    transfer.upload_file(path, self.bucket, remote_path)
+    self.transfer.upload_file(path, self.bucket, self._remote_path(remote_path))
 
   def write_fileobj(self, fileobj, remote_path):
     logger.debug("write_fileobj: writing to s3")
-    if self.base_path:
-      remote_path = os.path.join(self.base_path, remote_path)
-    self.client.upload_fileobj(fileobj, self.bucket, remote_path)
+    self.client.upload_fileobj(fileobj, self.bucket,
+      self._remote_path(remote_path), Config=self.transfer_config)
+
+  def write_str(self, src, remote_path):
+    logger.debug("write_str: writing to s3")
+    self.client.put_object(Bucket=self.bucket,
+      Key=self._remote_path(remote_path), Body=src)
+
+  def write_stream(self, chunks, remote_path):
+    ''' multipart upload of an iterable of byte chunks while it
+        is still being produced -- a part is sent as soon as
+        multipart_chunksize bytes have accumulated, with at most
+        max_concurrency parts in flight; return the key '''
+    key = self._remote_path(remote_path)
+    upload_id = self.client.create_multipart_upload(Bucket=self.bucket,
+      Key=key)['UploadId']
+    try:
+      with concurrent.futures.ThreadPoolExecutor(self.max_concurrency) as pool:
+        futures = []
+        buf = bytearray()
+        for chunk in chunks:
+          buf += chunk
+          while len(buf) >= self.multipart_chunksize:
+            futures.append(pool.submit(self._upload_part, key, upload_id,
+              len(futures) + 1, bytes(buf[:self.multipart_chunksize])))
+            del buf[:self.multipart_chunksize]
+            # hold no more than max_concurrency parts in memory:
+            in_flight = [ f for f in futures if not f.done() ]
+            if len(in_flight) >= self.max_concurrency:
+              concurrent.futures.wait(in_flight,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        if buf or not futures:
+          futures.append(pool.submit(self._upload_part, key, upload_id,
+            len(futures) + 1, bytes(buf)))
+        parts = [ f.result() for f in futures ]
+      self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+        UploadId=upload_id, MultipartUpload={ 'Parts': parts })
+    except Exception:
+      try:
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+          UploadId=upload_id)
+      except Exception as e:
+        logger.error("Failed to abort multipart upload %s: %s" % (key, e))
+      raise
+    logger.debug("write_stream: uploaded %s in %s parts" % (key, len(parts)))
+    return key
+
+  def _upload_part(self, key, upload_id, n, data):
+    resp = self.client.upload_part(Bucket=self.bucket, Key=key,
+      UploadId=upload_id, PartNumber=n, Body=data)
+    return { 'PartNumber': n, 'ETag': resp['ETag'] }
+
+  def get_video_path(self, camera_id, start_time, ext='mkv'):
+    return '%s-%s.%s' % (self._get_key(start_time), camera_id, ext)
 
   def _get_key(self, start_time):
     ''' given start time, convert it to reverse unix timestamp in
         ms for more efficient uploading '''
-    t = str(convert_time(start_time))
+    t = str(int(convert_time(start_time)))
     return t[::-1]
 
 
@@ -70,3 +161,196 @@ class KinesisWriter(CloudWriter):
         PartitionKey=self.get_partition_key()
     )
 
+
+class BufferedKinesisWriter(KinesisWriter):
+  ''' KinesisWriter that collects records and sends them in
+      PutRecords batches from a background thread -- a batch
+      goes out once it reaches the 500 record / 5 MB request
+      limits or its oldest record has waited linger seconds.
+      Entries that fail are retried on their own with jittered
+      exponential backoff; records are dropped, oldest first,
+      if more than max_buffer are waiting.
+
+      Records that still fail after max_retries are put on
+      spool, if given, except those sent by replay, which are
+      on the spool already.  endpoint_url can point the client
+      at a local stand-in. '''
+
+  MAX_BATCH_RECORDS = 500
+  MAX_BATCH_BYTES = 5 * 1024 * 1024
+  MAX_RECORD_BYTES = 1024 * 1024
+
+  def __init__(self, region, stream, linger=0.5, max_retries=5,
+               backoff=0.1, max_buffer=5000, endpoint_url=None,
+               spool=None):
+    self.region = region
+    self.stream = stream
+    self.linger = linger
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_buffer = max_buffer
+    self.spool = spool
+    self.client = boto3.client('kinesis', self.region,
+      endpoint_url=endpoint_url)
+    self.dropped = 0
+    self._records = collections.deque()
+    self._bytes = 0
+    self._cond = threading.Condition()
+    self._sending = False
+    self._closed = False
+    self._thread = None
+    self._sent = metrics.counter('smartcam_upload_records_total',
+      dest='kinesis')
+    self._sent_bytes = metrics.counter('smartcam_upload_bytes_total',
+      dest='kinesis')
+    self._send_time = metrics.histogram('smartcam_upload_seconds',
+      kind='kinesis')
+    self._failed = metrics.counter('smartcam_upload_failures_total',
+      kind='kinesis')
+
+  def write_fileobj(self, fileobj, dest):
+    """ dest is not used """
+    self.put(fileobj.read())
+
+  def write_str(self, src_str, dest):
+    """ dest is not used """
+    self.put(src_str)
+
+  def replay(self, data):
+    """ queue a record replayed from the spool, returning a
+        Future that completes once it has been sent, or fails
+        if it is given up on and so should stay spooled """
+    delivered = concurrent.futures.Future()
+    self.put(data, delivered)
+    return delivered
+
+  def put(self, data, delivered=None):
+    """ queue record for the next batch, never blocks on the network """
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    key = self.get_partition_key()
+    size = len(data) + len(key)
+    if size > self.MAX_RECORD_BYTES:
+      logger.error("BufferedKinesisWriter: dropping %s byte record" % size)
+      self.dropped += 1
+      self._settle(delivered, False)
+      return
+    with self._cond:
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run,
+          name='kinesis_writer', daemon=True)
+        self._thread.start()
+      if len(self._records) >= self.max_buffer:
+        oldest = self._records.popleft()
+        self._bytes -= oldest[3]
+        self.dropped += 1
+        self._settle(oldest[4], False)
+      self._records.append((time.monotonic(), data, key, size, delivered))
+      self._bytes += size
+      self._cond.notify()
+
+  @staticmethod
+  def _settle(delivered, sent):
+    if delivered is None:
+      return
+    if sent:
+      delivered.set_result(None)
+    else:
+      delivered.set_exception(IOError("kinesis record not sent"))
+
+  def flush(self):
+    """ block until every queued record has been sent or given up on """
+    with self._cond:
+      self._cond.notify()
+      while self._records or self._sending:
+        self._cond.wait(0.1)
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _batch_ready(self):
+    if not self._records:
+      return False
+    if self._closed or len(self._records) >= self.MAX_BATCH_RECORDS:
+      return True
+    if self._bytes >= self.MAX_BATCH_BYTES:
+      return True
+    return time.monotonic() - self._records[0][0] >= self.linger
+
+  def _take_batch(self):
+    batch = []
+    size = 0
+    while self._records and len(batch) < self.MAX_BATCH_RECORDS:
+      if size + self._records[0][3] > self.MAX_BATCH_BYTES:
+        break
+      (_, data, key, rec_size, delivered) = self._records.popleft()
+      batch.append(({ 'Data': data, 'PartitionKey': key }, delivered))
+      size += rec_size
+    self._bytes -= size
+    return batch
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._batch_ready():
+          if self._closed and not self._records:
+            return
+          timeout = None
+          if self._records:
+            timeout = max(0, self._records[0][0] + self.linger -
+              time.monotonic())
+          self._cond.wait(timeout)
+        batch = self._take_batch()
+        self._sending = True
+      try:
+        with self._send_time.time():
+          self._send(batch)
+      finally:
+        with self._cond:
+          self._sending = False
+          self._cond.notify_all()
+
+  def _send(self, batch):
+    """ put_records, retrying only the entries that failed --
+        batch is a list of (entry, delivered future or None) """
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+      try:
+        response = self.client.put_records(StreamName=self.stream,
+          Records=[ e for (e, _) in batch ])
+      except Exception as e:
+        logger.warning("BufferedKinesisWriter put_records failed: %s" % e)
+        continue
+      sent = [ (e, d) for ((e, d), r) in zip(batch, response['Records'])
+               if 'ErrorCode' not in r ]
+      self._sent.inc(len(sent))
+      self._sent_bytes.inc(sum(len(e['Data']) for (e, _) in sent))
+      for (_, delivered) in sent:
+        self._settle(delivered, True)
+      if not response.get('FailedRecordCount'):
+        return
+      batch = [ b for (b, r) in zip(batch, response['Records'])
+                if 'ErrorCode' in r ]
+    logger.error("BufferedKinesisWriter: giving up on %s records" %
+      len(batch))
+    self._failed.inc(len(batch))
+    entries = []
+    for (e, delivered) in batch:
+      if delivered is None:
+        entries.append(e)
+      else:
+        self._settle(delivered, False)
+    if self.spool is None:
+      self.dropped += len(entries)
+      return
+    for e in entries:
+      try:
+        self.spool.put('frame', { 'dest': None }, e['Data'])
+      except Exception as ex:
+        logger.error("BufferedKinesisWriter failed to spool record: %s" % ex)
+        self.dropped += 1
@@ -0,0 +1,89 @@
+import io
+import cv2
+from PIL import Image
+from smartcam.abstract import FrameEncoder
+
+
+def scaled_size(image, width):
+  ''' (width, height) downscale shrinks image to '''
+  (h, w) = image.shape[:2]
+  if not width or w <= width:
+    return (w, h)
+  return (width, int(h * width / float(w)))
+
+
+def downscale(image, width):
+  ''' shrink image to width, keeping aspect ratio; images
+      already no wider than width are returned as-is '''
+  dim = scaled_size(image, width)
+  if dim == image.shape[1::-1]:
+    return image
+  return cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
+
+
+class CV2JPEGEncoder(FrameEncoder):
+  ''' encode straight from the BGR buffer with cv2.imencode '''
+
+  image_type = 'JPEG'
+
+  def __init__(self, quality=90, width=None):
+    self.quality = quality
+    self.width = width
+
+  @property
+  def key(self):
+    return ('JPEG', self.quality, self.width)
+
+  def size(self, image):
+    return scaled_size(image, self.width)
+
+  def encode(self, image):
+    result, buf = cv2.imencode('.jpg', downscale(image, self.width),
+      [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+    if not result:
+      raise ValueError("cv2.imencode failed")
+    return buf.tobytes()
+
+
+class PILJPEGEncoder(FrameEncoder):
+  ''' encode with PIL, converting BGR to RGB first '''
+
+  image_type = 'JPEG'
+
+  def __init__(self, quality=90, width=None):
+    self.quality = quality
+    self.width = width
+
+  @property
+  def key(self):
+    return ('JPEG', self.quality, self.width)
+
+  def size(self, image):
+    return scaled_size(image, self.width)
+
+  def encode(self, image):
+    image = downscale(image, self.width)
+    if image.ndim == 3:
+      image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, self.image_type, quality=self.quality)
+    return buf.getvalue()
+
+
+ENCODERS = {
+  'cv2': CV2JPEGEncoder,
+  'pil': PILJPEGEncoder
+}
+
+_default_encoder = CV2JPEGEncoder()
+
+
+def get_default_encoder():
+  return _default_encoder
+
+
+def set_default_encoder(encoder):
+  ''' set encoder used by Frame.encode when none is given --
+      call before starting processes so they inherit it '''
+  global _default_encoder
+  _default_encoder = encoder
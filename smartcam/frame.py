@@ -1,9 +1,53 @@
 import datetime
 import cv2
-from PIL import Image
+import numpy as np
 import io
 import json
 import base64
+import struct
+import time
+from smartcam import metrics, trace
+from smartcam.video import convert_time
+from smartcam.encoder import get_default_encoder
+
+# binary envelope: magic, version, codec, camera id (utf-8, NUL
+# padded), epoch ms, width, height, payload length -- followed
+# by the encoded image bytes
+ENVELOPE_MAGIC = b'SCFR'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('!4sBB32sQHHI')
+CODECS = { 'JPEG': 1, 'PNG': 2 }
+
+_encode_timers = {}
+
+
+def _encode_timer(encoder):
+  name = type(encoder).__name__
+  timer = _encode_timers.get(name)
+  if timer is None:
+    timer = _encode_timers[name] = metrics.histogram(
+      'smartcam_encode_seconds', encoder=name)
+  return timer
+
+
+def decode_envelope(data):
+  ''' parse binary envelope, return (header dict, encoded image bytes) '''
+  (magic, version, codec, camera_id, ms, width, height, length) = \
+    ENVELOPE_HEADER.unpack_from(data)
+  if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION:
+    raise ValueError("not a version %s frame envelope" % ENVELOPE_VERSION)
+  start = ENVELOPE_HEADER.size
+  payload = bytes(data[start:start + length])
+  if len(payload) != length:
+    raise ValueError("truncated frame envelope")
+  codecs = { v: k for (k, v) in CODECS.items() }
+  return ({
+    'id': camera_id.rstrip(b'\0').decode('utf-8'),
+    'time': datetime.datetime.utcfromtimestamp(ms / 1000.0),
+    'width': width,
+    'height': height,
+    'image_type': codecs[codec]
+  }, payload)
 
 
 class Frame:
@@ -14,6 +58,12 @@ class Frame:
     self.width = width
     self.height = height
     self.image_type = 'JPEG'
+    # full resolution frame this one was downsampled from
+    # at capture, for recording, if any:
+    self.full = None
+    # per stage monotonic times, if the frame is traced --
+    # see smartcam.trace:
+    self.stamps = None
 
   @property
   def image(self):
@@ -22,6 +72,14 @@ class Frame:
   @image.setter
   def image(self, image):
     self._image = image
+    self._encoded = {}
+
+  @property
+  def encoded(self):
+    ''' encoded bytes cached by encoder key -- cleared when
+        image is replaced, so draw on the image before the
+        first encode '''
+    return self._encoded
 
   @property
   def time(self):
@@ -31,26 +89,67 @@ class Frame:
   def time(self, time):
     self._time = time
 
-  def frame_converter(self, x):
-    return cv2.cvtColor(x, cv2.COLOR_RGB2BGR)
+  def stamp(self, stage):
+    if self.stamps is not None:
+      self.stamps[stage] = time.monotonic()
 
-  def encode(self):
-    buf = io.BytesIO()
-    if self.frame_converter:
-      Image.fromarray(self.frame_converter(self.image)).save(buf, self.image_type)
-    else:
-      Image.fromarray(self.image).save(buf, self.image_type)
-    return buf
+  def encode(self, encoder=None):
+    return io.BytesIO(self.encode_str(encoder))
 
-  def encode_str(self):
-    ''' convert encoded buffer to byte string '''
-    return self.encode().getvalue()
+  def encode_str(self, encoder=None):
+    ''' return image encoded as byte string, encoding it
+        only once per encoder setting '''
+    if encoder is None:
+      encoder = get_default_encoder()
+    data = self._encoded.get(encoder.key)
+    if data is None:
+      with _encode_timer(encoder).time():
+        data = encoder.encode(self.image)
+      self._encoded[encoder.key] = data
+      self.stamp(trace.ENCODE)
+    return data
 
-  def serialize(self):
+  def serialize(self, fmt='binary', encoder=None):
+    ''' 'binary' packs the encoded image behind a fixed-size
+        header, see decode_envelope; 'json' is the older
+        base64-in-json format, kept for compatibility '''
+    if fmt == 'binary':
+      return self.serialize_binary(encoder)
+    if fmt != 'json':
+      raise ValueError("unknown frame format: %s" % fmt)
+    if encoder is None:
+      encoder = get_default_encoder()
+    (width, height) = encoder.size(self.image)
     return json.dumps({
       'id': self.id,
       'time': self.time.__str__(),
-      'width': self.width,
-      'height': self.height,
-      'image': base64.b64encode(self.encode_str()).decode('utf-8')
+      'width': width,
+      'height': height,
+      'image': base64.b64encode(self.encode_str(encoder)).decode('utf-8')
     })
+
+  def serialize_binary(self, encoder=None):
+    if encoder is None:
+      encoder = get_default_encoder()
+    camera_id = str(self.id).encode('utf-8')
+    if len(camera_id) > 32:
+      raise ValueError("camera id too long for frame envelope: %s" % self.id)
+    payload = self.encode_str(encoder)
+    # the size of the encoded image, which the encoder may
+    # have scaled down from the frame's
+    (width, height) = encoder.size(self.image)
+    header = ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION,
+      CODECS[encoder.image_type], camera_id, int(convert_time(self.time)),
+      width, height, len(payload))
+    return header + payload
+
+  @classmethod
+  def deserialize(cls, data):
+    ''' rebuild frame from a binary envelope '''
+    (header, payload) = decode_envelope(data)
+    image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8),
+      cv2.IMREAD_UNCHANGED)
+    frame = cls(header['id'], image, header['width'], header['height'])
+    frame.time = header['time']
+    frame.image_type = header['image_type']
+    return frame
@@ -1,8 +1,13 @@
 import cv2
+import datetime
 import logging
-import queue
+import numpy as np
+import os
 import multiprocessing
+import subprocess
+import threading
 import time
+from smartcam import metrics, trace
 from smartcam.frame import Frame
 from smartcam.abstract import FrameReader
 
@@ -10,30 +15,297 @@ logger = logging.getLogger(__name__)
 
 
 class CV2FrameReader(FrameReader):
+  ''' reads frames from cv2.VideoCapture -- given fps, a
+      grabber thread grabs continuously, so the capture buffer
+      never fills with stale frames, and only retrieves (decodes)
+      a frame when one is due on a monotonic schedule at fps.
+      Frames grabbed in between, or retrieved but never picked
+      up by get_frame, are counted as dropped, and the actual
+      rate is logged against the target every STATS_INTERVAL
+      seconds.  Without fps, get_frame reads straight from the
+      capture. '''
 
-  def __init__(self, camera_id, video_source):
+  STATS_INTERVAL = 60.0
+  TIMEOUT = 5.0
+
+  def __init__(self, camera_id, video_source, fps=None):
     self.id = camera_id
     try:
       self._cam = cv2.VideoCapture(video_source)
     except Exception as e:
       logger.critical('Failed to instantiate video capture device: %s' % e)
       raise e
+    self.fps = fps
+    self.grabbed = 0
+    self.retrieved = 0
+    self.dropped = 0
+    self.actual_fps = None
+    self._latest = None
+    self._cond = threading.Condition()
+    self._dropped = metrics.counter('smartcam_capture_dropped_total',
+      camera=camera_id)
+    self._fps = metrics.gauge('smartcam_capture_fps', camera=camera_id)
+    if fps:
+      threading.Thread(target=self._grab_loop, name='frame_grabber',
+        daemon=True).start()
+
+  def _read_error(self):
+    logger.error('CV2FrameReader read frame error')
+    # don't spin on a capture that has gone away
+    time.sleep(0.1)
+
+  def _grab_loop(self):
+    interval = 1.0 / self.fps
+    due = time.monotonic()
+    window_start = due
+    window_retrieved = 0
+    while True:
+      if not self._cam.grab():
+        self._read_error()
+        continue
+      grabbed_at = datetime.datetime.utcnow()
+      now = time.monotonic()
+      self.grabbed += 1
+      if now < due:
+        self.dropped += 1
+        self._dropped.inc()
+        continue
+      # step the schedule rather than restarting it from now,
+      # so the rate doesn't drift, but don't try to catch up
+      # on frames missed during a stall
+      due += interval
+      if due < now:
+        due = now + interval
+      result, img = self._cam.retrieve()
+      if not result:
+        self._read_error()
+        continue
+      with self._cond:
+        if self._latest is not None:
+          self.dropped += 1
+          self._dropped.inc()
+        self._latest = (img, grabbed_at)
+        self.retrieved += 1
+        self._cond.notify()
+      window_retrieved += 1
+      if now - window_start >= self.STATS_INTERVAL:
+        self.actual_fps = window_retrieved / (now - window_start)
+        self._fps.set(self.actual_fps)
+        logger.info("camera %s: %.1f fps (target %s), %s dropped" %
+          (self.id, self.actual_fps, self.fps, self.dropped))
+        window_start = now
+        window_retrieved = 0
+
+  def stats(self):
+    return {
+      'target_fps': self.fps,
+      'actual_fps': self.actual_fps,
+      'grabbed': self.grabbed,
+      'retrieved': self.retrieved,
+      'dropped': self.dropped
+    }
 
   def get_frame(self):
-    result, img = self._cam.read()
-    if result is True:
-      (h, w) = img.shape[:2]
-      return Frame(self.id, img, w, h)
+    if not self.fps:
+      result, img = self._cam.read()
+      if result is True:
+        (h, w) = img.shape[:2]
+        return Frame(self.id, img, w, h)
+      logger.error('CV2FrameReader read frame error')
+      return None
+    with self._cond:
+      if not self._cond.wait_for(lambda: self._latest is not None,
+                                 self.TIMEOUT):
+        logger.error('CV2FrameReader timed out waiting for frame')
+        return None
+      (img, grabbed_at) = self._latest
+      self._latest = None
+    (h, w) = img.shape[:2]
+    frame = Frame(self.id, img, w, h)
+    frame.time = grabbed_at
+    return frame
 
-    logger.error('CV2FrameReader read frame error')
-    return None
 
+def probe_size(video_source):
+  """ return (width, height) of the first video stream """
+  out = subprocess.check_output(['ffprobe', '-v', 'error',
+    '-select_streams', 'v:0', '-show_entries', 'stream=width,height',
+    '-of', 'csv=p=0:s=x'] + ffmpeg_input_args(video_source), timeout=30)
+  (w, h) = out.decode('utf-8').strip().splitlines()[0].split('x')
+  return (int(w), int(h))
+
+
+def ffmpeg_input_args(video_source):
+  """ ffmpeg/ffprobe arguments to open video_source """
+  if isinstance(video_source, int):
+    return ['-f', 'v4l2', '-i', '/dev/video%s' % video_source]
+  args = []
+  if video_source.startswith('rtsp://'):
+    args += ['-rtsp_transport', 'tcp']
+  return args + ['-i', video_source]
+
+
+class FFmpegFrameReader(FrameReader):
+  ''' reads frames decoded by an ffmpeg subprocess to raw
+      video on a pipe -- ffmpeg scales to width x height (the
+      source size, probed with ffprobe, if neither is given;
+      the source aspect ratio if only one is) and paces output
+      to fps.  Frames are always decoded in colour, as they are
+      recorded; the motion detector's small grayscale frames
+      are made from them with detection_frame (detect_width).
+
+      With reuse_buffer, frames are read with readinto into
+      one preallocated buffer, so each frame's image is only
+      valid until the next call to get_frame; that suits the
+      shared memory transport, whose put copies at once.
+
+      If the stream ends or ffmpeg dies, it is restarted after
+      an exponential backoff; so is the first start, if the
+      source can't be probed, as cameras may not be up yet.
+      Local files are read at their native rate, as if live. '''
+
+  MAX_BACKOFF = 30.0
+
+  def __init__(self, camera_id, video_source, fps=None, width=None,
+               height=None, reuse_buffer=False):
+    self.id = camera_id
+    self.video_source = video_source
+    self.fps = fps
+    self.reuse_buffer = reuse_buffer
+    self.width = width
+    self.height = height
+    self.shape = None
+    self.p = None
+    self.failures = 0
+    self.reconnects = 0
+    self._reconnects = metrics.counter('smartcam_capture_reconnects_total',
+      camera=camera_id)
+
+  def _command(self):
+    args = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+    if not isinstance(self.video_source, int) and \
+       os.path.exists(self.video_source):
+      args += ['-re']
+    args += ffmpeg_input_args(self.video_source)
+    filters = []
+    if self.fps:
+      filters.append('fps=%s' % self.fps)
+    filters.append('scale=%s:%s' % (self.width, self.height))
+    return args + ['-an', '-vf', ','.join(filters),
+      '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+
+  def _size(self):
+    ''' settle the output size, probing the source for what
+        wasn't given -- once, on the first start '''
+    (width, height) = (self.width, self.height)
+    if not (width and height):
+      (pw, ph) = probe_size(self.video_source)
+      if width:
+        height = int(round(width * ph / float(pw) / 2)) * 2
+      elif height:
+        width = int(round(height * pw / float(ph) / 2)) * 2
+      else:
+        (width, height) = (pw, ph)
+    self.width = width
+    self.height = height
+    self.shape = (height, width, 3)
+    self.frame_bytes = int(np.prod(self.shape))
+    self._buffer = np.empty(self.shape, dtype=np.uint8)
+
+  def _start(self):
+    if self.shape is None:
+      self._size()
+    logger.debug("FFmpegFrameReader: starting ffmpeg for %s" % self.id)
+    self.p = subprocess.Popen(self._command(), stdout=subprocess.PIPE,
+      stdin=subprocess.DEVNULL, bufsize=0)
 
-def run_frame_thread(frame_reader_class, camera_id, video_source, queue, fps):
-  """ initialize frame_reader and start thread """
+  def close(self):
+    if self.p is None:
+      return
+    try:
+      self.p.kill()
+      self.p.wait()
+      self.p.stdout.close()
+    except Exception as e:
+      logger.error("Failed to close ffmpeg: %s" % e)
+    self.p = None
+
+  def _read_into(self, image):
+    """ fill image from the pipe, return false at end of stream """
+    view = memoryview(image.reshape(-1))
+    filled = 0
+    while filled < self.frame_bytes:
+      n = self.p.stdout.readinto(view[filled:])
+      if not n:
+        return False
+      filled += n
+    return True
+
+  def _backoff(self):
+    self.failures += 1
+    delay = min(self.MAX_BACKOFF, 2 ** (self.failures - 1))
+    logger.error("FFmpegFrameReader: stream from camera %s ended, "
+      "reconnecting in %ss" % (self.id, delay))
+    time.sleep(delay)
+
+  def _reconnect(self):
+    self.close()
+    self._backoff()
+    self.reconnects += 1
+    self._reconnects.inc()
+
+  def get_frame(self):
+    """ block until the next frame, or return None if the
+        stream failed and has been restarted """
+    if self.p is None:
+      try:
+        self._start()
+      except Exception as e:
+        logger.error("FFmpegFrameReader failed to start: %s" % e)
+        self._reconnect()
+        return None
+    image = self._buffer if self.reuse_buffer else \
+      np.empty(self.shape, dtype=np.uint8)
+    try:
+      ok = self._read_into(image)
+    except Exception as e:
+      logger.error("FFmpegFrameReader read error: %s" % e)
+      ok = False
+    if not ok:
+      self._reconnect()
+      return None
+    self.failures = 0
+    return Frame(self.id, image, self.width, self.height)
+
+  def __del__(self):
+    self.close()
+
+
+def detection_frame(frame, width):
+  """ return small grayscale copy of frame for the motion
+      detector, holding the original as its full frame """
+  (h, w) = frame.image.shape[:2]
+  dim = (width, max(1, int(h * width / float(w))))
+  image = cv2.resize(frame.image, dim, interpolation=cv2.INTER_AREA)
+  if image.ndim == 3:
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+  small = Frame(frame.id, image, dim[0], dim[1])
+  small.time = frame.time
+  small.full = frame
+  small.stamps = frame.stamps
+  return small
+
+
+def run_frame_thread(frame_reader_class, camera_id, video_source, queue, fps,
+                     reader_options=None, detect_width=None):
+  """ initialize frame_reader and start thread -- the reader
+      paces itself to fps; reader_options are passed on to
+      frame_reader_class.  Given detect_width, what goes on
+      queue is a detection_frame of that width """
   logging.debug("starting frame_reader run loop")
   try:
-    frame_reader = frame_reader_class(camera_id, video_source)
+    frame_reader = frame_reader_class(camera_id, video_source, fps,
+      **(reader_options or {}))
   except Exception as e:
     logger.critical("Failed to load CV2FrameReader: %s" % e)
     raise e
@@ -42,15 +314,22 @@ def run_frame_thread(frame_reader_class, camera_id, video_source, queue, fps):
   # flub the first few for some reason:
   for i in range(5):
     frame_reader.get_frame()
+  captured = metrics.counter('smartcam_frames_captured_total',
+    camera=camera_id)
   while True:
     try:
       frame = frame_reader.get_frame()
-    except queue.Empty:
-      continue
     except Exception as e:
       logger.error("Failed to instantiate Frame: %s" % e)
+      continue
+    # None marks the end of a clip downstream, never pass it on
+    if frame is None:
+      continue
+    captured.inc()
+    trace.start(frame)
+    if detect_width:
+      frame = detection_frame(frame, detect_width)
     try:
       queue.put(frame)
     except Exception as e:
-      print("Failed to put frame onto queue: %s" % e)
-    time.sleep(1.0/fps)
+      logger.error("Failed to put frame onto queue: %s" % e)
@@ -2,23 +2,60 @@ import threading
 import queue
 import logging
 from PIL import Image
+from smartcam import metrics, trace
 
 logger = logging.getLogger(__name__)
 
+def frame_spool_handlers(cloud_writer):
+  """ SpoolUploader handlers for frames spooled by FrameWriter """
+  def replay_frame(spool, record):
+    data = spool.read_bytes(record)
+    replay = getattr(cloud_writer, 'replay', None)
+    if replay is not None:
+      # buffered writers send later, the record is acked once
+      # the future they return says it went out
+      return replay(data)
+    cloud_writer.write_str(data, record['meta']['dest'])
+
+  return { 'frame': replay_frame }
+
+
 class FrameWriter(threading.Thread):
   """ write images using PIL """
 
-  def __init__(self, queue, cloud_writer):
+  def __init__(self, queue, cloud_writer, frame_format='binary', spool=None):
+    """ frames that fail to write are put on spool, if given """
     threading.Thread.__init__(self)
     self.name = FrameWriter.__name__
     self.queue = queue
     self.cloud_writer = cloud_writer
+    self.frame_format = frame_format
+    self.spool = spool
+    self._write_time = metrics.histogram('smartcam_upload_seconds',
+      kind='frame')
+    self._failed = metrics.counter('smartcam_upload_failures_total',
+      kind='frame')
 
   def write_frame(self, frame):
+    dest = "img/%s" % frame.time
+    data = None
     try:
-      self.cloud_writer.write_str(frame.serialize(), "img/%s" % frame.time)
+      data = frame.serialize(self.frame_format)
+      with self._write_time.time():
+        self.cloud_writer.write_str(data, dest)
+      frame.stamp(trace.UPLOAD)
     except Exception as e:
-      logger.error("Failed to write frame to cloud_writer")
+      logger.error("Failed to write frame to cloud_writer: %s" % e)
+      self._failed.inc()
+      if self.spool is not None and data is not None:
+        if isinstance(data, str):
+          data = data.encode('utf-8')
+        try:
+          self.spool.put('frame', { 'dest': dest }, data)
+        except Exception as e:
+          logger.error("Failed to spool frame: %s" % e)
+    finally:
+      trace.emit(frame, 'image')
 
   def run(self):
     logger.debug("starting FrameWriter thread")
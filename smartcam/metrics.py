@@ -0,0 +1,307 @@
+import bisect
+import http.server
+import logging
+import multiprocessing
+import socketserver
+import threading
+import time
+from multiprocessing import sharedctypes
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# seconds, from sub-millisecond frame work up to uploads:
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = None
+
+
+class Registry:
+  ''' fixed-size table of metric values in shared memory --
+      any process forked after the registry is created can
+      register and update metrics, and an exporter in any of
+      them sees them all.  Each value is a slot identified by
+      its key (type, name and labels), which is written to a
+      shared key table the first time it is registered.
+      Updates take one of a few striped locks. '''
+
+  KEY_BYTES = 200
+  STRIPES = 16
+
+  def __init__(self, capacity=1024):
+    self.capacity = capacity
+    self._keys = sharedctypes.RawArray('c', capacity * self.KEY_BYTES)
+    self._values = sharedctypes.RawArray('d', capacity)
+    self._count = sharedctypes.RawValue('i', 0)
+    self._lock = multiprocessing.Lock()
+    self._stripes = [ multiprocessing.Lock() for _ in range(self.STRIPES) ]
+    self._index = {}
+    self._full = False
+
+  def _key(self, i):
+    start = i * self.KEY_BYTES
+    return self._keys[start:start + self.KEY_BYTES].rstrip(b'\0') \
+      .decode('utf-8')
+
+  def _refresh(self):
+    ''' pick up keys registered by other processes '''
+    for i in range(len(self._index), self._count.value):
+      self._index[self._key(i)] = i
+
+  def slot(self, key):
+    ''' return slot for key, registering it if need be, or
+        None once the table is full '''
+    i = self._index.get(key)
+    if i is not None:
+      return i
+    data = key.encode('utf-8')
+    if len(data) > self.KEY_BYTES:
+      raise ValueError("metric key too long: %s" % key)
+    with self._lock:
+      self._refresh()
+      i = self._index.get(key)
+      if i is not None:
+        return i
+      i = self._count.value
+      if i >= self.capacity:
+        if not self._full:
+          logger.warning("metrics registry full, ignoring %s" % key)
+          self._full = True
+        return None
+      start = i * self.KEY_BYTES
+      self._keys[start:start + len(data)] = data
+      self._count.value = i + 1
+      self._index[key] = i
+      return i
+
+  def add(self, i, n):
+    with self._stripes[i % self.STRIPES]:
+      self._values[i] += n
+
+  def set(self, i, value):
+    self._values[i] = value
+
+  def samples(self):
+    ''' return list of (key, value) for every registered slot '''
+    with self._lock:
+      self._refresh()
+      count = self._count.value
+    return [ (self._key(i), self._values[i]) for i in range(count) ]
+
+
+def enable(capacity=1024):
+  ''' create the default registry -- call before starting the
+      processes that should share it.  Until then metrics are
+      no-ops. '''
+  global _registry
+  _registry = Registry(capacity)
+  return _registry
+
+
+def get_registry():
+  return _registry
+
+
+def _labels(labels):
+  return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+    .replace('"', '\\"')) for (k, v) in sorted(labels.items()))
+
+
+def _key(kind, name, labels, suffix=''):
+  return '%s\t%s\t%s%s' % (kind, name, suffix, labels)
+
+
+class NullMetric:
+  ''' stands in for metrics while they are disabled '''
+
+  def inc(self, n=1):
+    pass
+
+  def dec(self, n=1):
+    pass
+
+  def set(self, value):
+    pass
+
+  def observe(self, value):
+    pass
+
+  def time(self):
+    return _Timer(self)
+
+
+NULL_METRIC = NullMetric()
+
+
+class Counter(NullMetric):
+
+  def __init__(self, registry, slot):
+    self.registry = registry
+    self.slot = slot
+
+  def inc(self, n=1):
+    self.registry.add(self.slot, n)
+
+
+class Gauge(Counter):
+
+  def dec(self, n=1):
+    self.registry.add(self.slot, -n)
+
+  def set(self, value):
+    self.registry.set(self.slot, value)
+
+
+class Histogram(NullMetric):
+  ''' bucket counts are kept per bucket, and made cumulative
+      when rendered '''
+
+  def __init__(self, registry, buckets, slots):
+    self.registry = registry
+    self.buckets = buckets
+    (self.bucket_slots, self.sum_slot, self.count_slot) = slots
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.buckets, value)
+    if i < len(self.buckets):
+      self.registry.add(self.bucket_slots[i], 1)
+    self.registry.add(self.sum_slot, value)
+    self.registry.add(self.count_slot, 1)
+
+
+class _Timer:
+
+  def __init__(self, metric):
+    self.metric = metric
+
+  def __enter__(self):
+    self.t0 = time.monotonic()
+    return self
+
+  def __exit__(self, *args):
+    self.metric.observe(time.monotonic() - self.t0)
+
+
+def counter(name, **labels):
+  if _registry is None:
+    return NULL_METRIC
+  slot = _registry.slot(_key(COUNTER, name, _labels(labels)))
+  return NULL_METRIC if slot is None else Counter(_registry, slot)
+
+
+def gauge(name, **labels):
+  if _registry is None:
+    return NULL_METRIC
+  slot = _registry.slot(_key(GAUGE, name, _labels(labels)))
+  return NULL_METRIC if slot is None else Gauge(_registry, slot)
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS, **labels):
+  if _registry is None:
+    return NULL_METRIC
+  labels = _labels(labels)
+  # the +Inf bucket is the count, so is not stored
+  slots = [ _registry.slot(_key(HISTOGRAM, name, labels, 'le=%r%s' %
+              (b, ',' if labels else ''))) for b in buckets ]
+  slots += [ _registry.slot(_key(HISTOGRAM, name, labels, s))
+             for s in ('_sum', '_count') ]
+  if None in slots:
+    return NULL_METRIC
+  return Histogram(_registry, buckets, (slots[:-2], slots[-2], slots[-1]))
+
+
+def render(registry=None):
+  ''' return all metrics in Prometheus text exposition format '''
+  registry = registry or _registry
+  if registry is None:
+    return ''
+  families = {}
+  for (key, value) in registry.samples():
+    (kind, name, labels) = key.split('\t')
+    families.setdefault((name, kind), []).append((labels, value))
+  lines = []
+  for ((name, kind), samples) in sorted(families.items()):
+    lines.append('# TYPE %s %s' % (name, kind))
+    if kind != HISTOGRAM:
+      for (labels, value) in samples:
+        lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '',
+          _format(value)))
+      continue
+    for (labels, series) in _histogram_series(samples):
+      cumulative = 0
+      for (le, value) in series['buckets']:
+        cumulative += value
+        lines.append('%s_bucket{%sle="%s"} %s' % (name,
+          labels + ',' if labels else '', le, _format(cumulative)))
+      lines.append('%s_bucket{%sle="+Inf"} %s' % (name,
+        labels + ',' if labels else '', _format(series['_count'])))
+      for s in ('_sum', '_count'):
+        lines.append('%s%s%s %s' % (name, s,
+          '{%s}' % labels if labels else '', _format(series[s])))
+  return '\n'.join(lines) + '\n'
+
+
+def _histogram_series(samples):
+  ''' regroup histogram slots by their own labels '''
+  series = {}
+  for (key, value) in samples:
+    if key.startswith('le='):
+      (le, _, labels) = key[3:].partition(',')
+      s = series.setdefault(labels, { 'buckets': [], '_sum': 0, '_count': 0 })
+      s['buckets'].append((float(le), value))
+    else:
+      for suffix in ('_sum', '_count'):
+        if key.startswith(suffix):
+          labels = key[len(suffix):]
+          s = series.setdefault(labels,
+            { 'buckets': [], '_sum': 0, '_count': 0 })
+          s[suffix] = value
+  for s in series.values():
+    s['buckets'].sort()
+  return sorted(series.items())
+
+
+def _format(value):
+  if value == int(value):
+    return str(int(value))
+  return repr(value)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path not in ('/metrics', '/'):
+      self.send_error(404)
+      return
+    body = render(self.server.registry).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, fmt, *args):
+    logger.debug(fmt % args)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+  ''' serve the registry over http in Prometheus format '''
+
+  def __init__(self, port, host='127.0.0.1', registry=None):
+    threading.Thread.__init__(self)
+    self.name = MetricsServer.__name__
+    self.daemon = True
+    self.server = _Server((host, port), _Handler)
+    self.server.registry = registry or _registry
+
+  def run(self):
+    logger.debug("serving metrics on %s:%s" % self.server.server_address)
+    self.server.serve_forever()
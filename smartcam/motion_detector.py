@@ -1,11 +1,16 @@
+import collections
+import concurrent.futures
 import cv2
 import copy
 import datetime
 import logging
+import math
 import multiprocessing
 import numpy as np
 import queue
 import threading
+import time
+from smartcam import metrics, trace
 from smartcam.abstract import MotionDetectorProcess, MotionDetector
 
 
@@ -35,11 +40,86 @@ def resize_image(image, width):
   return cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
 
 
-def downsample_image(image):
-  image = resize_image(image, 400)
-  image = blur_image(image)
-  image = grayscale_image(image)
-  # image = cv2.Canny(image, 30, 200)
+class Downsampler:
+  ''' shrink frames for motion detection -- resize to width,
+      convert to grayscale, then blur, writing every stage into
+      preallocated buffers; output alternates between two
+      buffers so the previous result stays valid for frame
+      differencing.
+
+      Given a MotionMask, frames are first cropped to the
+      bounding box of its ROI (width still applies to the
+      full frame), and `mask` holds its polygons rasterised
+      at the working resolution for the detector to apply. '''
+
+  def __init__(self, width=400, blur_kernel=21, mask=None):
+    self.width = width
+    self.blur_kernel = (blur_kernel, blur_kernel)
+    self.motion_mask = mask
+    self.mask = None
+    self._shape = None
+    self._i = 0
+
+  def clone(self):
+    ''' return a Downsampler with the same settings and
+        buffers of its own '''
+    return Downsampler(self.width, self.blur_kernel[0], self.motion_mask)
+
+  def prepare(self, shape):
+    ''' size buffers and mask for frames of shape '''
+    if shape != self._shape:
+      self._allocate(shape)
+
+  def _allocate(self, shape):
+    (h, w) = shape[:2]
+    scale = self.width / float(w)
+    if self.motion_mask:
+      (x0, y0, x1, y1) = self.motion_mask.crop_box(shape)
+      self._dim = (max(1, int(round((x1 - x0) * scale))),
+                   max(1, int(round((y1 - y0) * scale))))
+    else:
+      self._dim = (self.width, int(h * scale))
+    small = (self._dim[1], self._dim[0])
+    self._resized = np.empty(small + shape[2:], dtype=np.uint8)
+    self._gray = np.empty(small, dtype=np.uint8)
+    self._out = [ np.empty(small, dtype=np.uint8) for _ in range(2) ]
+    if self.motion_mask:
+      self.mask = self.motion_mask.rasterize(shape, small)
+    self._shape = shape
+
+  def __call__(self, image):
+    self.prepare(image.shape)
+    if self.motion_mask:
+      image = self.motion_mask.crop(image)
+    cv2.resize(image, self._dim, dst=self._resized,
+      interpolation=cv2.INTER_AREA)
+    gray = self._resized
+    if gray.ndim == 3:
+      gray = cv2.cvtColor(self._resized, cv2.COLOR_BGR2GRAY, dst=self._gray)
+    out = self._out[self._i]
+    self._i ^= 1
+    cv2.GaussianBlur(gray, self.blur_kernel, 0, dst=out)
+    return out
+
+  def to_source(self, regions):
+    ''' map find_regions rows found in downsampled frames back
+        to pixels of the last frame shape prepared for '''
+    (h, w) = self._shape[:2]
+    (x0, y0, x1, y1) = (0, 0, w, h)
+    if self.motion_mask:
+      (x0, y0, x1, y1) = self.motion_mask.crop_box(self._shape)
+    sx = (x1 - x0) / float(self._dim[0])
+    sy = (y1 - y0) / float(self._dim[1])
+    regions = np.asarray(regions, dtype=np.float64)
+    return np.column_stack([ regions[:, 0] * sx + x0, regions[:, 1] * sy + y0,
+      regions[:, 2] * sx, regions[:, 3] * sy,
+      regions[:, 4] * sx * sy ]).round().astype(np.int64)
+
+
+def apply_mask(image, mask):
+  ''' zero image outside mask, in place '''
+  if mask is not None:
+    cv2.bitwise_and(image, mask, dst=image)
   return image
 
 
@@ -69,23 +149,49 @@ def draw_contours(image, contours):
   cv2.drawContours(image, contours, -1, (0, 0, 255), 1)
 
 
-def blur_image(image):
-  return cv2.GaussianBlur(image, (21, 21), 0)
+def blur_image(image, kernel=21):
+  return cv2.GaussianBlur(image, (kernel, kernel), 0)
+
+
+def find_regions(image, threshold=100, mode='components', debug=False,
+                 nonzero=None):
+  ''' return an Nx5 array of (x, y, w, h, area) rows, one per
+      blob in binary image whose area exceeds threshold, or None
+      if there are none -- 'components' labels blobs with
+      connectedComponentsWithStats, 'contours' uses external-only
+      findContours; either way a frame with too few non-zero
+      pixels to hold such a blob returns early; pass nonzero
+      if the caller has already counted them '''
+  t0 = datetime.datetime.now()
+  if nonzero is None:
+    nonzero = cv2.countNonZero(image)
+  if nonzero <= threshold:
+    return None
+  if mode == 'components':
+    (_, _, stats, _) = cv2.connectedComponentsWithStats(image, connectivity=8)
+    # label 0 is the background:
+    stats = stats[1:, :5]
+    regions = stats[stats[:, cv2.CC_STAT_AREA] > threshold]
+  elif mode == 'contours':
+    contours = cv2.findContours(image, cv2.RETR_EXTERNAL,
+      cv2.CHAIN_APPROX_SIMPLE)[-2]
+    areas = [ cv2.contourArea(c) for c in contours ]
+    regions = np.array([ cv2.boundingRect(c) + (a,)
+      for (c, a) in zip(contours, areas) if a > threshold ],
+      dtype=np.int32).reshape(-1, 5)
+  else:
+    raise ValueError("unknown region mode: %s" % mode)
+  if debug:
+    t1 = datetime.datetime.now()
+    logger.debug("find_regions time: %s" % ((t1-t0).total_seconds()))
+  if len(regions) == 0:
+    return None
+  return regions
 
 
-def find_contours(image, threshold=100, debug=False):
-    t0 = datetime.datetime.now()
-    (_, _contours, _) = cv2.findContours(image, cv2.RETR_TREE,
-      cv2.CHAIN_APPROX_SIMPLE)
-    t1 = datetime.datetime.now()
-    if not _contours:
-      return None
-    contours = [ i for i in _contours if cv2.contourArea(i) > threshold ]
-    t2 = datetime.datetime.now()
-    if debug:
-      logger.debug("findContours time: %s" % ((t1-t0).total_seconds()))
-      logger.debug("filter contours time: %s" % ((t2-t1).total_seconds()))
-    return contours
+def draw_regions(image, regions):
+  for (x, y, w, h, _) in regions:
+    cv2.rectangle(image, (x, y), (x + w, y + h), (0, 255, 0), 1)
 
 
 def write_text(frame, text):
@@ -95,6 +201,146 @@ def write_text(frame, text):
     (255,255,255), 2, cv2.LINE_AA)
 
 
+def stamp_time(frame):
+  ''' write frame's time on its image, in place '''
+  write_text(frame, frame.time.isoformat())
+
+
+class AdaptiveScheduler:
+  ''' decide which frames get run through the motion detector --
+      every frame while motion is in progress or the last
+      result came close to the area threshold, otherwise every
+      stride-th frame, where stride is the smallest that keeps
+      the measured detector latency within idle_budget of the
+      frame interval, capped at max_stride '''
+
+  def __init__(self, fps, max_stride=1, idle_budget=0.25, near_ratio=0.5,
+               smoothing=0.1):
+    self.interval = 1.0 / fps
+    self.max_stride = max_stride
+    self.idle_budget = idle_budget
+    self.near_ratio = near_ratio
+    self.smoothing = smoothing
+    self.latency = None
+    self.stride = 1
+    self.near = False
+    self.i = 0
+
+  def should_detect(self, in_motion):
+    self.i += 1
+    if in_motion or self.near or self.i >= self.stride:
+      self.i = 0
+      return True
+    return False
+
+  def every_frame(self, in_motion):
+    ''' is should_detect passing every frame through at the
+        moment -- asked without counting towards the stride '''
+    return in_motion or self.near or self.stride == 1
+
+  def update(self, latency, activity, threshold):
+    ''' record detector latency in seconds, and activity, the
+        number of changed pixels, against its area threshold '''
+    if self.latency is None:
+      self.latency = latency
+    else:
+      self.latency += self.smoothing * (latency - self.latency)
+    self.near = activity >= self.near_ratio * threshold
+    stride = int(math.ceil(self.latency / (self.idle_budget * self.interval)))
+    self.stride = max(1, min(self.max_stride, stride))
+
+
+class PreprocessPool:
+  ''' downsample frames on a pool of threads ahead of the
+      stateful, serial part of motion detection -- cv2 releases
+      the GIL while resizing and blurring, so the threads run on
+      separate cores.  Up to depth frames are in flight, and
+      they come back out in the order they were submitted,
+      however the threads finish. '''
+
+  def __init__(self, workers=2, depth=None):
+    self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+    self.depth = depth or 2 * workers
+    self.pending = collections.deque()
+    self.local = threading.local()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def full(self):
+    return len(self.pending) >= self.depth
+
+  def _downsample(self, downsampler, image):
+    # Downsamplers keep scratch buffers, so each thread uses
+    # its own clones, and output is copied as it is held
+    # until the detector gets to it
+    clones = getattr(self.local, 'clones', None)
+    if clones is None:
+      clones = self.local.clones = {}
+    clone = clones.get(id(downsampler))
+    if clone is None:
+      clone = clones[id(downsampler)] = downsampler.clone()
+    return clone(image).copy()
+
+  def submit(self, frame, token, downsampler=None):
+    ''' queue frame to be downsampled with downsampler,
+        or just passed through in order if that is None '''
+    if downsampler is None:
+      future = concurrent.futures.Future()
+      future.set_result(None)
+    else:
+      future = self.executor.submit(self._downsample, downsampler,
+        frame.image)
+    self.pending.append((frame, token, future))
+
+  def ready(self, wait=False):
+    ''' yield (frame, token, image) for finished frames from
+        the head of the line, waiting for the first if wait '''
+    while self.pending and (wait or self.pending[0][2].done()):
+      (frame, token, future) = self.pending.popleft()
+      wait = False
+      try:
+        image = future.result()
+      except Exception as e:
+        logger.error("PreprocessPool failed to downsample frame: %s" % e)
+        image = None
+      yield (frame, token, image)
+
+
+def run_pipelined(in_queue, pool, route, poll_interval=0.01):
+  ''' motion detection loop with downsampling done ahead on
+      a PreprocessPool -- route(frame) returns the
+      CV2MotionDetectorProcess holding state for the frame's
+      camera, or None to drop the frame.  Each camera's frames
+      are detected in the order they came off in_queue, and
+      their leases given back once they have been handled.
+
+      Whether a frame is detected is only decided once it
+      comes out of the pool, against the motion state left by
+      the frames before it; frames are downsampled ahead while
+      every frame is likely to be, and otherwise as needed. '''
+  while True:
+    try:
+      (frame, lease) = in_queue.take(poll_interval if len(pool) else None)
+    except queue.Empty:
+      frame = None
+    if frame is not None:
+      process = route(frame)
+      if process is None:
+        in_queue.release(lease)
+      else:
+        pool.submit(frame, (process, lease),
+          process.motion_detector.downsample if process.detect_ahead()
+          else None)
+    for (frame, (process, lease), image) in pool.ready(pool.full()):
+      try:
+        process.process_frame(frame, image)
+      except Exception as e:
+        logger.error("Failed to process frame from %s: %s" % (frame.id, e))
+      finally:
+        in_queue.release(lease)
+
+
 class CV2MotionDetectorProcess(MotionDetectorProcess):
 
   def __init__(self,
@@ -103,7 +349,15 @@ class CV2MotionDetectorProcess(MotionDetectorProcess):
                motion_queue,
                motion_timeout,
                debug=False,
-               show_video=False):
+               show_video=False,
+               preroll=None,
+               scheduler=None,
+               preprocess_workers=0):
+    """ preroll is an optional PrerollBuffer of frames to
+        flush ahead of the first motion frame; scheduler is an
+        optional AdaptiveScheduler for skipping frames while idle;
+        with preprocess_workers, frames are downsampled ahead
+        on a PreprocessPool of that many threads """
     multiprocessing.Process.__init__(self)
     self.name = CV2MotionDetectorProcess.__name__
     self.motion_detector = motion_detector
@@ -114,15 +368,44 @@ class CV2MotionDetectorProcess(MotionDetectorProcess):
     self.frame = None
     self.debug = debug
     self.show_video = show_video
+    self.preroll = preroll
+    self.scheduler = scheduler
+    self.preprocess_workers = preprocess_workers
+    self._metrics = None
 
-  def handle_motion(self, contours):
+  @property
+  def record_frame(self):
+    ''' the frame to record -- the full resolution one, if
+        the current frame was downsampled at capture.  Either
+        may be leased from a fan-out, see stamped_frame '''
+    if self.frame.full is not None:
+      return self.frame.full
+    return self.frame
+
+  def stamped_frame(self):
+    ''' a private copy of record_frame with the time written
+        on it -- frames may be views onto shared memory slots
+        that other consumers are reading at the same time, so
+        are never drawn on in place '''
+    frame = copy.copy(self.record_frame)
+    frame.image = frame.image.copy()
+    stamp_time(frame)
+    return frame
+
+  def handle_motion(self, regions):
     logger.debug('motion detected')
+    if self.last_motion_time is None:
+      self.metrics['events'].inc()
+    if self.last_motion_time is None and self.preroll is not None:
+      logger.debug('flushing %s preroll frames' % len(self.preroll))
+      for frame in self.preroll.flush(draw=stamp_time):
+        self.motion_queue.put(frame)
     self.last_motion_time = self.frame.time
-    # draw_rectangles(self.frame.image, contours)
-    # draw_contours(self.frame.image, contours)
-    self.motion_queue.put(self.frame)
+    frame = self.stamped_frame()
+    # draw_regions(frame.image, regions)
+    self.motion_queue.put(frame)
     if self.show_video:
-      cv2.imshow('MOTION_DETECTED', self.frame.image)
+      cv2.imshow('MOTION_DETECTED', frame.image)
       cv2.waitKey(1)
 
   def handle_motion_timeout(self):
@@ -148,37 +431,101 @@ class CV2MotionDetectorProcess(MotionDetectorProcess):
 
   def run(self):
     logger.debug("starting motion_detector thread loop")
-    video_buffer = []
-    in_motion = False
+    if self.preprocess_workers > 0:
+      pool = PreprocessPool(self.preprocess_workers)
+      run_pipelined(self.image_queue, pool, lambda frame: self)
     while True:
       try:
-        self.frame = self.get_frame()
+        frame = self.get_frame()
       except queue.Empty:
         continue
-      if self.frame is None:
+      if frame is None:
         continue
-      self.motion_detector.current = copy.deepcopy(self.frame)
-      write_text(self.frame, self.frame.time.isoformat())
-      contours = self.motion_detector.detect_motion()
-      if contours:
-        self.handle_motion(contours)
-      elif self.motion_is_timed_out():
-        self.handle_motion_timeout()
-      ### not currently in motion but still within timeout period:
-      elif self.last_motion_time != None:
-        self.motion_queue.put(self.frame)
+      self.process_frame(frame)
+
+  @property
+  def metrics(self):
+    ''' created on first use, as the camera id is only known
+        from the frames '''
+    if self._metrics is None:
+      camera = self.frame.id
+      self._metrics = {
+        'detect': metrics.histogram('smartcam_detect_seconds', camera=camera),
+        'skipped': metrics.counter('smartcam_detect_skipped_total',
+          camera=camera),
+        'events': metrics.counter('smartcam_motion_events_total',
+          camera=camera)
+      }
+    return self._metrics
+
+  def should_detect(self):
+    ''' should the next frame go through the detector '''
+    in_motion = self.last_motion_time is not None
+    return self.scheduler is None or self.scheduler.should_detect(in_motion)
+
+  def detect_ahead(self):
+    ''' is it worth downsampling frames before should_detect
+        is asked about them, ie. is every frame being detected '''
+    in_motion = self.last_motion_time is not None
+    return self.scheduler is None or self.scheduler.every_frame(in_motion)
+
+  def process_frame(self, frame, image=None):
+    ''' run detection on frame and pass it on -- split out of
+        run so that several cameras can share one process.
+        image is the frame already downsampled, if it has
+        been; if not, and the frame is detected, it is
+        downsampled here '''
+    self.frame = frame
+    if not self.should_detect():
+      self.metrics['skipped'].inc()
+      if self.preroll is not None:
+        self.preroll.append(self.record_frame)
+      trace.emit(self.frame, 'detect')
+      return
+    t0 = time.monotonic()
+    self.frame.stamp(trace.DETECT_START)
+    if image is None:
+      self.motion_detector.current = self.frame
+    else:
+      self.motion_detector.set_current(self.frame, image)
+    regions = self.motion_detector.detect_motion()
+    self.frame.stamp(trace.DETECT_END)
+    latency = time.monotonic() - t0
+    self.metrics['detect'].observe(latency)
+    if self.scheduler:
+      self.scheduler.update(latency,
+        self.motion_detector.activity, self.motion_detector.area_threshold)
+    if regions is not None:
+      self.handle_motion(regions)
+      return
+    if self.motion_is_timed_out():
+      self.handle_motion_timeout()
+    ### not currently in motion but still within timeout period:
+    elif self.last_motion_time != None:
+      self.motion_queue.put(self.stamped_frame())
+      return
+    elif self.preroll is not None:
+      self.preroll.append(self.record_frame)
+    # frames that go no further are traced here
+    trace.emit(self.frame, 'detect')
 
 
 class CV2BackgroundSubtractorMOG(MotionDetector):
   ''' detect motion using cv2.BackgroundSubtractorMOG
   '''
 
-  def __init__(self, debug=False, show_video=False):
+  def __init__(self, debug=False, show_video=False, width=400,
+               blur_kernel=21, region_mode='components', mask=None,
+               area_threshold=100):
     self.cur_lock = multiprocessing.Lock()
     self._current = None
     self.daemon = True
     self.debug = debug
     self.show_video = show_video
+    self.area_threshold = area_threshold
+    self.activity = 0
+    self.downsample = Downsampler(width, blur_kernel, mask)
+    self.region_mode = region_mode
     self.fgbg = cv2.bgsegm.createBackgroundSubtractorMOG()
 
   @property
@@ -188,30 +535,43 @@ class CV2BackgroundSubtractorMOG(MotionDetector):
 
   @current.setter
   def current(self, frame):
+    self.set_current(frame, self.downsample(frame.image))
+
+  def set_current(self, frame, image):
+    ''' set current frame, already downsampled to image '''
+    self.downsample.prepare(frame.image.shape)
     with self.cur_lock:
-      self._current = frame
-      self._current.image = downsample_image(frame.image)
+      self._current = copy.copy(frame)
+      self._current.image = image
 
   def detect_motion(self):
     fgmask = adaptive_threshold_image(self.current.image)
     fgmask = self.fgbg.apply(fgmask)
+    apply_mask(fgmask, self.downsample.mask)
     if self.show_video:
       cv2.imshow('BackgroundSubtractorMOG', fgmask)
       cv2.waitKey(1)
-    contours = find_contours(fgmask)
-    return contours
+    self.activity = cv2.countNonZero(fgmask)
+    return find_regions(fgmask, self.area_threshold, self.region_mode,
+      nonzero=self.activity)
 
 
 class CV2BackgroundSubtractorGMG(MotionDetector):
   ''' detect motion using cv2.BackgroundSubtractorGMG
   '''
 
-  def __init__(self, debug=False, show_video=False):
+  def __init__(self, debug=False, show_video=False, width=400,
+               blur_kernel=21, region_mode='components', mask=None,
+               area_threshold=100):
     self.cur_lock = multiprocessing.Lock()
     self._current = None
     self.daemon = True
     self.debug = debug
     self.show_video = show_video
+    self.area_threshold = area_threshold
+    self.activity = 0
+    self.downsample = Downsampler(width, blur_kernel, mask)
+    self.region_mode = region_mode
     self.fgbg = cv2.bgsegm.createBackgroundSubtractorGMG()
 
   @property
@@ -221,27 +581,36 @@ class CV2BackgroundSubtractorGMG(MotionDetector):
 
   @current.setter
   def current(self, frame):
+    self.set_current(frame, self.downsample(frame.image))
+
+  def set_current(self, frame, image):
+    ''' set current frame, already downsampled to image '''
+    self.downsample.prepare(frame.image.shape)
     with self.cur_lock:
-      self._current = frame
-      self._current.image = downsample_image(frame.image)
+      self._current = copy.copy(frame)
+      self._current.image = image
 
   def detect_motion(self):
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(5,5))
     fgmask = self.fgbg.apply(self.current.image)
+    apply_mask(fgmask, self.downsample.mask)
     fgmask = cv2.morphologyEx(fgmask, cv2.MORPH_OPEN, kernel)
     thresh = threshold_image(fgmask)
     if self.show_video:
       cv2.imshow('BackgroundSubtractorGMG', thresh)
       cv2.waitKey(1)
-    contours = find_contours(thresh)
-    return contours
+    self.activity = cv2.countNonZero(thresh)
+    return find_regions(thresh, self.area_threshold, self.region_mode,
+      nonzero=self.activity)
 
 
 class CV2FrameDiffMotionDetector(MotionDetector):
   ''' detect motion by differencing current and previous
       frame
   '''
-  def __init__(self, area_threshold=100, debug=False, show_video=False):
+  def __init__(self, area_threshold=100, debug=False, show_video=False,
+               width=400, blur_kernel=21, region_mode='components',
+               mask=None):
     self.bg_lock = multiprocessing.Lock()
     self.cur_lock = multiprocessing.Lock()
     self._current = None
@@ -250,6 +619,9 @@ class CV2FrameDiffMotionDetector(MotionDetector):
     self.debug = debug
     self.show_video = show_video
     self.area_threshold = area_threshold
+    self.activity = 0
+    self.downsample = Downsampler(width, blur_kernel, mask)
+    self.region_mode = region_mode
     self.thresh_times = []
     self.dilate_times = []
     self.contour_times = []
@@ -272,7 +644,9 @@ class CV2FrameDiffMotionDetector(MotionDetector):
     thresh = cv2.dilate(thresh, None, iterations=2)
     t3 = datetime.datetime.now()
 
-    contours = find_contours(thresh, self.area_threshold, debug=self.debug)
+    self.activity = cv2.countNonZero(thresh)
+    regions = find_regions(thresh, self.area_threshold, self.region_mode,
+      debug=self.debug, nonzero=self.activity)
     t4 = datetime.datetime.now()
 
     if self.debug:
@@ -283,16 +657,17 @@ class CV2FrameDiffMotionDetector(MotionDetector):
         self.i = 0
         logger.debug("Thresh avg. time: %s" % (sum(self.thresh_times)/len(self.thresh_times)))
         logger.debug("Dilate avg. time: %s" % (sum(self.dilate_times)/len(self.dilate_times)))
-        logger.debug("Contours avg. time: %s" % (sum(self.contour_times)/len(self.contour_times)))
+        logger.debug("Regions avg. time: %s" % (sum(self.contour_times)/len(self.contour_times)))
         self.thresh_times = []
         self.dilate_times = []
         self.contour_times = []
-    return contours
+    return regions
 
   def get_delta(self):
     if self.background is None or self.current is None:
       return None
-    return cv2.absdiff(self.background.image, self.current.image)
+    delta = cv2.absdiff(self.background.image, self.current.image)
+    return apply_mask(delta, self.downsample.mask)
 
   @property
   def background(self):
@@ -311,11 +686,16 @@ class CV2FrameDiffMotionDetector(MotionDetector):
 
   @current.setter
   def current(self, frame):
+    self.set_current(frame, self.downsample(frame.image))
+
+  def set_current(self, frame, image):
+    ''' set current frame, already downsampled to image '''
+    self.downsample.prepare(frame.image.shape)
     with self.cur_lock:
       if self._current is not None:
         self.background = self._current
-      self._current = frame
-      self._current.image = downsample_image(frame.image)
+      self._current = copy.copy(frame)
+      self._current.image = image
       if self.background is None:
         self.background = self._current
 
@@ -0,0 +1,84 @@
+import math
+import cv2
+import numpy as np
+
+
+def parse_polygons(value):
+  ''' parse polygons from config -- polygons are separated by
+      ';', points by whitespace, and each point is 'x,y' given
+      as fractions of frame width and height, eg.
+      '0,0.5 1,0.5 1,1 0,1; 0.8,0 1,0 1,0.2' '''
+  polygons = []
+  for poly in (value or '').split(';'):
+    points = [ tuple(float(c) for c in p.split(',')) for p in poly.split() ]
+    if not points:
+      continue
+    if len(points) < 3 or any(len(p) != 2 for p in points):
+      raise ValueError("invalid motion mask polygon: %s" % poly.strip())
+    polygons.append(points)
+  return polygons
+
+
+class MotionMask:
+  ''' region of interest and exclusion polygons for the motion
+      detectors, in frame-relative coordinates -- frames are
+      cropped to the bounding box of the ROI before they are
+      downsampled, and the polygons are rasterised once at the
+      detector's working resolution into a mask that is applied
+      before thresholding '''
+
+  def __init__(self, roi=None, exclude=None):
+    self.roi = roi or []
+    self.exclude = exclude or []
+    if self.roi:
+      xs = [ x for poly in self.roi for (x, _) in poly ]
+      ys = [ y for poly in self.roi for (_, y) in poly ]
+      self.bbox = (max(0.0, min(xs)), max(0.0, min(ys)),
+                   min(1.0, max(xs)), min(1.0, max(ys)))
+    else:
+      self.bbox = (0.0, 0.0, 1.0, 1.0)
+
+  def __bool__(self):
+    return bool(self.roi or self.exclude)
+
+  def crop_box(self, shape):
+    ''' return ROI bounding box (x0, y0, x1, y1) in pixels
+        of a frame of the given shape '''
+    (h, w) = shape[:2]
+    (bx0, by0, bx1, by1) = self.bbox
+    x0 = int(math.floor(bx0 * w))
+    y0 = int(math.floor(by0 * h))
+    x1 = max(x0 + 1, int(math.ceil(bx1 * w)))
+    y1 = max(y0 + 1, int(math.ceil(by1 * h)))
+    return (x0, y0, x1, y1)
+
+  def crop(self, image):
+    ''' return view of image cropped to the ROI bounding box '''
+    (x0, y0, x1, y1) = self.crop_box(image.shape)
+    return image[y0:y1, x0:x1]
+
+  def rasterize(self, source_shape, working_shape):
+    ''' return uint8 mask of working_shape, 255 where motion
+        counts, for frames of source_shape that have been
+        cropped and resized to working_shape, or None if
+        there is nothing to mask '''
+    if not self:
+      return None
+    (x0, y0, x1, y1) = self.crop_box(source_shape)
+    (h, w) = source_shape[:2]
+    (wh, ww) = working_shape[:2]
+    sx = ww / float(x1 - x0)
+    sy = wh / float(y1 - y0)
+
+    def to_working(poly):
+      return np.array([ [ (x * w - x0) * sx, (y * h - y0) * sy ]
+        for (x, y) in poly ], dtype=np.int32)
+
+    if self.roi:
+      mask = np.zeros((wh, ww), dtype=np.uint8)
+      cv2.fillPoly(mask, [ to_working(p) for p in self.roi ], 255)
+    else:
+      mask = np.full((wh, ww), 255, dtype=np.uint8)
+    if self.exclude:
+      cv2.fillPoly(mask, [ to_working(p) for p in self.exclude ], 0)
+    return mask
@@ -0,0 +1,61 @@
+import collections
+import logging
+import cv2
+import numpy as np
+from smartcam.frame import Frame
+from smartcam.encoder import CV2JPEGEncoder
+
+logger = logging.getLogger(__name__)
+
+
+class PrerollBuffer:
+  ''' fixed-size ring buffer of the last few seconds of frames,
+      held as JPEG bytes so that several seconds of full
+      resolution video only costs a few MB -- flushed into
+      the motion queue when motion starts so that clips include
+      the lead-up to the event.
+
+      Frames are only read here, so they may be read-only views
+      onto shared memory; anything drawn on them is drawn on
+      the copies decoded by flush. '''
+
+  def __init__(self, seconds, fps, quality=80):
+    self.encoder = CV2JPEGEncoder(quality)
+    self.frames = collections.deque(maxlen=int(seconds * fps))
+
+  def __len__(self):
+    return len(self.frames)
+
+  def append(self, frame):
+    if self.frames.maxlen == 0:
+      return
+    try:
+      data = frame.encode_str(self.encoder)
+    except Exception as e:
+      logger.error("PrerollBuffer failed to encode frame: %s" % e)
+      return
+    self.frames.append((frame.id, frame.time, frame.width, frame.height,
+      data))
+
+  def clear(self):
+    self.frames.clear()
+
+  def flush(self, draw=None):
+    ''' yield buffered frames oldest first, emptying the buffer
+        -- draw, if given, is called on each decoded frame to
+        draw on its image before it is yielded '''
+    while self.frames:
+      (camera_id, time, width, height, data) = self.frames.popleft()
+      image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+        cv2.IMREAD_UNCHANGED)
+      if image is None:
+        logger.error("PrerollBuffer failed to decode frame")
+        continue
+      frame = Frame(camera_id, image, width, height)
+      frame.time = time
+      if draw is None:
+        frame.encoded[self.encoder.key] = data
+      else:
+        # the buffered JPEG no longer matches the image
+        draw(frame)
+      yield frame
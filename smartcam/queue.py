@@ -1,24 +1,148 @@
 from multiprocessing import Queue as _Queue
+import multiprocessing
+import queue
 import logging
+from smartcam import metrics
 
 logger = logging.getLogger(__name__)
 
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+KEEP_EVERY_NTH = 'keep_every_nth'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, KEEP_EVERY_NTH)
+
+
 class Queue():
-  def __init__(self, label, debug=False):
+  ''' multiprocessing queue wrapper -- maxsize bounds the
+      queue (0 is unbounded) and policy decides what put
+      does once it fills up:
+
+      block: wait for room, slowing the producer down
+      drop_oldest: evict the oldest item to make room
+      drop_newest: discard the item being put
+      keep_every_nth: once the queue is half full only
+        every nth item is kept, and items that still don't
+        fit are discarded
+
+      None is used as an end-of-stream marker by consumers
+      and is never dropped or moved: while one is queued,
+      drop_oldest discards the item being put instead of
+      evicting from the head, so items never cross a marker.
+      Dropped items are counted in
+      the shared `dropped` counter and passed to on_drop,
+      if given. '''
+
+  def __init__(self, label, debug=False, maxsize=0, policy=BLOCK, nth=2,
+               on_drop=None):
+    if policy not in POLICIES:
+      raise ValueError("unknown queue policy: %s" % policy)
     self.label = label
     self.debug = debug
-    self._queue = _Queue()
+    self.maxsize = maxsize
+    self.policy = policy if maxsize > 0 else BLOCK
+    self.nth = nth
+    self.on_drop = on_drop
+    self._queue = _Queue(maxsize)
+    self._dropped = multiprocessing.Value('L', 0)
+    # end-of-stream markers put and not yet got -- its lock
+    # is held while drop_oldest evicts
+    self._markers = multiprocessing.Value('L', 0)
     self.i = 0
+    self._offered = 0
+    self._depth = metrics.gauge('smartcam_queue_depth', queue=label)
+    self._drops = metrics.counter('smartcam_queue_dropped_total', queue=label)
+
+  @property
+  def dropped(self):
+    return self._dropped.value
+
+  def qsize(self):
+    return self._queue.qsize()
 
-  def get(self):
+  def get(self, timeout=None):
+    """ raises queue.Empty if timeout expires """
     interval = 20
-    item = self._queue.get()
+    item = self._queue.get(timeout=timeout)
+    if item is None:
+      with self._markers.get_lock():
+        self._markers.value -= 1
+    try:
+      self._depth.set(self._queue.qsize())
+    except NotImplementedError:
+      pass
     if self.debug:
       self.i = self.i + 1
       if self.i % interval == 0:
         self.i = 0
-        logger.debug("%s queue depth: %s" % (self.label, self._queue.qsize()))
+        logger.debug("%s queue depth: %s dropped: %s" %
+          (self.label, self._queue.qsize(), self.dropped))
     return item
 
+  def take(self, timeout=None):
+    """ same as get, returning (item, lease) to match
+        SharedFrameSubscriber; items here are private
+        copies, so there is never a lease """
+    return (self.get(timeout), None)
+
+  def release(self, lease=None):
+    pass
+
+  def reclaim(self):
+    """ same as SharedFrameSubscriber's; a consumer that
+        dies here holds nothing that needs giving back """
+    return 0
+
   def put(self, item):
-    return self._queue.put(item)
+    if item is None:
+      with self._markers.get_lock():
+        self._markers.value += 1
+      return self._queue.put(item)
+    if self.policy == BLOCK:
+      return self._queue.put(item)
+    if self.policy == KEEP_EVERY_NTH:
+      self._offered += 1
+      if self._under_pressure() and self._offered % self.nth != 0:
+        return self._drop(item)
+      return self._put_or_drop(item)
+    if self.policy == DROP_NEWEST:
+      return self._put_or_drop(item)
+    if self.policy == DROP_OLDEST:
+      while True:
+        try:
+          return self._queue.put_nowait(item)
+        except queue.Full:
+          pass
+        with self._markers.get_lock():
+          # the head may be an end-of-stream marker, which
+          # can't be put back in front, so while one is
+          # queued give up on the new item instead
+          if self._markers.value:
+            oldest = None
+          else:
+            try:
+              oldest = self._queue.get_nowait()
+            except queue.Empty:
+              continue
+        if oldest is None:
+          return self._drop(item)
+        self._drop(oldest)
+
+  def _under_pressure(self):
+    try:
+      return self._queue.qsize() >= self.maxsize // 2
+    except NotImplementedError:
+      return self._queue.full()
+
+  def _put_or_drop(self, item):
+    try:
+      self._queue.put_nowait(item)
+    except queue.Full:
+      self._drop(item)
+
+  def _drop(self, item):
+    with self._dropped.get_lock():
+      self._dropped.value += 1
+    self._drops.inc()
+    if self.on_drop is not None:
+      self.on_drop(item)
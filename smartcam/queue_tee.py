@@ -8,14 +8,16 @@ logger = logging.getLogger(__name__)
 
 class QueueTee(multiprocessing.Process):
   ''' read from in_queue
-      and put it onto out_queues
+      and put it onto out_queues, stamping
+      traced frames with stage, if given
   '''
 
-  def __init__(self, in_queue, out_queues, name):
+  def __init__(self, in_queue, out_queues, name, stage=None):
     multiprocessing.Process.__init__(self)
     self.name = name
     self.in_queue = in_queue
     self.out_queues = out_queues
+    self.stage = stage
     self.daemon = True
 
   def run(self):
@@ -25,6 +27,8 @@ class QueueTee(multiprocessing.Process):
         frame = self.in_queue.get()
       except queue.Empty:
         continue
+      if frame is not None and self.stage is not None:
+        frame.stamp(self.stage)
       for q in self.out_queues:
         try:
           q.put(frame)
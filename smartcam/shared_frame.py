@@ -0,0 +1,313 @@
+import logging
+import multiprocessing
+from multiprocessing import sharedctypes
+import numpy as np
+from smartcam.abstract import Queue
+from smartcam.frame import Frame
+from smartcam.queue import Queue as HeaderQueue, BLOCK
+
+logger = logging.getLogger(__name__)
+
+
+class SharedFrameStore:
+  ''' fixed pool of reference-counted frame slots in shared
+      memory -- a slot goes back on the free list once every
+      reference handed out for it has been released.
+
+      The pool is allocated up front, so the store must be
+      created before the processes that use it are started. '''
+
+  def __init__(self, label, slots=4, max_width=1920, max_height=1080,
+               channels=3):
+    self.label = label
+    self.slots = slots
+    self.slot_bytes = max_width * max_height * channels
+    self._buffer = sharedctypes.RawArray('B', slots * self.slot_bytes)
+    self._refs = sharedctypes.RawArray('i', slots)
+    self._lock = multiprocessing.Lock()
+    self._free = multiprocessing.Semaphore(slots)
+    self._view = None
+
+  @property
+  def view(self):
+    ''' flat uint8 view over the whole pool, created lazily
+        in whichever process first touches it '''
+    if self._view is None:
+      self._view = np.frombuffer(self._buffer, dtype=np.uint8)
+    return self._view
+
+  def array(self, slot, shape, dtype):
+    ''' return ndarray view of slot '''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    start = slot * self.slot_bytes
+    return self.view[start:start + nbytes].view(dtype).reshape(shape)
+
+  def write(self, image, refs=1):
+    ''' copy image into a free slot holding refs references,
+        blocking until a slot is available; return slot index '''
+    if image.nbytes > self.slot_bytes:
+      raise ValueError("%s: frame of %s bytes exceeds slot size of %s" %
+        (self.label, image.nbytes, self.slot_bytes))
+    slot = self._acquire(refs)
+    try:
+      np.copyto(self.array(slot, image.shape, image.dtype), image)
+    except Exception:
+      self.decref(slot, refs)
+      raise
+    return slot
+
+  def _acquire(self, refs):
+    self._free.acquire()
+    with self._lock:
+      for slot in range(self.slots):
+        if self._refs[slot] == 0:
+          self._refs[slot] = refs
+          return slot
+    # semaphore and slot table disagree; should never happen
+    self._free.release()
+    raise RuntimeError("%s: no free frame slot" % self.label)
+
+  def incref(self, slot, n=1):
+    with self._lock:
+      self._refs[slot] += n
+
+  def decref(self, slot, n=1):
+    with self._lock:
+      self._refs[slot] -= n
+      freed = self._refs[slot] <= 0
+      if freed:
+        self._refs[slot] = 0
+    if freed:
+      self._free.release()
+
+
+class SharedFrameSubscriber(Queue):
+  ''' read side of a SharedFrameFanout -- each subscriber has
+      its own header queue, i.e. its own read cursor over the
+      stores it is attached to, and get returns a frame whose
+      image is a view onto the slot.
+
+      The view is leased to the consumer until its next call
+      to get, so consumers must not hold on to frame.image
+      across calls (copy it if you need to).  Leased views are
+      read-only: every subscriber of the fan-out reads the
+      same slot, so copy before drawing on or otherwise
+      changing one.  Putting a leased frame onto another
+      shared queue or fanout is safe, as put copies
+      synchronously.
+
+      Consumers that work on several frames at once use take
+      instead, and give each lease back with release; leases
+      is the most frames such a consumer holds at a time.
+
+      The slots leased out are counted in shared memory, so
+      that if the consumer dies holding some, reclaim can give
+      them back from another process. '''
+
+  def __init__(self, label, debug=False, maxsize=0, policy=BLOCK, nth=2,
+               leases=1):
+    self.label = label
+    self.debug = debug
+    self.leases = leases
+    self._headers = HeaderQueue(label, debug=debug, maxsize=maxsize,
+      policy=policy, nth=nth, on_drop=self._on_drop)
+    self._stores = {}
+    self._held = {}
+    self._leased = None
+
+  @property
+  def maxsize(self):
+    return self._headers.maxsize
+
+  @property
+  def policy(self):
+    return self._headers.policy
+
+  @property
+  def dropped(self):
+    return self._headers.dropped
+
+  def qsize(self):
+    return self._headers.qsize()
+
+  def attach(self, store):
+    self._stores[store.label] = store
+    self._held[store.label] = sharedctypes.RawArray('i', store.slots)
+
+  def deliver(self, header):
+    ''' push header for a slot this subscriber holds a reference to '''
+    self._headers.put(header)
+
+  def _on_drop(self, header):
+    ''' give up the references held by a header the queue dropped '''
+    (store_label, slot) = header[:2]
+    self._stores[store_label].decref(slot)
+    full = header[-1]
+    if full is not None:
+      self._stores[full[0]].decref(full[1])
+
+  def get(self, timeout=None):
+    ''' release the previously leased slot and return
+        the next frame '''
+    self.release()
+    (frame, self._leased) = self.take(timeout)
+    return frame
+
+  def take(self, timeout=None):
+    ''' return (frame, lease) for the next frame, where the
+        frame's image stays valid until lease is passed to
+        release; raises queue.Empty if timeout expires '''
+    header = self._headers.get(timeout)
+    if header is None:
+      return (None, None)
+    (store_label, slot, camera_id, time, width, height, shape, dtype,
+      encoded, stamps, full) = header
+    store = self._stores[store_label]
+    frame = Frame(camera_id, store.array(slot, shape, dtype), width, height)
+    frame.time = time
+    frame.encoded.update(encoded)
+    frame.stamps = stamps
+    lease = ((store, slot),)
+    if full is not None:
+      (full_label, full_slot, shape, dtype, width, height) = full
+      full_store = self._stores[full_label]
+      frame.full = Frame(camera_id, full_store.array(full_slot, shape, dtype),
+        width, height)
+      frame.full.time = time
+      frame.full.stamps = stamps
+      lease += ((full_store, full_slot),)
+    for (store, slot) in lease:
+      self._held[store.label][slot] += 1
+    return (frame, lease)
+
+  def release(self, lease=None):
+    ''' drop references to the slots of lease, by default
+        those leased by get '''
+    if lease is None:
+      (lease, self._leased) = (self._leased, None)
+    for (store, slot) in lease or ():
+      # uncounted first: dying in between leaks the slot,
+      # rather than having reclaim release it twice
+      self._held[store.label][slot] -= 1
+      store.decref(slot)
+
+  def reclaim(self):
+    ''' give back the slots leased by a consumer that died
+        without releasing them -- call only once it has
+        exited, and before another consumer takes over;
+        returns the number of references given back.  Frames
+        still queued are not lost, the next consumer gets them '''
+    n = 0
+    for (label, held) in self._held.items():
+      store = self._stores[label]
+      for slot in range(len(held)):
+        if held[slot] > 0:
+          store.decref(slot, held[slot])
+          n += held[slot]
+        held[slot] = 0
+    self._leased = None
+    return n
+
+
+class SharedFrameFanout:
+  ''' single producer, many consumer frame fan-out -- each
+      frame is written once into a shared store slot holding
+      one reference per subscriber, and only a small header is
+      sent to each subscriber; the slot is recycled once every
+      subscriber has released it, so memory use does not grow
+      with the number of subscribers.  Traced frames are
+      stamped with stage, if given, on the way through.
+
+      If slots is None and every subscriber is bounded with a
+      dropping policy, the store gets enough slots that the
+      producer never waits on a slow subscriber.
+
+      Given full_size, (max width, max height, channels), frames
+      put here may carry the full resolution frame they were
+      downsampled from (frame.full), which goes into a second
+      store of that size; subscribers get it back as frame.full,
+      leased along with the frame itself and just as read-only
+      -- every subscriber sees the one copy. '''
+
+  def __init__(self, label, subscribers, slots=None, max_width=1920,
+               max_height=1080, channels=3, full_size=None, stage=None):
+    self.label = label
+    self.subscribers = subscribers
+    self.stage = stage
+    if slots is None:
+      slots = self.default_slots(subscribers)
+    self.store = SharedFrameStore(label, slots, max_width, max_height,
+      channels)
+    self.full_store = None
+    if full_size is not None:
+      self.full_store = SharedFrameStore(label + '_full', slots, *full_size)
+    for s in self.subscribers:
+      s.attach(self.store)
+      if self.full_store is not None:
+        s.attach(self.full_store)
+
+  @staticmethod
+  def default_slots(subscribers):
+    ''' each subscriber holds at most maxsize queued slots
+        plus those it has leased, and the producer needs one
+        to write into '''
+    if any(s.maxsize <= 0 or s.policy == BLOCK for s in subscribers):
+      return max(4, sum(s.leases for s in subscribers) + 1)
+    return sum(s.maxsize + s.leases for s in subscribers) + 1
+
+  def put(self, frame):
+    ''' None is passed through to every subscriber as-is '''
+    if frame is None:
+      for s in self.subscribers:
+        s.deliver(None)
+      return
+    full = None
+    if frame.full is not None:
+      if self.full_store is None:
+        raise ValueError("%s: no store for full frames" % self.label)
+      image = frame.full.image
+      full_slot = self.full_store.write(image, refs=len(self.subscribers))
+      full = (self.full_store.label, full_slot, image.shape, image.dtype.str,
+        frame.full.width, frame.full.height)
+    image = frame.image
+    try:
+      slot = self.store.write(image, refs=len(self.subscribers))
+    except Exception:
+      # nothing will ever be delivered for the full frame
+      if full is not None:
+        self.full_store.decref(full_slot, len(self.subscribers))
+      raise
+    if self.stage is not None:
+      frame.stamp(self.stage)
+    # encoded images already cached on the frame ride along,
+    # so that subscribers don't encode the same frame again
+    header = (self.label, slot, frame.id, frame.time, frame.width,
+      frame.height, image.shape, image.dtype.str, frame.encoded,
+      frame.stamps, full)
+    for s in self.subscribers:
+      try:
+        s.deliver(header)
+      except Exception as e:
+        logger.error("%s: failed to deliver frame to %s: %s" %
+          (self.label, s.label, e))
+        # give up the references held for s
+        self.store.decref(slot)
+        if full is not None:
+          self.full_store.decref(full_slot)
+
+
+class SharedFrameQueue(SharedFrameSubscriber):
+  ''' point-to-point shared memory frame queue, ie. a fan-out
+      with a single subscriber '''
+
+  def __init__(self, label, slots=None, max_width=1920, max_height=1080,
+               channels=3, debug=False, maxsize=0, policy=BLOCK, nth=2,
+               leases=1):
+    super().__init__(label, debug=debug, maxsize=maxsize, policy=policy,
+      nth=nth, leases=leases)
+    self._fanout = SharedFrameFanout(label, [self], slots, max_width,
+      max_height, channels)
+
+  def put(self, frame):
+    self._fanout.put(frame)
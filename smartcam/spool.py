@@ -0,0 +1,322 @@
+import concurrent.futures
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from smartcam import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1048576
+
+
+class Spool:
+  ''' durable on-disk spool for uploads that failed -- records
+      are appended to numbered segment files, and an append-only
+      index of json lines records where each one lives ('put'),
+      when it has been uploaded ('ack') and which segments were
+      evicted to stay under quota ('evict').  A segment is deleted
+      once every record in it has been acked -- or emptied, if it
+      is the last one -- and whole segments are evicted oldest
+      first when the spool outgrows quota_bytes.
+
+      Any number of processes may put records; writes are
+      serialised with a lock file.  Only one process should
+      replay the spool (see SpoolUploader). '''
+
+  RECORD = struct.Struct('!4sIQ')
+  MAGIC = b'SPL1'
+
+  def __init__(self, directory, quota_bytes=1 << 30, segment_bytes=64 << 20):
+    self.directory = directory
+    self.quota_bytes = quota_bytes
+    self.segment_bytes = segment_bytes
+    self.tmp_dir = os.path.join(directory, 'tmp')
+    os.makedirs(self.tmp_dir, exist_ok=True)
+    self.index_path = os.path.join(directory, 'index')
+    self.lock_path = os.path.join(directory, 'lock')
+    self._thread_lock = threading.Lock()
+    # replay state, only used by the reading process:
+    self._index_offset = 0
+    self._pending = {}
+
+  def _locked(self):
+    return _FileLock(self.lock_path, self._thread_lock)
+
+  def _segment_path(self, n):
+    return os.path.join(self.directory, 'segment-%08d' % n)
+
+  def _segments(self):
+    return sorted(int(f.split('-')[1]) for f in os.listdir(self.directory)
+                  if f.startswith('segment-'))
+
+  def _append_index(self, entry, sync=True):
+    ''' sync waits for the entry to reach the disk -- needed
+        for all but acks, as losing one of those only means an
+        upload is repeated '''
+    with open(self.index_path, 'a') as f:
+      f.write(json.dumps(entry) + '\n')
+      if sync:
+        f.flush()
+        os.fsync(f.fileno())
+
+  def temp_path(self):
+    ''' path for staging a file before put_file, inside the
+        spool so the final move stays on one filesystem '''
+    return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+  def put(self, kind, meta, data):
+    ''' append record holding data bytes '''
+    return self._put(kind, meta, len(data), lambda f: f.write(data))
+
+  def put_file(self, kind, meta, path):
+    ''' append record holding the contents of file at path '''
+    def copy(f):
+      with open(path, 'rb') as src:
+        while True:
+          chunk = src.read(CHUNK_SIZE)
+          if not chunk:
+            return
+          f.write(chunk)
+    return self._put(kind, meta, os.path.getsize(path), copy)
+
+  def _put(self, kind, meta, length, write_payload):
+    record_id = uuid.uuid4().hex
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    with self._locked():
+      segments = self._segments()
+      n = segments[-1] if segments else 0
+      path = self._segment_path(n)
+      if os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes:
+        n += 1
+        path = self._segment_path(n)
+      with open(path, 'ab') as f:
+        offset = f.tell()
+        f.write(self.RECORD.pack(self.MAGIC, len(meta_bytes), length))
+        f.write(meta_bytes)
+        write_payload(f)
+        # the payload must be on disk before the index says
+        # where it is
+        f.flush()
+        os.fsync(f.fileno())
+      self._append_index({ 'op': 'put', 'id': record_id, 'kind': kind,
+        'meta': meta, 'segment': n,
+        'offset': offset + self.RECORD.size + len(meta_bytes),
+        'length': length })
+      self._enforce_quota()
+    logger.debug("spooled %s record %s (%s bytes)" % (kind, record_id, length))
+    return record_id
+
+  def _enforce_quota(self):
+    ''' evict oldest segments while over quota, called
+        with the lock held '''
+    segments = self._segments()
+    sizes = { n: os.path.getsize(self._segment_path(n)) for n in segments }
+    total = sum(sizes.values())
+    while total > self.quota_bytes and len(segments) > 1:
+      n = segments.pop(0)
+      logger.warning("spool over quota, evicting segment %s" % n)
+      os.remove(self._segment_path(n))
+      self._append_index({ 'op': 'evict', 'segment': n })
+      total -= sizes[n]
+
+  def pending(self):
+    ''' return list of records not yet acked, oldest first '''
+    with self._locked():
+      self._refresh()
+    return list(self._pending.values())
+
+  def _refresh(self):
+    ''' apply index entries written since the last refresh,
+        called with the lock held '''
+    if not os.path.exists(self.index_path):
+      return
+    with open(self.index_path, 'rb') as f:
+      f.seek(self._index_offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          break
+        self._index_offset += len(line)
+        self._apply(json.loads(line.decode('utf-8')))
+
+  def _apply(self, entry):
+    op = entry['op']
+    if op == 'put':
+      self._pending[entry['id']] = entry
+    elif op == 'ack':
+      self._pending.pop(entry['id'], None)
+    elif op == 'evict':
+      for (k, v) in list(self._pending.items()):
+        if v['segment'] == entry['segment']:
+          del self._pending[k]
+
+  def read(self, record):
+    ''' generator over record payload in chunks '''
+    with open(self._segment_path(record['segment']), 'rb') as f:
+      f.seek(record['offset'])
+      remaining = record['length']
+      while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+          raise IOError("spool segment %s truncated" % record['segment'])
+        remaining -= len(chunk)
+        yield chunk
+
+  def read_bytes(self, record):
+    return b''.join(self.read(record))
+
+  def intact(self, record):
+    ''' is all of record's payload there to read -- it may
+        not be after a power loss, or if its segment was
+        evicted since it was listed '''
+    try:
+      size = os.path.getsize(self._segment_path(record['segment']))
+    except OSError:
+      return False
+    return size >= record['offset'] + record['length']
+
+  def ack(self, record):
+    ''' mark record uploaded, reclaiming its segment once
+        nothing in it is pending '''
+    with self._locked():
+      self._append_index({ 'op': 'ack', 'id': record['id'] }, sync=False)
+      self._refresh()
+      segment = record['segment']
+      segments = self._segments()
+      live = any(r['segment'] == segment for r in self._pending.values())
+      path = self._segment_path(segment)
+      if not live and os.path.exists(path):
+        if segments and segment == segments[-1]:
+          # writers append to the last segment, so it is
+          # emptied rather than deleted, which keeps segment
+          # numbers from being reused
+          os.truncate(path, 0)
+        else:
+          os.remove(path)
+      if not self._pending:
+        # everything in the index is done with, start a new one
+        os.remove(self.index_path)
+        self._index_offset = 0
+
+
+class _FileLock:
+  ''' lock held across threads (threading.Lock) and
+      processes (flock on lock file) '''
+
+  def __init__(self, path, thread_lock):
+    self.path = path
+    self.thread_lock = thread_lock
+
+  def __enter__(self):
+    self.thread_lock.acquire()
+    self.fh = open(self.path, 'a')
+    fcntl.flock(self.fh, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self.fh, fcntl.LOCK_UN)
+    self.fh.close()
+    self.thread_lock.release()
+
+
+class SpoolUploader(threading.Thread):
+  ''' replay spooled records in the background -- handlers maps
+      record kind to a function taking (spool, record) that
+      uploads it and raises on failure; up to max_workers
+      uploads run at once, and a round stops early at the
+      first failure so a dead uplink is only probed once per
+      interval.
+
+      A handler that only hands the record over to be sent
+      later returns a concurrent.futures.Future instead, and
+      the record is acked once that completes; until then
+      later rounds skip it. '''
+
+  def __init__(self, spool, handlers, max_workers=2, interval=30.0):
+    threading.Thread.__init__(self)
+    self.name = SpoolUploader.__name__
+    self.daemon = True
+    self.spool = spool
+    self.handlers = handlers
+    self.max_workers = max_workers
+    self.interval = interval
+    self._in_flight = set()
+    self._in_flight_lock = threading.Lock()
+    self._pending = metrics.gauge('smartcam_spool_pending',
+      spool=os.path.basename(os.path.normpath(spool.directory)))
+
+  def upload(self, record):
+    if not self.spool.intact(record):
+      # retrying can't help, and would hold up the rest
+      logger.error("spooled %s record %s is truncated, dropping it" %
+        (record['kind'], record['id']))
+      self.spool.ack(record)
+      return
+    result = self.handlers[record['kind']](self.spool, record)
+    if not isinstance(result, concurrent.futures.Future):
+      self.spool.ack(record)
+      return
+    with self._in_flight_lock:
+      self._in_flight.add(record['id'])
+    result.add_done_callback(lambda f: self._delivered(record, f))
+
+  def _delivered(self, record, future):
+    try:
+      if future.exception() is None:
+        self.spool.ack(record)
+      else:
+        logger.warning("spooled upload failed: %s" % future.exception())
+    except Exception as e:
+      logger.error("SpoolUploader failed to ack record: %s" % e)
+    finally:
+      with self._in_flight_lock:
+        self._in_flight.discard(record['id'])
+
+  def replay(self):
+    ''' upload pending records, return count uploaded (or
+        handed over, for handlers that return a Future) '''
+    with self._in_flight_lock:
+      in_flight = set(self._in_flight)
+    records = [ r for r in self.spool.pending()
+                if r['kind'] in self.handlers and r['id'] not in in_flight ]
+    self._pending.set(len(records))
+    if not records:
+      return 0
+    logger.info("replaying %s spooled records" % len(records))
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+      records = iter(records)
+      running = set()
+      failed = False
+      while True:
+        while not failed and len(running) < self.max_workers:
+          record = next(records, None)
+          if record is None:
+            break
+          running.add(pool.submit(self.upload, record))
+        if not running:
+          break
+        finished, running = concurrent.futures.wait(running,
+          return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in finished:
+          try:
+            f.result()
+            done += 1
+            self._pending.dec()
+          except Exception as e:
+            logger.warning("spooled upload failed: %s" % e)
+            failed = True
+    return done
+
+  def run(self):
+    logger.debug("starting SpoolUploader thread")
+    while True:
+      try:
+        self.replay()
+      except Exception as e:
+        logger.error("SpoolUploader replay failed: %s" % e)
+      time.sleep(self.interval)
@@ -0,0 +1,201 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from smartcam.motion_detector import PreprocessPool, run_pipelined
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_count(n_cameras, reserved=1):
+  ''' one worker per camera, but no more workers than there
+      are cores left over after reserved ones (frame readers,
+      the supervisor itself) '''
+  cpus = os.cpu_count() or 1
+  return max(1, min(n_cameras, cpus - reserved))
+
+
+def assign_workers(camera_ids, workers):
+  ''' return dict of camera id -> worker index -- cameras are
+      dealt out round robin in sorted order, and the assignment
+      is fixed for the life of the supervisor, so a restarted
+      worker takes back the same cameras '''
+  return { c: i % workers for (i, c) in enumerate(sorted(camera_ids)) }
+
+
+class Service:
+  ''' a process kept running by Supervisor -- factory returns
+      a new, unstarted multiprocessing.Process every time the
+      service is (re)started, and queues are those it consumes
+      from, whose leases are reclaimed when it exits '''
+
+  def __init__(self, name, factory, queues=()):
+    self.name = name
+    self.factory = factory
+    self.queues = queues
+    self.process = None
+    self.failures = 0
+    self.started_at = None
+    self.restart_at = None
+
+  def start(self):
+    self.restart_at = None
+    self.process = self.factory()
+    self.process.daemon = True
+    self.process.start()
+    self.started_at = time.monotonic()
+    logger.info("started %s (pid %s)" % (self.name, self.process.pid))
+
+  def is_alive(self):
+    return self.process is not None and self.process.is_alive()
+
+  def reclaim(self):
+    ''' give back shared frame slots the exited process held '''
+    for q in self.queues:
+      try:
+        n = q.reclaim()
+      except Exception as e:
+        logger.error("%s: failed to reclaim %s: %s" % (self.name, q.label, e))
+        continue
+      if n:
+        logger.warning("%s: reclaimed %s frame slot references from %s" %
+          (self.name, n, q.label))
+
+
+class Supervisor:
+  ''' start services and restart any that exit -- a service
+      that keeps failing is restarted after an exponential
+      backoff, reset once it has stayed up for stable seconds.
+
+      A service that dies while holding leased shared memory
+      frame slots would otherwise never give them back, so the
+      queues it was added with are reclaimed as soon as it is
+      found to have exited, before it is restarted. '''
+
+  def __init__(self, interval=1.0, backoff=1.0, max_backoff=60.0,
+               stable=60.0):
+    self.services = []
+    self.interval = interval
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.stable = stable
+
+  def add(self, name, factory, queues=()):
+    self.services.append(Service(name, factory, queues))
+
+  def _start(self, service):
+    try:
+      service.start()
+    except Exception as e:
+      logger.error("failed to start %s: %s" % (service.name, e))
+      self._failed(service)
+
+  def _failed(self, service):
+    service.failures += 1
+    delay = min(self.max_backoff,
+      self.backoff * (2 ** (service.failures - 1)))
+    service.restart_at = time.monotonic() + delay
+    logger.warning("restarting %s in %.1fs" % (service.name, delay))
+
+  def poll(self):
+    ''' check on every service once, restarting those due '''
+    now = time.monotonic()
+    for service in self.services:
+      if service.is_alive():
+        if service.failures and now - service.started_at >= self.stable:
+          service.failures = 0
+        continue
+      if service.restart_at is None:
+        logger.error("%s exited with code %s" % (service.name,
+          service.process.exitcode if service.process else None))
+        service.reclaim()
+        self._failed(service)
+      elif now >= service.restart_at:
+        self._start(service)
+
+  def run(self):
+    for service in self.services:
+      self._start(service)
+    while True:
+      time.sleep(self.interval)
+      self.poll()
+
+
+class MotionWorker(multiprocessing.Process):
+  ''' motion detection for several cameras in one process --
+      frames from all of them arrive on in_queue and each is
+      handed to the CV2MotionDetectorProcess holding its
+      camera's detector state, used here as a plain object and
+      never started.  An error on one camera's frame is logged
+      and does not affect the others.
+
+      With preprocess_workers, downsampling for all cameras is
+      spread over a PreprocessPool of that many threads, while
+      detection itself stays serial per camera. '''
+
+  def __init__(self, name, in_queue, detectors, preprocess_workers=0):
+    """ detectors maps camera id to CV2MotionDetectorProcess """
+    multiprocessing.Process.__init__(self)
+    self.name = name
+    self.in_queue = in_queue
+    self.detectors = detectors
+    self.preprocess_workers = preprocess_workers
+
+  def route(self, frame):
+    detector = self.detectors.get(frame.id)
+    if detector is None:
+      logger.error("%s: no detector for camera %s" % (self.name, frame.id))
+    return detector
+
+  def run(self):
+    logger.debug("starting %s for cameras %s" %
+      (self.name, sorted(self.detectors)))
+    if self.preprocess_workers > 0:
+      run_pipelined(self.in_queue, PreprocessPool(self.preprocess_workers),
+        self.route)
+    while True:
+      try:
+        frame = self.in_queue.get()
+      except queue.Empty:
+        continue
+      if frame is None:
+        continue
+      detector = self.route(frame)
+      if detector is None:
+        continue
+      try:
+        detector.process_frame(frame)
+      except Exception as e:
+        logger.error("%s: failed to process frame from %s: %s" %
+          (self.name, frame.id, e))
+
+
+class UploadWorker(multiprocessing.Process):
+  ''' video and frame writers for several cameras in one
+      process, each on its own thread -- encoding happens in
+      ffmpeg subprocesses and uploads wait on the network, so
+      threads are enough, and the cameras share one interpreter
+      and their api and cloud clients.  Exits if any writer
+      thread dies, for the supervisor to restart it. '''
+
+  def __init__(self, name, video_writers, frame_writers):
+    """ video_writers are VideoWriterImpl, whose run loop is
+        called on a thread rather than started as a process;
+        frame_writers are unstarted FrameWriter threads """
+    multiprocessing.Process.__init__(self)
+    self.name = name
+    self.video_writers = video_writers
+    self.frame_writers = frame_writers
+
+  def run(self):
+    threads = [ threading.Thread(target=w.run, name='%s-%s' % (w.name, i))
+                for (i, w) in enumerate(self.video_writers) ]
+    threads += self.frame_writers
+    for t in threads:
+      t.daemon = True
+      t.start()
+    while all(t.is_alive() for t in threads):
+      time.sleep(1.0)
+    logger.error("%s: writer thread exited" % self.name)
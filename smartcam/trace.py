@@ -0,0 +1,134 @@
+import array
+import itertools
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# stages a traced frame is stamped at, in pipeline order:
+STAGES = ('capture', 'tee', 'detect_start', 'detect_end', 'motion_queue',
+          'encode', 'ffmpeg_write', 'upload')
+(CAPTURE, TEE, DETECT_START, DETECT_END, MOTION_QUEUE, ENCODE, FFMPEG_WRITE,
+  UPLOAD) = range(len(STAGES))
+
+FORMATS = ('jsonl', 'chrome')
+
+_tracer = None
+
+
+def new_stamps():
+  ''' one time.monotonic() per stage, 0 for stages not
+      reached -- the monotonic clock is system wide, so stamps
+      taken in different processes can be compared '''
+  return array.array('d', bytes(8 * len(STAGES)))
+
+
+class Tracer:
+  ''' write the stamps of one in every sample_every captured
+      frames to path once the frame is done with, either as
+      json lines, one per frame, or as Chrome trace events
+      (chrome://tracing, Perfetto), one async slice per stage.
+
+      Frames are done with in several processes, which all
+      append to the one file; each record goes out in a single
+      write to a file opened with O_APPEND, so records from
+      different processes do not interleave. '''
+
+  def __init__(self, path, sample_every=100, fmt='jsonl'):
+    if fmt not in FORMATS:
+      raise ValueError("unknown trace format: %s" % fmt)
+    self.path = path
+    self.sample_every = sample_every
+    self.fmt = fmt
+    self._count = itertools.count()
+    self._fd = None
+    self._pid = None
+
+  def start(self):
+    ''' truncate the file, call once before forking '''
+    with open(self.path, 'w') as f:
+      if self.fmt == 'chrome':
+        # the closing ] is optional in the Chrome trace format
+        f.write('[\n')
+
+  def sample(self):
+    return next(self._count) % self.sample_every == 0
+
+  def _write(self, data):
+    if self._fd is None or self._pid != os.getpid():
+      self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+      self._pid = os.getpid()
+    os.write(self._fd, data.encode('utf-8'))
+
+  def emit(self, frame, sink):
+    stamps = [ (STAGES[i], t) for (i, t) in enumerate(frame.stamps) if t ]
+    if not stamps:
+      return
+    if self.fmt == 'jsonl':
+      data = json.dumps({ 'camera': frame.id, 'sink': sink,
+        'time': frame.time.isoformat(), 'pid': os.getpid(),
+        'stamps': dict(stamps),
+        'latency': stamps[-1][1] - stamps[0][1] }) + '\n'
+    else:
+      data = ''.join(json.dumps(e) + ',\n'
+                     for e in self.chrome_events(frame, sink, stamps))
+    try:
+      self._write(data)
+    except Exception as e:
+      logger.error("Failed to write frame trace: %s" % e)
+
+  def chrome_events(self, frame, sink, stamps):
+    ''' nestable async events, one slice for the whole frame
+        and one inside it for each stage, covering the time
+        from the stage before '''
+    common = { 'cat': 'frame', 'pid': os.getpid(), 'tid': os.getpid(),
+      'id': '%s/%s/%s' % (frame.id, frame.time.isoformat(), sink) }
+    us = lambda t: int(t * 1000000)
+    events = [ dict(common, name=sink, ph='b', ts=us(stamps[0][1]),
+      args={ 'camera': frame.id, 'time': frame.time.isoformat() }) ]
+    for ((_, start), (stage, end)) in zip(stamps, stamps[1:]):
+      events.append(dict(common, name=stage, ph='b', ts=us(start)))
+      events.append(dict(common, name=stage, ph='e', ts=us(end)))
+    events.append(dict(common, name=sink, ph='e', ts=us(stamps[-1][1])))
+    return events
+
+
+def enable(path, sample_every=100, fmt='jsonl'):
+  ''' start tracing -- call before starting the processes
+      that should trace, which write to the same file '''
+  global _tracer
+  _tracer = Tracer(path, sample_every, fmt)
+  _tracer.start()
+  return _tracer
+
+
+def start(frame):
+  ''' called at capture: if frame is sampled, give it stamps '''
+  if _tracer is None or not _tracer.sample():
+    return
+  frame.stamps = new_stamps()
+  frame.stamp(CAPTURE)
+
+
+def emit(frame, sink):
+  ''' write frame's trace, if it is traced -- sink names where
+      the frame ended up: 'detect' for frames the detector did
+      not pass on, 'video' and 'image' for the two writers '''
+  if _tracer is None or frame.stamps is None:
+    return
+  _tracer.emit(frame, sink)
+
+
+class Sample:
+  ''' what emit needs of a frame, for holding on to its stamps
+      without holding on to its image '''
+
+  def __init__(self, frame):
+    self.id = frame.id
+    self.time = frame.time
+    self.stamps = frame.stamps
+
+  def stamp(self, stage, t=None):
+    self.stamps[stage] = time.monotonic() if t is None else t
@@ -56,4 +56,22 @@ class RemoteVideo(Video):
     }, ensure_ascii=False)
 
 
+class SegmentedVideo(Video):
+  ''' manifest of a recording uploaded as separate segments --
+      each segment is a dict of bucket, key, region, start
+      and end '''
 
+  def __init__(self, camera_id, start, end, width, height, segments):
+    self.segments = segments
+    super().__init__(camera_id, start, end, width, height)
+
+  def serialize(self):
+    return json.dumps({
+      'camera_id': self.camera_id,
+      'start': convert_time(self.start),
+      'end': convert_time(self.end),
+      'width': self.width,
+      'height': self.height,
+      'segments': [ dict(s, start=convert_time(s['start']),
+                         end=convert_time(s['end'])) for s in self.segments ]
+    }, ensure_ascii=False)
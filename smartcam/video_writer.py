@@ -1,44 +1,108 @@
+import concurrent.futures
+import datetime
 import logging
 import multiprocessing
 import os
 import queue
+import shutil
 import subprocess
-from threading import Thread, Lock
+import tempfile
+import time
+from threading import Thread, Lock, Event
 import cv2
+import numpy as np
 from PIL import Image
+from smartcam import metrics, trace
 from smartcam.abstract import VideoWriter
-from smartcam.video import RemoteVideo
+from smartcam.encoder import CV2JPEGEncoder, get_default_encoder
+from smartcam.video import RemoteVideo, SegmentedVideo, convert_time
 
 logger = logging.getLogger(__name__)
 
+SEGMENT_LIST = 'segments.csv'
+
+_metrics = {}
+
+
+def _metric(metric_type, name, **labels):
+  """ return cached metric handle """
+  key = (metric_type, name, tuple(sorted(labels.items())))
+  metric = _metrics.get(key)
+  if metric is None:
+    metric = _metrics[key] = getattr(metrics, metric_type)(name, **labels)
+  return metric
+
 
 class FFMpegProcess:
 
-  def __init__(self, fps, width, height, pipe, is_color=True):
-    """ pass first frame of video, return ffmpeg process """
+  def __init__(self, fps, width, height, pipe, is_color=True,
+               input_format='rawvideo', preset=None, crf=0, tune=None,
+               segment_dir=None, segment_seconds=10):
+    """ pass first frame of video, return ffmpeg process --
+        input_format 'rawvideo' pipes the ndarray buffer
+        straight to ffmpeg, 'image2pipe' sends a JPEG per frame,
+        at the image quality but never scaled down, as ffmpeg
+        is told the full frame size.
+        Given segment_dir, output is split into fragmented mp4
+        segments of segment_seconds in that directory, each
+        listed in SEGMENT_LIST once it is finished, and pipe
+        is not used """
     logger.debug("instantiating FFMpegProcess")
-    self.pipe = open(pipe, 'wb')
-    self.p = subprocess.Popen([
-      'ffmpeg', '-y', '-f', 'image2pipe', '-r', str(fps),
-      '-s', '%sx%s' % (width, height), '-i', '-',
-      '-crf', "0", '-vcodec', 'libx264', '-f', 'matroska', "-" ],
-       stdin=subprocess.PIPE, stdout=self.pipe)
+    self.input_format = input_format
+    self.pipe = open(pipe, 'wb') if pipe is not None else None
+    if input_format == 'rawvideo':
+      pix_fmt = 'bgr24' if is_color else 'gray'
+      input_args = ['-f', 'rawvideo', '-pix_fmt', pix_fmt]
+    elif input_format == 'image2pipe':
+      input_args = ['-f', 'image2pipe']
+      self.encoder = CV2JPEGEncoder(
+        getattr(get_default_encoder(), 'quality', 90))
+    else:
+      raise ValueError("unknown ffmpeg input format: %s" % input_format)
+    output_args = ['-vcodec', 'libx264', '-crf', str(crf)]
+    if preset:
+      output_args += ['-preset', preset]
+    if tune:
+      output_args += ['-tune', tune]
+    output_args += ['-pix_fmt', 'yuv420p']
+    if segment_dir is None:
+      output_args += ['-f', 'matroska', '-']
+    else:
+      output_args += [
+        # keyframe on every boundary so segments are exactly
+        # segment_seconds long and each one plays on its own:
+        '-force_key_frames', 'expr:gte(t,n_forced*%s)' % segment_seconds,
+        '-f', 'segment', '-segment_time', str(segment_seconds),
+        '-segment_format', 'mp4', '-segment_format_options',
+        'movflags=+frag_keyframe+empty_moov+default_base_moof',
+        '-reset_timestamps', '1',
+        '-segment_list', os.path.join(segment_dir, SEGMENT_LIST),
+        '-segment_list_type', 'csv',
+        os.path.join(segment_dir, 'segment-%05d.mp4')]
+    self.p = subprocess.Popen(['ffmpeg', '-y'] + input_args +
+      ['-r', str(fps), '-s', '%sx%s' % (width, height), '-i', '-'] +
+      output_args, stdin=subprocess.PIPE,
+      stdout=self.pipe if self.pipe is not None else subprocess.DEVNULL)
 
   def write(self, frame):
     """ write frame to ffmpeg """
 
     logger.debug("writing frame")
-    last_frame = frame
-    buf = frame.encode()
-    buf.seek(0)
-    self.p.stdin.write(buf.read())
+    # time spent blocked here is ffmpeg falling behind
+    with _metric('histogram', 'smartcam_ffmpeg_write_seconds').time():
+      if self.input_format == 'rawvideo':
+        self.p.stdin.write(np.ascontiguousarray(frame.image).data)
+      else:
+        self.p.stdin.write(frame.encode_str(self.encoder))
+    frame.stamp(trace.FFMPEG_WRITE)
 
   def close(self):
     logger.debug("FFMpegProcess: closing")
     try:
       self.p.stdin.close()
       self.p.wait()
-      self.pipe.close()
+      if self.pipe is not None:
+        self.pipe.close()
     except Exception as e:
       logger.error("Failed to close FFMpeg: %s" % e)
 
@@ -46,9 +110,11 @@ class FFMpegProcess:
     self.close()
 
 
+CHUNK_SIZE = 1048576
+
+
 def chunk_generator(pipe):
   """ return generator function """
-  CHUNK_SIZE = 1048576
   while True:
     data = pipe.read(CHUNK_SIZE)
     if len(data) == 0:
@@ -58,27 +124,211 @@ def chunk_generator(pipe):
     yield data
 
 
+def follow_file(path, done):
+  """ generator over a file another thread is still writing --
+      returns once done is set and everything has been read """
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(CHUNK_SIZE)
+      if data:
+        yield data
+      elif done.is_set():
+        # catch anything written between the read and the check
+        data = f.read(CHUNK_SIZE)
+        if not data:
+          return
+        yield data
+      else:
+        time.sleep(0.05)
+
+
+def file_chunks(path):
+  """ generator over a finished file """
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(CHUNK_SIZE)
+      if not data:
+        return
+      yield data
+
+
+def from_epoch_ms(t):
+  return datetime.datetime.utcfromtimestamp(t / 1000.0)
+
+
+def video_from_meta(meta):
+  """ rebuild RemoteVideo from spooled metadata """
+  return RemoteVideo(meta['camera_id'],
+    from_epoch_ms(meta['start']), from_epoch_ms(meta['end']),
+    meta['width'], meta['height'],
+    meta['bucket'], meta['key'], meta['region'])
+
+
+def manifest_from_meta(meta):
+  """ rebuild SegmentedVideo from spooled metadata """
+  return SegmentedVideo(meta['camera_id'],
+    from_epoch_ms(meta['start']), from_epoch_ms(meta['end']),
+    meta['width'], meta['height'],
+    [ dict(s, start=from_epoch_ms(s['start']), end=from_epoch_ms(s['end']))
+      for s in meta['segments'] ])
+
+
+def counted(chunks, counter):
+  """ pass chunks through, counting their bytes """
+  for chunk in chunks:
+    counter.inc(len(chunk))
+    yield chunk
+
+
+def upload_video_data(api_manager, cloud_writer, chunks, camera_id, start,
+                      ext='mkv'):
+  """ upload clip binary, streaming it straight into cloud
+      storage if there is a cloud_writer, through the api
+      otherwise; return its location """
+  dest = 'api' if cloud_writer is None else 's3'
+  if not isinstance(chunks, (bytes, bytearray)):
+    chunks = counted(chunks,
+      _metric('counter', 'smartcam_upload_bytes_total', dest=dest))
+  try:
+    with _metric('histogram', 'smartcam_upload_seconds', kind='video').time():
+      if cloud_writer is None:
+        return api_manager.post_video_data(chunks)
+      key = cloud_writer.write_stream(chunks,
+        cloud_writer.get_video_path(camera_id, start, ext))
+  except Exception:
+    _metric('counter', 'smartcam_upload_failures_total', kind='video').inc()
+    raise
+  return { 'bucket': cloud_writer.bucket, 'key': key,
+    'region': cloud_writer.region }
+
+
+def video_spool_handlers(api_manager, cloud_writer=None):
+  """ SpoolUploader handlers for clips spooled by VideoManager """
+  def replay_video(spool, record):
+    meta = record['meta']
+    resp = upload_video_data(api_manager, cloud_writer, spool.read(record),
+      meta['camera_id'], from_epoch_ms(meta['start']), meta.get('ext', 'mkv'))
+    meta = dict(meta, bucket=resp['bucket'], key=resp['key'],
+      region=resp['region'])
+    api_manager.post_video(video_from_meta(meta))
+
+  def replay_video_meta(spool, record):
+    api_manager.post_video(video_from_meta(record['meta']))
+
+  def replay_video_manifest(spool, record):
+    api_manager.post_video(manifest_from_meta(record['meta']))
+
+  return { 'video': replay_video, 'video_meta': replay_video_meta,
+    'video_manifest': replay_video_manifest }
+
+
 class VideoManager:
-  ''' manage ffmpeg and remote api calls '''
-  def __init__(self, fps, api_manager, frame):
+  ''' manage ffmpeg and remote api calls -- given a cloud_writer
+      the clip is streamed straight into cloud storage and only
+      its metadata goes to the api.  Given a spool, ffmpeg
+      output is drained to a local file as fast as it is
+      produced and uploaded from there, so recording never
+      waits on the network, and clips that fail to upload are
+      spooled for SpoolUploader to retry '''
+  def __init__(self, fps, api_manager, frame, ffmpeg_options=None,
+               spool=None, cloud_writer=None):
     self.r, self.w = os.pipe()
     self.first_frame = frame
     self.current_frame = frame
-    self.ffmpeg = FFMpegProcess(fps, frame.width, frame.height, self.w)
+    self.ffmpeg = FFMpegProcess(fps, frame.width, frame.height, self.w,
+      is_color=frame.image.ndim == 3, **(ffmpeg_options or {}))
     self.api_manager = api_manager
+    self.cloud_writer = cloud_writer
+    self.spool = spool
     self.lock = Lock()
+    self.samples = []
     self.readfh = open(self.r, 'rb')
-    Thread(target=self.post_video,
-      args=(chunk_generator(self.readfh),),
+    if spool is None:
+      Thread(target=self.post_video,
+        args=(chunk_generator(self.readfh),),
+        name='api_manager_video_post').start()
+      return
+    self.path = spool.temp_path()
+    self.spool_fh = open(self.path, 'wb')
+    self.written = Event()
+    Thread(target=self.drain, name='video_spool_drain').start()
+    Thread(target=self.post_spooled_video,
       name='api_manager_video_post').start()
 
+  def upload(self, chunks):
+    return upload_video_data(self.api_manager, self.cloud_writer, chunks,
+      self.first_frame.id, self.first_frame.time)
+
+  def metadata(self, resp=None):
+    meta = {
+      'camera_id': self.first_frame.id,
+      'start': convert_time(self.first_frame.time),
+      'end': convert_time(self.current_frame.time),
+      'width': self.first_frame.width,
+      'height': self.first_frame.height
+    }
+    if resp is not None:
+      meta.update(bucket=resp['bucket'], key=resp['key'],
+        region=resp['region'])
+    return meta
+
+  def emit_samples(self, uploaded):
+    """ write traces of the traced frames in the clip """
+    for s in self.samples:
+      if uploaded:
+        s.stamp(trace.UPLOAD)
+      trace.emit(s, 'video')
+
+  def drain(self):
+    """ copy ffmpeg output to the local file """
+    try:
+      with self.spool_fh as f:
+        for chunk in chunk_generator(self.readfh):
+          f.write(chunk)
+          f.flush()
+    except Exception as e:
+      logger.error("ERROR: Failed to write video to spool: %s" % e)
+    finally:
+      self.readfh.close()
+      self.written.set()
+
+  def post_spooled_video(self):
+    """ post video binary, following the local file while
+        ffmpeg is still writing it, then metadata """
+    try:
+      try:
+        resp = self.upload(follow_file(self.path, self.written))
+      except Exception as e:
+        logger.error("ERROR: Failed to post video, spooling it: %s" % e)
+        self.emit_samples(False)
+        self.written.wait()
+        self.spool.put_file('video', self.metadata(), self.path)
+        return
+      self.emit_samples(True)
+      try:
+        self.api_manager.post_video(video_from_meta(self.metadata(resp)))
+      except Exception as e:
+        logger.error("ERROR: Failed to post video metadata, spooling it: %s"
+          % e)
+        self.spool.put('video_meta', self.metadata(resp), b'')
+    except Exception as e:
+      logger.error("ERROR: Failed to spool video: %s" % e)
+    finally:
+      self.written.wait()
+      os.remove(self.path)
+
   def post_video(self, generator):
     """ post video binary then metadata, hold
         lock to prevent pipe from being closed from
         other thread """
     try:
       with self.lock:
-        resp = self.api_manager.post_video_data(generator)
+        try:
+          resp = self.upload(generator)
+        except Exception:
+          self.emit_samples(False)
+          raise
+        self.emit_samples(True)
         self.api_manager.post_video(RemoteVideo(
             self.first_frame.id,
             self.first_frame.time,
@@ -94,23 +344,193 @@ class VideoManager:
   def on_next(self, frame):
     self.current_frame = frame
     self.ffmpeg.write(frame)
+    if frame.stamps is not None:
+      self.samples.append(trace.Sample(frame))
 
   def on_completed(self):
-    """ this should block until post_video is done """
+    """ without a spool, this blocks until post_video is done """
     self.ffmpeg.close()
+    if self.spool is not None:
+      self.ffmpeg = None
+      return
     with self.lock:
       self.ffmpeg = None
       self.readfh.close()
 
 
+class SegmentedVideoManager:
+  ''' record to fixed-length fragmented mp4 segments in a local
+      directory rather than one stream -- each segment is
+      uploaded as soon as ffmpeg finishes it, up to
+      upload_workers at a time, and when the recording ends a
+      SegmentedVideo manifest of them is posted to the api.
+      Upload size is bounded by the segment length, and a
+      crash loses at most the segment being written.  Segments
+      that fail to upload are spooled as clips of their own
+      if there is a spool. '''
+  def __init__(self, fps, api_manager, frame, ffmpeg_options=None,
+               spool=None, cloud_writer=None, segment_seconds=10,
+               segment_dir=None, upload_workers=2):
+    self.first_frame = frame
+    self.current_frame = frame
+    self.api_manager = api_manager
+    self.cloud_writer = cloud_writer
+    self.spool = spool
+    self.dir = tempfile.mkdtemp(prefix='segments-', dir=segment_dir)
+    self.list_path = os.path.join(self.dir, SEGMENT_LIST)
+    self.list_offset = 0
+    self.ffmpeg = FFMpegProcess(fps, frame.width, frame.height, None,
+      is_color=frame.image.ndim == 3, segment_dir=self.dir,
+      segment_seconds=segment_seconds, **(ffmpeg_options or {}))
+    self.pool = concurrent.futures.ThreadPoolExecutor(upload_workers)
+    self.uploads = []
+    self.samples = []
+    # (start, end) offset of each uploaded segment -> time
+    # its upload finished, for tracing:
+    self.uploaded = {}
+    self.stopped = Event()
+    self.watcher = Thread(target=self.watch, name='video_segment_watch')
+    self.watcher.start()
+
+  def watch(self):
+    """ submit segments for upload as ffmpeg lists them """
+    while not self.stopped.wait(0.2):
+      self.submit_finished()
+    self.submit_finished()
+
+  def submit_finished(self):
+    if not os.path.exists(self.list_path):
+      return
+    with open(self.list_path, 'rb') as f:
+      f.seek(self.list_offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          break
+        self.list_offset += len(line)
+        (name, start, end) = line.decode('utf-8').strip().rsplit(',', 2)
+        self.uploads.append(self.pool.submit(self.upload_segment,
+          os.path.join(self.dir, os.path.basename(name)),
+          float(start), float(end)))
+
+  def metadata(self, start, end):
+    return {
+      'camera_id': self.first_frame.id,
+      'start': convert_time(start),
+      'end': convert_time(end),
+      'width': self.first_frame.width,
+      'height': self.first_frame.height
+    }
+
+  def upload_segment(self, path, start, end):
+    """ upload segment, return its manifest entry or
+        None if it could not be uploaded """
+    segment = {
+      'start': self.first_frame.time + datetime.timedelta(seconds=start),
+      'end': self.first_frame.time + datetime.timedelta(seconds=end)
+    }
+    try:
+      try:
+        resp = upload_video_data(self.api_manager, self.cloud_writer,
+          file_chunks(path), self.first_frame.id, segment['start'], 'mp4')
+      except Exception as e:
+        if self.spool is None:
+          raise
+        logger.error("ERROR: Failed to post video segment, spooling it: %s"
+          % e)
+        meta = self.metadata(segment['start'], segment['end'])
+        self.spool.put_file('video', dict(meta, ext='mp4'), path)
+        return None
+      segment.update(bucket=resp['bucket'], key=resp['key'],
+        region=resp['region'])
+      self.uploaded[(start, end)] = time.monotonic()
+      return segment
+    except Exception as e:
+      logger.error("ERROR: Failed to post video segment: %s" % e)
+      return None
+    finally:
+      os.remove(path)
+
+  def emit_samples(self):
+    """ write traces of the traced frames, stamped with the
+        upload of the segment each one ended up in """
+    for s in self.samples:
+      offset = (s.time - self.first_frame.time).total_seconds()
+      for ((start, end), t) in self.uploaded.items():
+        if start <= offset < end:
+          s.stamp(trace.UPLOAD, t)
+      trace.emit(s, 'video')
+
+  def post_manifest(self):
+    """ wait for the remaining segment uploads, then post
+        the manifest of those that made it """
+    try:
+      self.watcher.join()
+      self.pool.shutdown(wait=True)
+      self.emit_samples()
+      segments = [ s for s in (f.result() for f in self.uploads)
+                   if s is not None ]
+      if not segments:
+        return
+      video = SegmentedVideo(self.first_frame.id, self.first_frame.time,
+        self.current_frame.time, self.first_frame.width,
+        self.first_frame.height, segments)
+      try:
+        self.api_manager.post_video(video)
+      except Exception as e:
+        if self.spool is None:
+          raise
+        logger.error("ERROR: Failed to post video manifest, spooling it: %s"
+          % e)
+        meta = self.metadata(video.start, video.end)
+        meta['segments'] = [ dict(s, start=convert_time(s['start']),
+          end=convert_time(s['end'])) for s in segments ]
+        self.spool.put('video_manifest', meta, b'')
+    except Exception as e:
+      logger.error("ERROR: Failed to post video manifest: %s" % e)
+    finally:
+      shutil.rmtree(self.dir, ignore_errors=True)
+
+  def on_next(self, frame):
+    self.current_frame = frame
+    self.ffmpeg.write(frame)
+    if frame.stamps is not None:
+      self.samples.append(trace.Sample(frame))
+
+  def on_completed(self):
+    """ the last segments and the manifest are posted
+        from another thread, so this does not block """
+    self.ffmpeg.close()
+    self.ffmpeg = None
+    self.stopped.set()
+    Thread(target=self.post_manifest,
+      name='api_manager_video_post').start()
+
+
 class VideoWriterImpl(VideoWriter):
 
-  def __init__(self, queue, fps, api_manager):
+  def __init__(self, queue, fps, api_manager, ffmpeg_options=None,
+               spool=None, cloud_writer=None, segment_options=None):
+    """ ffmpeg_options are passed through to FFMpegProcess;
+        clips go to cloud_writer, if given, else through the api.
+        Given segment_options, each recording is made with a
+        SegmentedVideoManager taking those options """
     multiprocessing.Process.__init__(self)
     self.name =  VideoWriterImpl.__name__
     self.queue = queue
     self.fps = fps
     self.api_manager = api_manager
+    self.ffmpeg_options = ffmpeg_options
+    self.spool = spool
+    self.cloud_writer = cloud_writer
+    self.segment_options = segment_options
+
+  def manager(self, frame):
+    if self.segment_options is not None:
+      return SegmentedVideoManager(self.fps, self.api_manager, frame,
+        self.ffmpeg_options, self.spool, self.cloud_writer,
+        **self.segment_options)
+    return VideoManager(self.fps, self.api_manager, frame,
+      self.ffmpeg_options, self.spool, self.cloud_writer)
 
   def run(self):
     vid_man = None
@@ -118,7 +538,9 @@ class VideoWriterImpl(VideoWriter):
       try:
         frame = self.queue.get()
         if vid_man is None:
-          vid_man = VideoManager(self.fps, self.api_manager, frame)
+          if frame is None:
+            continue
+          vid_man = self.manager(frame)
         if frame is not None:
           vid_man.on_next(frame)
         else:
@@ -0,0 +1,34 @@
+from smartcam.queue import Queue, DROP_OLDEST
+
+
+def drain(q, n):
+  return [ q.get(timeout=1) for _ in range(n) ]
+
+
+def test_drop_oldest_evicts_head():
+  q = Queue('test', maxsize=3, policy=DROP_OLDEST)
+  for item in ('a', 'b', 'c', 'd'):
+    q.put(item)
+  assert drain(q, 3) == ['b', 'c', 'd']
+  assert q.dropped == 1
+
+
+def test_drop_oldest_keeps_marker_in_place():
+  q = Queue('test', maxsize=3, policy=DROP_OLDEST)
+  for item in (None, 'a', 'b', 'c'):
+    q.put(item)
+  # 'c' belongs to the next clip, so it must not get ahead of
+  # the marker ending the last one
+  assert drain(q, 3) == [None, 'a', 'b']
+  assert q.dropped == 1
+
+
+def test_drop_oldest_evicts_again_once_marker_is_got():
+  q = Queue('test', maxsize=3, policy=DROP_OLDEST)
+  for item in ('a', None, 'b', 'c'):
+    q.put(item)
+  assert drain(q, 3) == ['a', None, 'b']
+  for item in ('d', 'e', 'f', 'g'):
+    q.put(item)
+  assert drain(q, 3) == ['e', 'f', 'g']
+  assert q.dropped == 2